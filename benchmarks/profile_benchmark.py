@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+# Opens tabs the way kBrowser did before the profile manager, with a new QWebEngineProfile per tab, and with one shared
+# profile, each in its own process. Reports the time from creating a tab to its page finishing loading, and the memory
+# of the browser and its webengine processes once every tab has loaded.
+#     python benchmarks/profile_benchmark.py --tabs 50
+
+
+def read_children(pid):
+    children = list()
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children', encoding='utf-8') as children_file:
+                children.extend(int(child) for child in children_file.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def read_memory_kb(pid):
+    # Pss shares the pages used by several processes among them, so that the sum over processes is not inflated. RSS
+    # is the fallback on kernels without smaps_rollup.
+    for path, field in [(f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')]:
+        try:
+            with open(path, encoding='utf-8') as memory_file:
+                for line in memory_file:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+
+def read_process_tree_memory_mb(pid):
+    pids = [pid]
+    for process in pids:
+        pids.extend(read_children(process))
+    return sum(read_memory_kb(process) for process in pids) / 1024, len(pids)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_tabs(mode, tab_count, url):
+    # Runs in the child process, prints one JSON line with the results.
+    from PySide6.QtCore import QUrl, QTimer
+    from PySide6.QtWidgets import QApplication, QTabWidget
+    from PySide6.QtWebEngineCore import QWebEngineProfile, QWebEnginePage
+    from PySide6.QtWebEngineWidgets import QWebEngineView
+
+    app = QApplication([])
+    tabs = QTabWidget()
+    tabs.resize(1024, 768)
+    tabs.show()
+
+    profile_folder = tempfile.mkdtemp(prefix='kbprofile-benchmark-')
+    shared_profile = None
+    if mode == 'shared':
+        shared_profile = QWebEngineProfile('kBrowser', app)
+        shared_profile.setCachePath(os.path.join(profile_folder, 'cache'))
+        shared_profile.setPersistentStoragePath(os.path.join(profile_folder, 'storage'))
+        shared_profile.setHttpAcceptLanguage('en-US')
+
+    latencies = list()
+    results = dict()
+
+    def open_tab():
+        start = time.perf_counter()
+        web_view = QWebEngineView()
+        if mode == 'shared':
+            profile = shared_profile
+        else:
+            profile = QWebEngineProfile('kBrowser', web_view)
+            profile.setCachePath(os.path.join(profile_folder, 'cache'))
+            profile.setPersistentStoragePath(os.path.join(profile_folder, 'storage'))
+            profile.setHttpAcceptLanguage('en-US')
+        web_view.setPage(QWebEnginePage(profile, web_view))
+        web_view.loadFinished.connect(lambda ok, start=start: tab_loaded(start))
+        web_view.setUrl(QUrl(url))
+        tabs.setCurrentIndex(tabs.addTab(web_view, str(tabs.count() + 1)))
+
+    def tab_loaded(start):
+        latencies.append((time.perf_counter() - start) * 1000)
+        if len(latencies) < tab_count:
+            QTimer.singleShot(0, open_tab)
+        else:
+            # Give the webengine processes a moment to settle before measuring them.
+            QTimer.singleShot(2000, finish)
+
+    def finish():
+        memory_mb, processes = read_process_tree_memory_mb(os.getpid())
+        results.update({'mode': mode, 'tabs': tab_count, 'p50': percentile(latencies, 0.5),
+                        'p99': percentile(latencies, 0.99), 'max': max(latencies), 'memory_mb': memory_mb,
+                        'processes': processes})
+        app.quit()
+
+    QTimer.singleShot(0, open_tab)
+    app.exec()
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tabs', type=int, default=50)
+    parser.add_argument('--url', default='data:text/html,<title>kBrowser</title><p>benchmark</p>')
+    parser.add_argument('--modes', nargs='+', default=['per-tab', 'shared'], choices=['per-tab', 'shared'])
+    parser.add_argument('--child', choices=['per-tab', 'shared'], help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        run_tabs(arguments.child, arguments.tabs, arguments.url)
+        return
+
+    for mode in arguments.modes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, '--tabs',
+                                 str(arguments.tabs), '--url', arguments.url],
+                                check=True, capture_output=True, text=True).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        print(f'{results["mode"]:8} {results["tabs"]} tabs: open to loaded p50 {results["p50"]:7.1f} ms    '
+              f'p99 {results["p99"]:7.1f} ms    max {results["max"]:7.1f} ms    '
+              f'memory {results["memory_mb"]:7.1f} MiB in {results["processes"]} processes')
+
+
+if __name__ == '__main__':
+    main()
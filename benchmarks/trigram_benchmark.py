@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kbtrigram import TrigramIndex
+
+
+# Compares substring matching of the address bar completion over synthetic history: a linear scan like QCompleter with
+# Qt.MatchContains, and candidates of the trigram index which are checked afterwards.
+#     python benchmarks/trigram_benchmark.py --sizes 100000 1000000
+
+
+def generate_history(size, seed):
+    generator = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(generator.choice(letters) for _ in range(generator.randint(3, 10))) for _ in range(5000)]
+    hosts = [f'{generator.choice(["www.", ""])}{generator.choice(words)}{generator.choice(words)}.'
+             f'{generator.choice(["com", "org", "net", "io", "de"])}' for _ in range(20000)]
+
+    history = list()
+    for _ in range(size):
+        path = '/'.join(generator.choice(words) for _ in range(generator.randint(1, 3)))
+        query = f'?id={generator.randint(0, 10 ** 7)}' if generator.random() < 0.4 else ''
+        title = ' '.join(generator.choice(words).capitalize() for _ in range(generator.randint(2, 6)))
+        history.append((f'https://{generator.choice(hosts)}/{path}{query}', title))
+    return history, words
+
+
+def generate_queries(history, words, count, seed):
+    # Prefixes of words and hosts as they are typed, and texts which match nothing.
+    generator = random.Random(seed)
+    queries = list()
+    for n in range(count):
+        if n % 4 == 0:
+            url, _ = generator.choice(history)
+            host = url.split('/')[2]
+            queries.append(host[:generator.randint(3, len(host))])
+        elif n % 4 == 1:
+            word = generator.choice(words)
+            queries.append(word[:generator.randint(3, len(word))])
+        elif n % 4 == 2:
+            queries.append(f'{generator.choice(words)} {generator.choice(words)[:3]}')
+        else:
+            queries.append(''.join(generator.choice('qxzj') for _ in range(4)))
+    return queries
+
+
+def linear_scan(texts, words, limit, stop_early=False):
+    # QCompleter filters the whole model. Texts made only of common trigrams match many urls, then the completion
+    # stops after limit urls.
+    results = list()
+    for url, text in texts:
+        if all(word in text for word in words):
+            results.append(url)
+            if stop_early and len(results) >= limit:
+                break
+    return results[:limit]
+
+
+def trigram_lookup(trigram_index, text_of, texts, words, limit):
+    candidates = trigram_index.candidates(words)
+    if candidates is None:
+        return linear_scan(texts, words, limit, True)
+    return [url for url in candidates if all(word in text_of[url] for word in words)][:limit]
+
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def measure(function, queries):
+    latencies = list()
+    for query in queries:
+        start = time.perf_counter()
+        function(query.lower().split())
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def run(size, query_count, limit, seed):
+    history, words = generate_history(size, seed)
+    # A url visited again with another title keeps the last one, as in the urls table.
+    text_of = {url: f'{url}\n{title}'.lower() for url, title in history}
+    texts = list(text_of.items())
+    queries = generate_queries(history, words, query_count, seed)
+
+    start = time.perf_counter()
+    trigram_index = TrigramIndex()
+    for url, text in texts:
+        trigram_index.add(url, text)
+    build_time = time.perf_counter() - start
+    postings = sum(len(posting) for posting in trigram_index.postings.values() if posting is not None)
+
+    # Both find the same urls, unless the trigram index falls back to the scan which stops early.
+    for query in queries:
+        words_of_query = query.lower().split()
+        if trigram_index.candidates(words_of_query) is None:
+            continue
+        if sorted(linear_scan(texts, words_of_query, size)) != \
+                sorted(trigram_lookup(trigram_index, text_of, texts, words_of_query, size)):
+            raise AssertionError(f'different results for {query!r}')
+
+    linear_latencies = measure(lambda words_of_query: linear_scan(texts, words_of_query, limit), queries)
+    trigram_latencies = measure(
+        lambda words_of_query: trigram_lookup(trigram_index, text_of, texts, words_of_query, limit), queries
+    )
+
+    print(f'{size} urls: trigram index built in {build_time:.1f} s, {len(trigram_index.postings)} trigrams, '
+          f'{postings * 4 / 1048576:.1f} MiB of posting lists')
+    for name, latencies in [('linear scan', linear_latencies), ('trigram index', trigram_latencies)]:
+        print(f'    {name:14} p50 {percentile(latencies, 0.5):8.3f} ms    p99 {percentile(latencies, 0.99):8.3f} ms    '
+              f'max {max(latencies):8.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=1)
+    arguments = parser.parse_args()
+
+    for size in arguments.sizes:
+        run(size, arguments.queries, arguments.limit, arguments.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,27 @@
 import sys
 
-from PySide6.QtCore import Qt, QUrl
-from PySide6.QtWidgets import (QWidget, QApplication, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout, QTabWidget,
-                               QCompleter)
-from PySide6.QtWebEngineCore import (QWebEnginePage, QWebEngineProfile, QWebEngineSettings, QWebEngineDownloadRequest)
+from PySide6.QtCore import Qt, QUrl, QTimer
+from PySide6.QtGui import QKeySequence, QShortcut
+from PySide6.QtWidgets import QWidget, QApplication, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout, QTabWidget
+from PySide6.QtWebEngineCore import QWebEnginePage, QWebEngineSettings, QWebEngineDownloadRequest
 from PySide6.QtWebEngineWidgets import QWebEngineView
 
+from kbdatabase import EnvironConfig, connection_manager, TRANSITION_LINK, TRANSITION_TYPED
+from kbbackup import profile_backup
 from kbsettings import Settings
-from kbsettingshandler import BasicSettings, SearchEngines, WindowSettings, LangSetting
+from kbsettingshandler import BasicSettings, WindowSettings, LangSetting
 from kbdownloader import DownloadsManagement
 from kbprivacy import CertificatesHandler, PermissionsHandler
-from kbhistory import HistoryManagement, VisitsHistory, DownloadsHistory
+from kbhistory import HistoryManagement, VisitsHistory, DownloadsHistory, history_writer
+from kbsession import SessionTab, SessionManager
+from kbsync import ProfileSync
+from kbcompleter import AddressBarCompleter
+from kbpreload import SpeculativePreloader
+from kbhttps import HttpsUpgradeInterceptor
+from kbomnibox import OmniboxClassifier
+from kbprofile import ProfileManager
+from kbtabs import TabLifecycleManager
+from kbtaskmanager import TaskManager, TaskManagerDialog
 
 
 class MainWindow(QWidget):
@@ -27,17 +38,25 @@ class MainWindow(QWidget):
         self.basic_settings = BasicSettings()
         self.window_settings = WindowSettings()
         self.LangSetting = LangSetting()
+        self.session_manager = SessionManager()
+        self.https_upgrade_interceptor = HttpsUpgradeInterceptor()
+        self.private_https_upgrade_interceptor = HttpsUpgradeInterceptor(
+            upgrade_list=self.https_upgrade_interceptor.upgrade_list, is_learning=False
+        )
+        self.omnibox_classifier = OmniboxClassifier()
+        self.profile_manager = ProfileManager(self.https_upgrade_interceptor, self.private_https_upgrade_interceptor)
+        # Handle a request for a download.
+        self.profile_manager.download_requested.connect(self.open_download)
 
         # Title of the browser's main window
         self.setWindowTitle('kBrowser')
 
         # Address bar
         self.address_bar = QLineEdit()
-        self.history_urls = self.visits_history.read_history_urls()
-        address_suggestions = QCompleter(self.history_urls)
-        address_suggestions.setCompletionMode(QCompleter.PopupCompletion)
-        address_suggestions.setFilterMode(Qt.MatchContains)
-        self.address_bar.setCompleter(address_suggestions)
+        self.address_bar_completer = AddressBarCompleter()
+        self.address_bar_completer.load_history()
+        self.address_bar.setCompleter(self.address_bar_completer)
+        self.preloader = SpeculativePreloader()
 
         # Tabs for web_view
         self.tabs = QTabWidget()
@@ -47,8 +66,24 @@ class MainWindow(QWidget):
         self.tabs.setElideMode(Qt.ElideRight)
         self.tabs.setStyleSheet("QTabBar::tab { width: 160px; }")
 
-        # Initial tab
-        self.tab_add('')
+        # Background tabs are frozen after a while and discarded under memory pressure.
+        self.tab_lifecycle_manager = TabLifecycleManager(self.tabs)
+
+        # Tabs of the last session, or a blank tab
+        self.restore_session()
+        self.tab_lifecycle_manager.tab_activated(self.tabs.currentWidget())
+
+        # Memory and CPU usage of the tabs, shown with Shift+Esc.
+        self.task_manager = TaskManager(self.tabs, self.tab_lifecycle_manager)
+        self.task_manager_dialog = None
+        self.task_manager_shortcut = QShortcut(QKeySequence('Shift+Esc'), self)
+        self.task_manager_shortcut.activated.connect(self.task_management)
+
+        # Save the open tabs periodically, so that a crash loses little.
+        self.session_timer = QTimer()
+        self.session_timer.setInterval(30000)
+        self.session_timer.timeout.connect(self.save_session)
+        self.session_timer.start()
 
         # Buttons
         self.back_button = QPushButton(self.LangSetting.language.lang_back)
@@ -110,29 +145,49 @@ class MainWindow(QWidget):
 
         # Actions of operating a keyboard
         self.address_bar.returnPressed.connect(self.load)
+        self.address_bar.textEdited.connect(self.address_bar_completer.update_suggestions)
+        self.address_bar_completer.suggestions_signal.connect(self.preload_suggestion)
 
         # Actions of operating tabs
         self.tabs.tabBarDoubleClicked.connect(self.tab_open)
         self.tabs.currentChanged.connect(self.tab_change)
         self.tabs.tabCloseRequested.connect(self.tab_close)
 
-    def update_address_bar_completer(self, page_title, web_view):
+    def page_visited(self, page_title, web_view):
+        # A page loaded from the address bar counts as a typed visit, which ranks higher in the completion. The first
+        # titles of a page are often its url and are not recorded, so the typed flag is kept until a visit is.
+        transition = TRANSITION_TYPED if getattr(web_view, 'typed_navigation', False) else TRANSITION_LINK
+
         web_address = web_view.url().toString()
-        no_suggest = ['', 'about:blank', page_title, f'{page_title}/']
-        if web_address not in no_suggest:
-            if web_address not in self.history_urls:
-                self.history_urls.append(web_address)
-                address_suggestions = QCompleter(self.history_urls)
-                address_suggestions.setCompletionMode(QCompleter.PopupCompletion)
-                address_suggestions.setFilterMode(Qt.MatchContains)
-                self.address_bar.setCompleter(address_suggestions)
+        if self.visits_history.is_recorded(page_title, web_address):
+            web_view.typed_navigation = False
+            self.address_bar_completer.record_visit(web_address, page_title, transition)
+
+        # When private browsing status is disabled, every visit will be recorded into history database.
+        private_browsing_status = self.basic_settings.read_private_browsing()
+        if private_browsing_status == self.LangSetting.language.lang_no:
+            self.visits_history.record_a_visit(page_title, web_view, transition)
+
+    def preload_suggestion(self, text, suggestions, frecencies):
+        preload_suggestions_status = self.basic_settings.read_preload_suggestions()
+        if preload_suggestions_status == self.LangSetting.language.lang_yes:
+            self.preloader.suggest(suggestions, frecencies, self.tabs.currentWidget().page().profile())
+        else:
+            self.preloader.cancel()
+
+    def adopt_page(self, web_view, page):
+        # The previous page of the view is deleted by setPage, the signals are connected to the adopted one.
+        page.setParent(web_view)
+        web_view.setPage(page)
+        self.web_signals(web_view)
+
+        self.update_address(page.url(), web_view)
+        if page.title():
+            self.page_title_changed(page.title(), web_view)
+            self.page_visited(page.title(), web_view)
 
     def clear_address_bar_completer(self):
-        self.history_urls = []
-        address_suggestions = QCompleter(self.history_urls)
-        address_suggestions.setCompletionMode(QCompleter.PopupCompletion)
-        address_suggestions.setFilterMode(Qt.MatchContains)
-        self.address_bar.setCompleter(address_suggestions)
+        self.address_bar_completer.clear()
 
     def open_url_receiver(self, url):
         self.tab_add(url)
@@ -150,6 +205,13 @@ class MainWindow(QWidget):
 
         self.settings_dialog.open_url_signal.connect(self.open_url_receiver)
 
+    def task_management(self):
+        if self.task_manager_dialog is not None and self.task_manager_dialog.isVisible():
+            self.task_manager_dialog.activateWindow()
+        else:
+            self.task_manager_dialog = TaskManagerDialog(self.task_manager)
+            self.task_manager_dialog.show()
+
     def history_management(self):
         self.history_dialog = HistoryManagement()
         if self.history_dialog.isVisible():
@@ -161,58 +223,88 @@ class MainWindow(QWidget):
         self.history_dialog.clear_address_bar_completer_signal.connect(self.clear_address_bar_completer)
         self.history_dialog.clear_cookies_signal.connect(self.clear_cookies)
 
-    def tab_add(self, web_address):
+    def create_web_view(self):
+        # Every tab uses the shared persistent profile, or the off-the-record one while private browsing is enabled.
         web_view = QWebEngineView()
+        profile_page = QWebEnginePage(self.profile_manager.read_profile(), web_view)
+        web_view.setPage(profile_page)
+
+        return web_view
+
+    def tab_add(self, web_address):
+        web_view = self.create_web_view()
+        web_view.setUrl(web_address)
+
+        n = self.tabs.addTab(web_view, self.LangSetting.language.lang_new_tab)
+        self.tabs.setCurrentIndex(n)
 
+        self.web_signals(web_view)
+
+    def restore_session(self):
+        # Restored tabs are placeholders until they are activated, so that a large session opens without creating a
+        # web view for every tab.
+        session_tabs = list()
         private_browsing_status = self.basic_settings.read_private_browsing()
         if private_browsing_status == self.LangSetting.language.lang_no:
-            profile = QWebEngineProfile('kBrowser', web_view)
+            session_tabs = self.session_manager.read_session()
 
-            cache_path, storage_path = self.basic_settings.read_cache_storage_path()
-            profile.setCachePath(cache_path)
-            profile.setPersistentStoragePath(storage_path)
+        if not session_tabs:
+            self.tab_add('')
+            return
 
-            profile_page = QWebEnginePage(profile, web_view)
-            web_view.setPage(profile_page)
+        current_index = 0
+        for n, (web_address, page_title, history, current) in enumerate(session_tabs):
+            session_tab = SessionTab(web_address, page_title, history)
+            self.tabs.addTab(session_tab, page_title or self.LangSetting.language.lang_new_tab)
+            if current:
+                current_index = n
 
-        download_folder = self.basic_settings.read_download_folder()
-        web_view.page().profile().setDownloadPath(download_folder)
+        self.tabs.setCurrentIndex(current_index)
+        self.materialize_tab(current_index)
 
-        http_language_code, _, _ = self.LangSetting.read_preferred_language_setting()
-        web_view.page().profile().setHttpAcceptLanguage(http_language_code)
+    def materialize_tab(self, n):
+        session_tab = self.tabs.widget(n)
+        if not isinstance(session_tab, SessionTab):
+            return
 
-        web_view.setUrl(web_address)
+        web_view = self.create_web_view()
+        if not session_tab.history or not self.session_manager.restore_history(web_view, session_tab.history):
+            web_view.setUrl(QUrl(session_tab.web_address))
 
-        n = self.tabs.addTab(web_view, self.LangSetting.language.lang_new_tab)
+        # Swapping the placeholder for the web view must not activate another tab in between.
+        self.tabs.blockSignals(True)
+        self.tabs.removeTab(n)
+        self.tabs.insertTab(n, web_view, session_tab.page_title or self.LangSetting.language.lang_new_tab)
         self.tabs.setCurrentIndex(n)
+        self.tabs.blockSignals(False)
+        session_tab.deleteLater()
 
         self.web_signals(web_view)
 
+    def save_session(self):
+        # Nothing about the open tabs is stored while private browsing is enabled.
+        private_browsing_status = self.basic_settings.read_private_browsing()
+        if private_browsing_status == self.LangSetting.language.lang_no:
+            self.session_manager.save_session(self.tabs)
+
     def load(self):
-        if self.address_bar.text() == 'about:blank':
-            web_address = QUrl('')
-        # Recognize the address bar's text which has a space or has no dot as keywords and trigger a search.
-        elif ' ' in self.address_bar.text() or '.' not in self.address_bar.text():
-            _, enabled_search_engine_url = SearchEngines().read_enabled_search_engine()
-            web_address = QUrl(f'{enabled_search_engine_url}{self.address_bar.text()}')
-        # Enable or disable a mode that only permit https visits.
-        else:
-            web_address = self.address_bar.text()
-            https_mode_status = self.basic_settings.read_https_mode()
-            if https_mode_status == 'Yes':
-                if '://' not in web_address:
-                    web_address = f'https://{web_address}'
-                web_address = QUrl(web_address)
-                if web_address.scheme() == 'http':
-                    web_address.setScheme('https')
-            else:
-                if '://' not in web_address:
-                    web_address = f'http://{web_address}'
-                web_address = QUrl(web_address)
-
-        self.tabs.currentWidget().setUrl(web_address)
+        # The classifier tells urls like localhost:8080 or intranet/wiki from searches and applies the https mode.
+        web_address = QUrl(self.omnibox_classifier.resolve(self.address_bar.text()))
+
+        web_view = self.tabs.currentWidget()
+        web_view.typed_navigation = True
+
+        # Adopt the page of the suggestion preloaded while typing, if it has this url.
+        preload_suggestions_status = self.basic_settings.read_preload_suggestions()
+        if preload_suggestions_status == self.LangSetting.language.lang_yes:
+            preloaded_page = self.preloader.take(web_address)
+            if preloaded_page is not None:
+                self.adopt_page(web_view, preloaded_page)
+                return
+        web_view.setUrl(web_address)
 
     def web_signals(self, web_view):
+        # Signals of the page of a view, connected again when the view adopts another page.
         # Enable full screen support when playing a video.
         web_view.settings().setAttribute(QWebEngineSettings.FullScreenSupportEnabled, True)
         # Update address bar after the url of a page is changed,
@@ -222,14 +314,9 @@ class MainWindow(QWidget):
         web_view.page().titleChanged.connect(lambda page_title, web_view=web_view:
                                              self.page_title_changed(page_title, web_view))
 
+        # Rank the page in the address bar completion and record it in the history.
         web_view.page().titleChanged.connect(lambda page_title, web_view=web_view:
-                                             self.update_address_bar_completer(page_title, web_view))
-        # When private browsing status is disabled, every visit will be recorded into history database.
-        private_browsing_status = self.basic_settings.read_private_browsing()
-        if private_browsing_status == self.LangSetting.language.lang_no:
-            web_view.page().titleChanged.connect(
-                lambda page_title, web_view=web_view: self.visits_history.record_a_visit(page_title, web_view)
-            )
+                                             self.page_visited(page_title, web_view))
 
         # Handle the error of a certificate.
         web_view.page().certificateError.connect(self.cert_dialog.cert_handling)
@@ -243,15 +330,22 @@ class MainWindow(QWidget):
 
         # If a link has an attribute "_blank", it will be opened in a new tab instead of a new window.
         web_view.page().newWindowRequested.connect(self.new_window)
-        # Handle a request for a download.
-        web_view.page().profile().downloadRequested.connect(
-            lambda download, web_view=web_view:
-            self.open_download(download, web_view)
-        )
+        # Learn the hosts of pages loaded over https.
+        web_view.page().loadFinished.connect(lambda ok, web_view=web_view: self.page_loaded(ok, web_view))
+
+    def page_loaded(self, ok, web_view):
+        # Nothing about visited hosts is stored while private browsing is enabled, nor for tabs opened in it before.
+        private_browsing_status = self.basic_settings.read_private_browsing()
+        if ok and private_browsing_status == self.LangSetting.language.lang_no and \
+                not web_view.page().profile().isOffTheRecord():
+            self.https_upgrade_interceptor.learn(web_view.url())
 
-    def open_download(self, download, web_view):
+    def open_download(self, download):
         download.accept()
 
+        # The page of the download is the reference of its history record.
+        web_view = download.page() or self.tabs.currentWidget()
+
         # When private browsing status is disabled, every download will be recorded into history database.
         private_browsing_status = self.basic_settings.read_private_browsing()
         if private_browsing_status == self.LangSetting.language.lang_no:
@@ -283,18 +377,32 @@ class MainWindow(QWidget):
             self.tab_add('')
 
     def tab_change(self):
+        # A preloaded page was started for the text typed in the previous tab.
+        self.preloader.cancel()
+
+        if isinstance(self.tabs.currentWidget(), SessionTab):
+            self.materialize_tab(self.tabs.currentIndex())
+
+        self.tab_lifecycle_manager.tab_activated(self.tabs.currentWidget())
+
         web_address = self.tabs.currentWidget().url()
         self.update_address(web_address, self.tabs.currentWidget())
 
     def tab_close(self, n):
         if self.tabs.count() == 1:
+            self.save_session()
+            self.address_bar_completer.stop()
+            self.https_upgrade_interceptor.save()
+            self.task_manager.stop(force=True)
+            history_writer.flush()
             sys.exit()
 
-        # Generally the close of a tab is just hiding the tab and the webengine process still runs in the background.
-        # The function terminates an instance after closing a tab, except a webengine process related to a download.
+        # Removing a tab only hides it, its view and page are deleted so that the webengine process of the page ends.
+        # Downloads belong to the shared profile and continue.
         widget_info = self.tabs.widget(n)
+        self.tab_lifecycle_manager.tab_removed(widget_info)
         self.tabs.removeTab(n)
-        widget_info.page().deleteLater()
+        widget_info.deleteLater()
 
     def update_address(self, web_address, web_view=None):
         if web_view != self.tabs.currentWidget():
@@ -326,9 +434,33 @@ class MainWindow(QWidget):
         window_height = self.geometry().height()
         self.window_settings.save_window_size(window_width, window_height)
 
+        self.save_session()
+        self.address_bar_completer.stop()
+        self.https_upgrade_interceptor.save()
+        self.task_manager.stop(force=True)
+
+        # Write the visits and downloads which are still queued in the history writer.
+        history_writer.flush()
+
 
 if __name__ == '__main__':
     app = QApplication([])
+
+    synchronous, mmap_size, cache_size = EnvironConfig().read_database_settings()
+    connection_manager.configure(synchronous, mmap_size, cache_size)
+
+    # Damaged profile databases are restored from the newest backup before anything opens them.
+    profile_backup.restore_corrupt_databases()
+    profile_backup.start()
+    app.aboutToQuit.connect(profile_backup.stop)
+
+    # Changes are shared with other devices through a folder set by SyncFolder in kbconfiguration.
+    sync_folder = EnvironConfig().read_sync_folder()
+    if sync_folder:
+        profile_sync = ProfileSync(sync_folder)
+        profile_sync.start()
+        app.aboutToQuit.connect(profile_sync.stop)
+
     widget = MainWindow()
 
     screen = app.primaryScreen()
@@ -341,4 +473,9 @@ if __name__ == '__main__':
         widget.setWindowState(Qt.WindowMaximized)
 
     widget.show()
+
+    # Slots run in the order they were connected. The pooled connections are closed last, after every thread which
+    # may still use them was stopped.
+    app.aboutToQuit.connect(history_writer.stop)
+    app.aboutToQuit.connect(connection_manager.close_all)
     sys.exit(app.exec())
@@ -0,0 +1,221 @@
+import os
+import time
+import glob
+import shutil
+import sqlite3
+import threading
+import urllib.parse
+
+from kbdatabase import EnvironConfig, connection_manager, database_registry
+
+
+class ProfileBackup(threading.Thread):
+    # Copies the profile databases into rotating snapshots while the browser runs. The SQLite backup API copies a few
+    # pages per step and the thread sleeps between steps, so that the database is never locked for long.
+    database_names = ['kbsettings.db', 'kbhistory.db']
+    history_archive_folder = 'history_archive'
+
+    def __init__(self, pages_per_step=256, step_sleep=0.02, max_restarts=5, keep=3, first_run_delay=300,
+                 interval=86400):
+        super(ProfileBackup, self).__init__(name='ProfileBackup', daemon=True)
+
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.max_restarts = max_restarts
+        self.keep = keep
+        self.first_run_delay = first_run_delay
+        self.interval = interval
+
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.last_backup_time = None
+
+    @staticmethod
+    def read_profile_path():
+        custom_profile_path = EnvironConfig().read_custom_profile_path()
+        return custom_profile_path
+
+    def read_backup_folder(self, custom_profile_path=None):
+        if custom_profile_path is None:
+            custom_profile_path = self.read_profile_path()
+
+        backup_folder = os.path.normpath(os.path.join(custom_profile_path, 'backups'))
+        if os.path.exists(backup_folder) is False:
+            os.mkdir(backup_folder)
+
+        return backup_folder
+
+    def read_snapshots(self, backup_folder):
+        # Snapshot folders are named by their creation time, so that the newest one sorts last.
+        snapshots = [name for name in os.listdir(backup_folder)
+                     if name.startswith('snapshot-') and os.path.isdir(os.path.join(backup_folder, name))]
+        snapshots.sort()
+        snapshots = [os.path.join(backup_folder, name) for name in snapshots]
+        return snapshots
+
+    def read_archive_names(self, custom_profile_path):
+        # The monthly history archives are backed up with the profile databases, as paths relative to the profile.
+        archives = glob.glob(os.path.join(custom_profile_path, self.history_archive_folder,
+                                          'kbhistory-[0-9][0-9][0-9][0-9]-[0-9][0-9].db'))
+        archives.sort()
+        return [os.path.join(self.history_archive_folder, os.path.basename(archive_path)) for archive_path in archives]
+
+    def read_database_names(self, custom_profile_path):
+        return self.database_names + self.read_archive_names(custom_profile_path)
+
+    @staticmethod
+    def is_database_intact(db_path):
+        try:
+            connection = sqlite3.connect(f'file:{urllib.parse.quote(db_path)}?mode=ro', uri=True)
+            try:
+                result = connection.execute('PRAGMA quick_check').fetchone()[0]
+            finally:
+                connection.close()
+        except sqlite3.OperationalError:
+            # A locked or unreadable file is not a damaged one.
+            raise
+        except sqlite3.DatabaseError:
+            return False
+
+        return result == 'ok'
+
+    def backup_database(self, db_path, backup_path):
+        # Without WAL, a write from another connection restarts the copy at the next step. After a few restarts the
+        # remaining pages are copied without sleeping.
+        progress_state = {'remaining': None, 'restarts': 0}
+
+        def step(status, remaining, total):
+            if progress_state['remaining'] is not None and remaining > progress_state['remaining']:
+                progress_state['restarts'] += 1
+            progress_state['remaining'] = remaining
+            if progress_state['restarts'] < self.max_restarts and self.stop_event.is_set() is False:
+                time.sleep(self.step_sleep)
+
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(backup_path)
+        try:
+            source.execute('PRAGMA busy_timeout = 5000')
+            # In WAL mode an open read transaction pins one version of the database for the whole copy without
+            # blocking writers, so that their commits do not restart it.
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=self.pages_per_step, progress=step)
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+
+    def create_snapshot(self):
+        with self.lock:
+            custom_profile_path = self.read_profile_path()
+            backup_folder = self.read_backup_folder(custom_profile_path)
+
+            # The snapshot is written to a partial folder and renamed when every database is copied and checked.
+            snapshot_name = time.strftime('snapshot-%Y%m%d-%H%M%S')
+            partial_folder = os.path.join(backup_folder, f'{snapshot_name}.partial')
+            shutil.rmtree(partial_folder, ignore_errors=True)
+            os.mkdir(partial_folder)
+            os.mkdir(os.path.join(partial_folder, self.history_archive_folder))
+
+            try:
+                for database_name in self.read_database_names(custom_profile_path):
+                    db_path = os.path.join(custom_profile_path, database_name)
+                    if os.path.exists(db_path) is False:
+                        continue
+                    backup_path = os.path.join(partial_folder, database_name)
+                    self.backup_database(db_path, backup_path)
+                    if self.is_database_intact(backup_path) is False:
+                        raise sqlite3.DatabaseError(f'{database_name} backup failed quick_check')
+
+                snapshot_folder = os.path.join(backup_folder, snapshot_name)
+                os.replace(partial_folder, snapshot_folder)
+            except (OSError, sqlite3.Error):
+                shutil.rmtree(partial_folder, ignore_errors=True)
+                raise
+
+            for snapshot in self.read_snapshots(backup_folder)[:-self.keep]:
+                shutil.rmtree(snapshot, ignore_errors=True)
+
+            self.last_backup_time = time.time()
+            return snapshot_folder
+
+    def restore_corrupt_databases(self, database_names=None):
+        # Runs at startup for the profile databases, before any connection is opened. A database which fails
+        # quick_check is moved aside and replaced by its copy in the newest intact snapshot. Returns the names of the
+        # restored databases. The archives are checked by restore_corrupt_archives in the backup thread, so that
+        # startup does not grow with their number.
+        custom_profile_path = self.read_profile_path()
+        backup_folder = self.read_backup_folder(custom_profile_path)
+        snapshots = self.read_snapshots(backup_folder)
+        if database_names is None:
+            database_names = self.database_names
+
+        restored = []
+        for database_name in database_names:
+            db_path = os.path.join(custom_profile_path, database_name)
+            try:
+                if os.path.exists(db_path) is False or self.is_database_intact(db_path):
+                    continue
+            except sqlite3.OperationalError:
+                continue
+
+            for snapshot in reversed(snapshots):
+                backup_path = os.path.join(snapshot, database_name)
+                if os.path.exists(backup_path) and self.is_database_intact(backup_path):
+                    corrupt_path = f'{db_path}.corrupt-{time.strftime("%Y%m%d-%H%M%S")}'
+                    os.replace(db_path, corrupt_path)
+                    for suffix in ['-wal', '-shm']:
+                        if os.path.exists(f'{db_path}{suffix}'):
+                            os.replace(f'{db_path}{suffix}', f'{corrupt_path}{suffix}')
+                    shutil.copyfile(backup_path, f'{db_path}.restore')
+                    os.replace(f'{db_path}.restore', db_path)
+                    restored.append(database_name)
+                    break
+
+        return restored
+
+    def restore_corrupt_archives(self):
+        # An archive is only attached for single queries, a restored one is migrated again on its next use.
+        custom_profile_path = self.read_profile_path()
+        restored = self.restore_corrupt_databases(self.read_archive_names(custom_profile_path))
+        for database_name in restored:
+            archive_path = os.path.normpath(os.path.join(custom_profile_path, database_name))
+            connection_manager.discard_connection(archive_path)
+            with database_registry.lock:
+                database_registry.initialized_paths.discard(archive_path)
+        return restored
+
+    def is_due(self, backup_folder):
+        if self.last_backup_time is None:
+            snapshots = self.read_snapshots(backup_folder)
+            if snapshots:
+                self.last_backup_time = os.path.getmtime(snapshots[-1])
+
+        return self.last_backup_time is None or time.time() - self.last_backup_time >= self.interval
+
+    def run(self):
+        try:
+            self.restore_corrupt_archives()
+        except (OSError, sqlite3.Error):
+            pass
+
+        if self.stop_event.wait(self.first_run_delay):
+            return
+
+        while True:
+            try:
+                if self.is_due(self.read_backup_folder()):
+                    self.create_snapshot()
+            except (OSError, sqlite3.Error):
+                self.last_backup_time = time.time()
+
+            if self.stop_event.wait(min(self.interval, 3600)):
+                return
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+profile_backup = ProfileBackup()
@@ -0,0 +1,361 @@
+import math
+import time
+import heapq
+import queue
+import bisect
+from collections import deque
+
+from PySide6.QtCore import Qt, Signal, QAbstractListModel, QModelIndex, QTimer, QThread
+from PySide6.QtWidgets import QCompleter
+
+from kbdatabase import Database, connection_manager, current_time_us, TRANSITION_TYPED
+from kbtrigram import TrigramIndex
+
+
+class FrecencyIndex:
+    # Visited urls ranked by frecency, the number of visits weighted by how recent the last one was:
+    #     (visit_count + typed_weight * typed_count) * 2 ** (-(now - last_visit_time) / half_life)
+    # Its logarithm log2(weight) + last_visit_time / half_life - now / half_life only depends on now through a term
+    # shared by every url, so urls are kept sorted by the rest of it and the order never has to be recomputed as time
+    # passes. A visit moves a single url with two binary searches.
+    #
+    # Texts with a rare trigram are looked up in a trigram index instead of walking the ranking. The index is built in
+    # steps after load, until then every query walks the ranking.
+    def __init__(self, half_life_days=30, typed_weight=1.0):
+        super(FrecencyIndex, self).__init__()
+
+        self.half_life = half_life_days * 86400 * 1000000
+        self.typed_weight = typed_weight
+
+        # url: [title, visit_count, typed_count, last_visit_time, key, lower case url and title]
+        self.entries = dict()
+        # (-key, url), the highest frecency first
+        self.ranked = list()
+
+        self.trigram_index = TrigramIndex()
+        # Urls which are not in the trigram index yet, indexed from trigram_position on.
+        self.trigram_pending = list()
+        self.trigram_position = 0
+
+        # [url, typed] of the last recorded visit, further titles of the same page are not counted as visits.
+        self.last_visit = None
+
+    def frecency_key(self, visit_count, typed_count, last_visit_time):
+        weight = max(visit_count + self.typed_weight * typed_count, 1)
+        return math.log2(weight) + last_visit_time / self.half_life
+
+    def frecency(self, url, now=None):
+        if now is None:
+            now = current_time_us()
+        return 2 ** (self.entries[url][4] - now / self.half_life)
+
+    def load(self, rows):
+        # Rows are (url, title, visit_count, typed_count, last_visit_time), sorted once.
+        self.entries = dict()
+        for url, title, visit_count, typed_count, last_visit_time in rows:
+            key = self.frecency_key(visit_count, typed_count, last_visit_time)
+            self.entries[url] = [title or '', visit_count, typed_count, last_visit_time, key,
+                                 f'{url}\n{title or ""}'.lower()]
+        self.ranked = sorted((-entry[4], url) for url, entry in self.entries.items())
+
+        self.trigram_index.clear()
+        self.trigram_pending = [url for _, url in self.ranked]
+        self.trigram_position = 0
+
+    def is_trigram_index_ready(self):
+        return self.trigram_position >= len(self.trigram_pending)
+
+    def build_trigram_index(self, budget=1000):
+        # Index up to budget pending urls. Returns True while urls are left.
+        end = min(self.trigram_position + budget, len(self.trigram_pending))
+        for url in self.trigram_pending[self.trigram_position:end]:
+            entry = self.entries.get(url)
+            if entry is not None and url not in self.trigram_index.url_ids:
+                self.trigram_index.add(url, entry[5])
+        self.trigram_position = end
+
+        if self.is_trigram_index_ready():
+            self.trigram_pending = list()
+            self.trigram_position = 0
+            return False
+        return True
+
+    def record_visit(self, url, title, transition, visit_time=None):
+        if visit_time is None:
+            visit_time = current_time_us()
+
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = [title or '', 0, 0, visit_time, 0.0, '']
+            self.entries[url] = entry
+        else:
+            del self.ranked[bisect.bisect_left(self.ranked, (-entry[4], url))]
+        old_text = entry[5]
+
+        # Like in the history writer, a page changing its title is one visit, which is typed if any record was.
+        is_typed = transition == TRANSITION_TYPED
+        if self.last_visit is not None and self.last_visit[0] == url:
+            entry[2] += int(is_typed and not self.last_visit[1])
+            self.last_visit[1] = self.last_visit[1] or is_typed
+        else:
+            entry[1] += 1
+            entry[2] += int(is_typed)
+            self.last_visit = [url, is_typed]
+        if visit_time >= entry[3]:
+            entry[0] = title or entry[0]
+            entry[3] = visit_time
+        entry[5] = f'{url}\n{entry[0]}'.lower()
+        entry[4] = self.frecency_key(entry[1], entry[2], entry[3])
+        bisect.insort(self.ranked, (-entry[4], url))
+
+        if url in self.trigram_index.url_ids:
+            self.trigram_index.add(url, entry[5], old_text)
+        elif self.is_trigram_index_ready():
+            self.trigram_index.add(url, entry[5])
+        else:
+            self.trigram_pending.append(url)
+
+    def remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            del self.ranked[bisect.bisect_left(self.ranked, (-entry[4], url))]
+            self.trigram_index.remove(url)
+
+    def clear(self):
+        self.entries = dict()
+        self.ranked = list()
+        self.last_visit = None
+        self.trigram_index.clear()
+        self.trigram_pending = list()
+        self.trigram_position = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def query(self, text, limit=12, cancelled=None):
+        # The best ranked urls whose url or title contains every word of the text, case-insensitively. Candidates of
+        # the trigram index are checked and ranked, otherwise the walk over the ranking stops as soon as limit urls are
+        # found. A long walk asks cancelled() now and then and gives up with None once it returns True.
+        words = text.lower().split()
+        results = list()
+        if not words:
+            return results
+
+        entries = self.entries
+        if self.is_trigram_index_ready():
+            candidates = self.trigram_index.candidates(words)
+            if candidates is not None:
+                matches = [(entries[url][4], url) for url in candidates
+                           if url in entries and all(word in entries[url][5] for word in words)]
+                for _, url in heapq.nlargest(limit, matches):
+                    results.append((url, entries[url][0]))
+                return results
+
+        for n, (_, url) in enumerate(self.ranked):
+            entry = entries[url]
+            haystack = entry[5]
+            if all(word in haystack for word in words):
+                results.append((url, entry[0]))
+                if len(results) >= limit:
+                    break
+            if cancelled is not None and n % 4096 == 4095 and cancelled():
+                return None
+        return results
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class CompletionWorker(QThread):
+    # Owns the frecency index and answers the queries of the address bar off the GUI thread. Requests are queued as
+    # (action, arguments) and handled in order, so visits and clears are never applied while a query runs. Between
+    # requests the trigram index is built in steps.
+    #
+    # Every query carries the generation of the text it was made for. Queries older than latest_generation, which the
+    # GUI thread raises on every keystroke, are skipped or given up, only the newest one is answered.
+    results_signal = Signal(int, object, object)
+
+    def __init__(self, max_suggestions=12):
+        super(CompletionWorker, self).__init__()
+
+        self.max_suggestions = max_suggestions
+        self.frecency_index = FrecencyIndex()
+        self.requests = queue.Queue()
+        self.latest_generation = 0
+
+        # Milliseconds spent on the recent queries, and the queries which were skipped or given up.
+        self.query_times = deque(maxlen=1000)
+        self.cancelled_queries = 0
+
+    def send_request(self, action, *arguments):
+        self.requests.put((action, arguments))
+
+    def is_stale(self, generation):
+        return generation < self.latest_generation
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    action, arguments = self.requests.get(block=self.frecency_index.is_trigram_index_ready())
+                except queue.Empty:
+                    self.frecency_index.build_trigram_index(100)
+                    continue
+
+                if action == 'stop':
+                    break
+                elif action == 'load':
+                    self.frecency_index.load(Database().read_history_url_stats())
+                elif action == 'visit':
+                    self.frecency_index.record_visit(*arguments)
+                elif action == 'clear':
+                    self.frecency_index.clear()
+                elif action == 'query':
+                    self.query(*arguments)
+        finally:
+            connection_manager.close_thread_connections()
+
+    def query(self, generation, text):
+        if self.is_stale(generation):
+            self.cancelled_queries += 1
+            return
+
+        start = time.perf_counter()
+        suggestions = self.frecency_index.query(text, self.max_suggestions, lambda: self.is_stale(generation))
+        if suggestions is None:
+            self.cancelled_queries += 1
+            return
+        self.query_times.append((time.perf_counter() - start) * 1000)
+
+        suggestions = suggestions[:self.max_suggestions]
+        now = current_time_us()
+        frecencies = [self.frecency_index.frecency(url, now) for url, _ in suggestions]
+        self.results_signal.emit(generation, suggestions, frecencies)
+
+
+class CompletionModel(QAbstractListModel):
+    # The few suggestions shown for the current text, the url for display and editing and the title as tooltip.
+    def __init__(self):
+        super(CompletionModel, self).__init__()
+
+        self.suggestions = list()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.suggestions)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.suggestions):
+            return None
+
+        url, title = self.suggestions[index.row()]
+        if role in [Qt.DisplayRole, Qt.EditRole]:
+            return url
+        if role == Qt.ToolTipRole:
+            return title
+        return None
+
+    def set_suggestions(self, suggestions):
+        self.beginResetModel()
+        self.suggestions = list(suggestions)
+        self.endResetModel()
+
+
+class AddressBarCompleter(QCompleter):
+    # Completion of the address bar by frecency. The model only ever holds max_suggestions rows, which are ranked and
+    # filtered by the worker, so the completer shows them unfiltered.
+    #
+    # Keystrokes are debounced by a timer of debounce_interval milliseconds. Zero still collects the keystrokes which
+    # are already waiting in the event queue into one query. The time from the last keystroke to the popup showing its
+    # suggestions is kept for the recent queries.
+    #
+    # suggestions_signal carries the text, the shown suggestions and their frecencies.
+    suggestions_signal = Signal(str, object, object)
+
+    def __init__(self, max_suggestions=12, debounce_interval=0):
+        super(AddressBarCompleter, self).__init__()
+
+        self.max_suggestions = max_suggestions
+        self.completion_model = CompletionModel()
+
+        self.setModel(self.completion_model)
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setMaxVisibleItems(max_suggestions)
+
+        self.completion_worker = CompletionWorker(max_suggestions)
+        self.completion_worker.results_signal.connect(self.show_suggestions)
+        self.completion_worker.start()
+
+        self.debounce_timer = QTimer()
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_interval)
+        self.debounce_timer.timeout.connect(self.send_query)
+
+        self.generation = 0
+        self.pending_text = ''
+        self.query_text = ''
+        self.keystroke_time = 0.0
+        self.latencies = deque(maxlen=1000)
+
+    def load_history(self):
+        self.completion_worker.send_request('load')
+
+    def record_visit(self, url, title, transition):
+        self.completion_worker.send_request('visit', url, title, transition)
+
+    def clear(self):
+        self.completion_worker.send_request('clear')
+        self.completion_model.set_suggestions([])
+
+    def update_suggestions(self, text):
+        # A new text makes every query in flight stale at once.
+        self.generation += 1
+        self.completion_worker.latest_generation = self.generation
+        self.keystroke_time = time.perf_counter()
+
+        if not text.split():
+            self.debounce_timer.stop()
+            self.completion_model.set_suggestions([])
+            self.popup().hide()
+            self.suggestions_signal.emit(text, [], [])
+            return
+
+        self.pending_text = text
+        self.debounce_timer.start()
+
+    def send_query(self):
+        self.query_text = self.pending_text
+        self.completion_worker.send_request('query', self.generation, self.pending_text)
+
+    def show_suggestions(self, generation, suggestions, frecencies):
+        if generation != self.generation:
+            return
+
+        self.completion_model.set_suggestions(suggestions)
+        if suggestions:
+            self.complete()
+        else:
+            self.popup().hide()
+        self.latencies.append((time.perf_counter() - self.keystroke_time) * 1000)
+        self.suggestions_signal.emit(self.query_text, suggestions, frecencies)
+
+    def read_latency_statistics(self):
+        # Milliseconds from the keystroke to the popup, and the time of the queries in the worker alone.
+        latencies = list(self.latencies)
+        query_times = list(self.completion_worker.query_times)
+        return {'samples': len(latencies), 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+                'max': max(latencies, default=0.0), 'query_p50': percentile(query_times, 0.5),
+                'query_p99': percentile(query_times, 0.99), 'cancelled': self.completion_worker.cancelled_queries}
+
+    def stop(self):
+        if self.completion_worker.isRunning():
+            self.completion_worker.send_request('stop')
+            self.completion_worker.wait()
@@ -1,9 +1,185 @@
 import os
+import re
+import ast
+import csv
+import glob
+import gzip
+import json
 import time
+import uuid
 import random
 import string
 import sqlite3
+import tempfile
 import locale
+import calendar
+import threading
+import urllib.parse
+
+
+# How a visit started, stored in visits.transition like Chromium's core page transition types.
+TRANSITION_LINK = 0
+TRANSITION_TYPED = 1
+
+# Remembered answers to permission requests in permission_decisions.decision.
+PERMISSION_REJECT = 0
+PERMISSION_ACCEPT = 1
+
+# Functions called with (kind, data) after a change of history, settings or permission decisions through Database,
+# e.g. to log the change for profile sync.
+mutation_listeners = list()
+
+
+def add_mutation_listener(listener):
+    mutation_listeners.append(listener)
+
+
+def remove_mutation_listener(listener):
+    if listener in mutation_listeners:
+        mutation_listeners.remove(listener)
+
+
+def current_time_us():
+    return time.time_ns() // 1000
+
+
+def asctime_to_us(asctime):
+    # Visits recorded before the history schema version 2 have time.asctime() strings.
+    try:
+        return int(time.mktime(time.strptime(asctime)) * 1000000)
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def us_to_asctime(visit_time):
+    try:
+        return time.asctime(time.localtime(visit_time / 1000000))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return ''
+
+
+def us_to_month(visit_time):
+    # History archives hold the visits of one calendar month in UTC, e.g. '2024-05'.
+    try:
+        return time.strftime('%Y-%m', time.gmtime(visit_time / 1000000))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return '1970-01'
+
+
+def month_start_us(visit_time, months_before=0):
+    # Start of the month of visit_time, or of a month before it, in microseconds since the epoch.
+    year, month = time.gmtime(visit_time / 1000000)[:2]
+    month -= months_before
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return calendar.timegm((year, month, 1, 0, 0, 0)) * 1000000
+
+
+def url_to_origin(url):
+    # Permission decisions are remembered per origin, e.g. https://example.com:8443 for any page of that site.
+    try:
+        split_url = urllib.parse.urlsplit(url)
+        hostname = split_url.hostname
+        port = split_url.port
+    except ValueError:
+        return url
+
+    if not split_url.scheme or not hostname:
+        return url
+
+    origin = f'{split_url.scheme.lower()}://{hostname}'
+    if port is not None:
+        origin = f'{origin}:{port}'
+    return origin
+
+
+class ConfigurationFile:
+    # The kbconfiguration file holds one "item=value" per line. It is parsed once per process and parsed again only
+    # when its modification time changes. Updates replace the file atomically through a temporary file.
+    shared_files = dict()
+    shared_files_lock = threading.Lock()
+
+    def __init__(self, configuration_file):
+        super(ConfigurationFile, self).__init__()
+
+        self.configuration_file = configuration_file
+        self.lock = threading.RLock()
+        self.lines = list()
+        self.values = dict()
+        self.mtime = None
+
+    @classmethod
+    def shared(cls, configuration_file):
+        with cls.shared_files_lock:
+            if configuration_file not in cls.shared_files:
+                cls.shared_files[configuration_file] = cls(configuration_file)
+            return cls.shared_files[configuration_file]
+
+    def reload_if_changed(self):
+        with self.lock:
+            try:
+                mtime = os.stat(self.configuration_file).st_mtime_ns
+            except FileNotFoundError:
+                self.write(['Configuration for kBrowser\n'])
+                mtime = os.stat(self.configuration_file).st_mtime_ns
+
+            if mtime != self.mtime:
+                with open(self.configuration_file, 'r') as temp:
+                    self.lines = temp.readlines()
+                self.values = dict()
+                for line in self.lines:
+                    item, separator, value = line.rstrip('\n').partition('=')
+                    if separator:
+                        self.values[item.strip()] = value
+                self.mtime = mtime
+
+    def read(self, item):
+        with self.lock:
+            self.reload_if_changed()
+            return self.values.get(item, str())
+
+    def update(self, items):
+        with self.lock:
+            self.reload_if_changed()
+            items = {item: str(value) for item, value in items.items()}
+            if all(self.values.get(item) == value for item, value in items.items()):
+                return
+
+            lines = list()
+            written = set()
+            for line in self.lines:
+                item, separator, _ = line.rstrip('\n').partition('=')
+                item = item.strip()
+                if separator and item in items:
+                    # Repeated lines of an item are merged into one.
+                    if item not in written:
+                        lines.append(f'{item}={items[item]}\n')
+                        written.add(item)
+                else:
+                    lines.append(line if line.endswith('\n') else f'{line}\n')
+            for item, value in items.items():
+                if item not in written:
+                    lines.append(f'{item}={value}\n')
+
+            self.write(lines)
+            self.lines = lines
+            self.values.update(items)
+            self.mtime = os.stat(self.configuration_file).st_mtime_ns
+
+    def write(self, lines):
+        folder = os.path.dirname(self.configuration_file)
+        temp_file, temp_path = tempfile.mkstemp(prefix='kbconfiguration', dir=folder)
+        try:
+            with os.fdopen(temp_file, 'w') as temp:
+                temp.writelines(lines)
+                temp.flush()
+                os.fsync(temp.fileno())
+            if os.path.exists(self.configuration_file):
+                os.chmod(temp_path, os.stat(self.configuration_file).st_mode & 0o777)
+            os.replace(temp_path, self.configuration_file)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
 
 class EnvironConfig:
@@ -38,42 +214,49 @@ class EnvironConfig:
     def read_configuration_file(self):
         configuration_file = os.path.join(self.profile_path, 'kbconfiguration')
         configuration_file = os.path.normpath(configuration_file)
-        if os.path.exists(configuration_file) is False:
-            with open(configuration_file, 'w') as temp:
-                temp.write('Configuration for kBrowser\n')
-
-        with open(configuration_file, 'r') as temp:
-            configuration = temp.readlines()
-
+        configuration = ConfigurationFile.shared(configuration_file)
         return configuration_file, configuration
 
     def read_configuration_file_setting(self, item):
-        value = str()
         _, configuration = self.read_configuration_file()
-        for line in configuration:
-            if item in line:
-                line = line.strip('\n')
-                line = line.split('=')
-                value = line[1]
+        value = configuration.read(item)
         return value
 
     def update_configuration_file_setting(self, item, value):
-        configuration_file, configuration = self.read_configuration_file()
+        self.update_configuration_file_settings({item: value})
 
-        setting = None
-        for line in configuration:
-            if item in line:
-                setting = line
+    def update_configuration_file_settings(self, items):
+        # Several settings are written with a single rewrite of the file.
+        _, configuration = self.read_configuration_file()
+        configuration.update(items)
 
-        if setting:
-            n = configuration.index(setting)
-            configuration[n] = f'{item}={value}\n'
-        else:
-            configuration.append(f'{item}={value}\n')
+    def read_sync_folder(self):
+        # Folder shared by the devices of a user, e.g. "SyncFolder=/mnt/share/kbrowser" in kbconfiguration. Profile sync
+        # is disabled without it.
+        sync_folder = self.read_configuration_file_setting('SyncFolder')
+        if sync_folder:
+            sync_folder = os.path.normpath(os.path.expanduser(sync_folder))
+        return sync_folder
+
+    def read_database_settings(self):
+        # Optional tuning of SQLite connections, e.g. "DatabaseSynchronous=FULL" in kbconfiguration.
+        synchronous = self.read_configuration_file_setting('DatabaseSynchronous').upper()
+        if synchronous not in ['OFF', 'NORMAL', 'FULL', 'EXTRA']:
+            synchronous = None
+
+        mmap_size = self.read_configuration_file_setting('DatabaseMmapSize')
+        try:
+            mmap_size = int(mmap_size)
+        except ValueError:
+            mmap_size = None
 
-        with open(configuration_file, 'w') as temp:
-            for line in configuration:
-                temp.write(line)
+        cache_size = self.read_configuration_file_setting('DatabaseCacheSize')
+        try:
+            cache_size = int(cache_size)
+        except ValueError:
+            cache_size = None
+
+        return synchronous, mmap_size, cache_size
 
     @staticmethod
     def create_random_name(prefix_name):
@@ -159,14 +342,178 @@ class EnvironConfig:
         return default_locale, default_http_language
 
 
+class ConnectionManager:
+    # Keep one long-lived connection per database file per thread, so that a query does not pay for opening the file,
+    # parsing the schema and committing with a full fsync every time.
+    def __init__(self, synchronous='NORMAL', mmap_size=64 * 1024 * 1024, cache_size=-8000, cached_statements=256):
+        super(ConnectionManager, self).__init__()
+
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.cached_statements = cached_statements
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def configure(self, synchronous=None, mmap_size=None, cache_size=None):
+        # New values are applied to connections opened afterwards.
+        if synchronous is not None:
+            self.synchronous = synchronous
+        if mmap_size is not None:
+            self.mmap_size = mmap_size
+        if cache_size is not None:
+            self.cache_size = cache_size
+
+    def open_connection(self, db_path):
+        # Python's sqlite3 module caches prepared statements per connection, keyed by the SQL text.
+        connection = sqlite3.connect(db_path, cached_statements=self.cached_statements, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute(f'PRAGMA synchronous = {self.synchronous}')
+        connection.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        connection.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        connection.execute('PRAGMA busy_timeout = 5000')
+        return connection
+
+    def get_connection(self, db_path):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = dict()
+            self.local.connections = connections
+
+        connection = connections.get(db_path)
+        if connection is None:
+            connection = self.open_connection(db_path)
+            connections[db_path] = connection
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    def discard_connection(self, db_path):
+        # The next get_connection of this thread opens a new connection, e.g. to drop per-connection state left by a
+        # large delete.
+        connections = getattr(self.local, 'connections', dict())
+        connection = connections.pop(db_path, None)
+        if connection is not None:
+            connection.commit()
+            connection.close()
+            with self.lock:
+                if connection in self.connections:
+                    self.connections.remove(connection)
+
+    def close_thread_connections(self):
+        # Called by worker threads before they exit.
+        connections = getattr(self.local, 'connections', dict())
+        for connection in connections.values():
+            connection.commit()
+            connection.close()
+            with self.lock:
+                if connection in self.connections:
+                    self.connections.remove(connection)
+        connections.clear()
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections)
+            self.connections = []
+
+        for connection in connections:
+            try:
+                connection.commit()
+                connection.close()
+            except sqlite3.ProgrammingError:
+                pass
+
+        self.local = threading.local()
+
+
+connection_manager = ConnectionManager()
+
+
+class DatabaseRegistry:
+    # Process-wide registry. Profile paths are resolved once and every database file is migrated to the latest schema
+    # version once, so that creating a Database (and every settings handler built on it) is cheap.
+    def __init__(self):
+        super(DatabaseRegistry, self).__init__()
+
+        self.lock = threading.RLock()
+        self.environ_config = None
+        self.profile_settings = None
+        self.initialized_paths = set()
+
+    def read_profile_settings(self):
+        with self.lock:
+            if self.profile_settings is None:
+                self.environ_config = EnvironConfig()
+                custom_profile_path = self.environ_config.read_custom_profile_path()
+                default_downloads_path = self.environ_config.read_default_downloads_path()
+                default_locale, default_http_language = self.environ_config.read_default_language_settings()
+                self.profile_settings = (custom_profile_path, default_downloads_path,
+                                         default_locale, default_http_language)
+
+            return self.environ_config, self.profile_settings
+
+    def initialize(self, db_path, migrations):
+        # Each migration brings a database file from version n - 1 to n. The current version is kept in
+        # PRAGMA user_version, so only the missing migrations run, and only for the first Database of the process.
+        with self.lock:
+            if db_path in self.initialized_paths:
+                return
+
+            connection = connection_manager.get_connection(db_path)
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < len(migrations):
+                self.run_migrations(connection, version, migrations)
+
+            self.initialized_paths.add(db_path)
+
+    @staticmethod
+    def run_migrations(connection, version, migrations):
+        # Every migration and its version bump are one transaction, so that a migration which fails or is interrupted
+        # leaves the file at the previous version. In its default mode Python's sqlite3 would commit every CREATE and
+        # ALTER on its own.
+        connection.commit()
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            for n in range(version, len(migrations)):
+                cursor = connection.cursor()
+                try:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    migrations[n](cursor)
+                    cursor.execute(f'PRAGMA user_version = {n + 1}')
+                    cursor.execute('COMMIT')
+                finally:
+                    if connection.in_transaction:
+                        cursor.execute('ROLLBACK')
+                    cursor.close()
+        finally:
+            connection.isolation_level = isolation_level
+
+    def reset(self):
+        with self.lock:
+            self.environ_config = None
+            self.profile_settings = None
+            self.initialized_paths = set()
+
+
+database_registry = DatabaseRegistry()
+
+
 class Database:
     def __init__(self):
         super(Database, self).__init__()
 
-        self.environ_config = EnvironConfig()
-        self.custom_profile_path = self.environ_config.read_custom_profile_path()
-        self.default_downloads_path = self.environ_config.read_default_downloads_path()
-        self.default_locale, self.default_http_language = self.environ_config.read_default_language_settings()
+        self.environ_config, profile_settings = database_registry.read_profile_settings()
+        self.custom_profile_path, self.default_downloads_path, self.default_locale, self.default_http_language = \
+            profile_settings
+
+        self.settings_db_path = os.path.normpath(os.path.join(self.custom_profile_path, 'kbsettings.db'))
+        self.history_db_path = os.path.normpath(os.path.join(self.custom_profile_path, 'kbhistory.db'))
+        # Visits of past months are moved into one archive file per month, kbhistory.db keeps the recent ones.
+        self.history_archive_folder = os.path.normpath(os.path.join(self.custom_profile_path, 'history_archive'))
 
         self.settings_db = None
         self.settings_cursor = None
@@ -177,81 +524,393 @@ class Database:
         self.initialize_history_db()
 
     def open_settings_db(self):
-        settings_db_path = os.path.join(self.custom_profile_path, 'kbsettings.db')
-        settings_db_path = os.path.normpath(settings_db_path)
-        self.settings_db = sqlite3.connect(settings_db_path)
+        self.settings_db = connection_manager.get_connection(self.settings_db_path)
         self.settings_cursor = self.settings_db.cursor()
 
     def close_settings_db(self):
+        # The connection stays open in the connection manager and is reused by the next query.
         self.settings_db.commit()
         self.settings_cursor.close()
-        self.settings_db.close()
 
     def open_history_db(self):
-        history_db_path = os.path.join(self.custom_profile_path, 'kbhistory.db')
-        history_db_path = os.path.normpath(history_db_path)
-        self.history_db = sqlite3.connect(history_db_path)
+        self.history_db = connection_manager.get_connection(self.history_db_path)
         self.history_cursor = self.history_db.cursor()
 
     def close_history_db(self):
         self.history_db.commit()
         self.history_cursor.close()
-        self.history_db.close()
+
+    def settings_migrations(self):
+        return [self.migrate_settings_v1, self.migrate_settings_v2, self.migrate_settings_v3, self.migrate_settings_v4,
+                self.migrate_settings_v5, self.migrate_settings_v6, self.migrate_settings_v7,
+                self.migrate_settings_v8]
+
+    def history_migrations(self):
+        return [self.migrate_history_v1, self.migrate_history_v2, self.migrate_history_v3, self.migrate_history_v4,
+                self.migrate_history_v5]
+
+    def history_archive_migrations(self):
+        return [self.migrate_history_archive_v1, self.migrate_history_v3, self.migrate_history_v5]
 
     def initialize_settings_db(self):
-        self.open_settings_db()
+        database_registry.initialize(self.settings_db_path, self.settings_migrations())
+
+    def initialize_history_db(self):
+        database_registry.initialize(self.history_db_path, self.history_migrations())
 
+    @staticmethod
+    def is_table_empty(cursor, table):
+        cursor.execute(f'SELECT 1 FROM {table} LIMIT 1')
+        return cursor.fetchone() is None
+
+    @staticmethod
+    def insert_basic_settings(cursor, settings):
+        # Items which are already in the basic table keep their value.
+        cursor.executemany('INSERT INTO basic (item, value) SELECT ?1, ?2 WHERE NOT EXISTS '
+                           '(SELECT 1 FROM basic WHERE item = ?1)', settings)
+
+    def migrate_settings_v1(self, cursor):
         # Basic settings
-        self.settings_cursor.execute('''CREATE TABLE IF NOT EXISTS basic
-                                       (id INTEGER PRIMARY KEY AUTOINCREMENT, item, value)''')
-        check_table = self.check_settings_table('basic')
-        if len(check_table) == 0:
-            self.settings_cursor.executemany('INSERT INTO basic (item, value) VALUES (?, ?)',
-                                             [('download_folder', self.default_downloads_path),
-                                              ('private_browsing', '0'),
-                                              ('https_mode', '1'),
-                                              ('ui_translation', self.default_locale),
-                                              ('preferred_language', self.default_http_language)])
+        cursor.execute('''CREATE TABLE IF NOT EXISTS basic
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, item, value)''')
+        if self.is_table_empty(cursor, 'basic'):
+            cursor.executemany('INSERT INTO basic (item, value) VALUES (?, ?)',
+                               [('download_folder', self.default_downloads_path),
+                                ('private_browsing', '0'),
+                                ('https_mode', '1'),
+                                ('ui_translation', self.default_locale),
+                                ('preferred_language', self.default_http_language)])
 
         # Permissions and certificates
-        self.settings_cursor.execute('''CREATE TABLE IF NOT EXISTS permissions
-                                        (id INTEGER PRIMARY KEY AUTOINCREMENT, permission, status, accept, reject)''')
-        check_table = self.check_settings_table('permissions')
-        if len(check_table) == 0:
-            self.settings_cursor.executemany('''INSERT INTO permissions (permission, status, accept, reject)
-                                                VALUES (?, ?, ?, ?)''',
-                                             [('Certificates', '1', '', ''),
-                                              ('Notifications', '1', '', ''),
-                                              ('Geolocation', '1', '', ''),
-                                              ('MediaAudioCapture', '1', '', ''),
-                                              ('MediaVideoCapture', '1', '', ''),
-                                              ('MediaAudioVideoCapture', '1', '', ''),
-                                              ('MouseLock', '1', '', ''),
-                                              ('DesktopVideoCapture', '1', '', ''),
-                                              ('DesktopAudioVideoCapture', '1', '', '')]
-                                             )
+        cursor.execute('''CREATE TABLE IF NOT EXISTS permissions
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, permission, status, accept, reject)''')
+        if self.is_table_empty(cursor, 'permissions'):
+            cursor.executemany('INSERT INTO permissions (permission, status, accept, reject) VALUES (?, ?, ?, ?)',
+                               [('Certificates', '1', '', ''),
+                                ('Notifications', '1', '', ''),
+                                ('Geolocation', '1', '', ''),
+                                ('MediaAudioCapture', '1', '', ''),
+                                ('MediaVideoCapture', '1', '', ''),
+                                ('MediaAudioVideoCapture', '1', '', ''),
+                                ('MouseLock', '1', '', ''),
+                                ('DesktopVideoCapture', '1', '', ''),
+                                ('DesktopAudioVideoCapture', '1', '', '')])
 
         # Search engines
-        self.settings_cursor.execute('''CREATE TABLE IF NOT EXISTS search_engines
-                                       (id INTEGER PRIMARY KEY AUTOINCREMENT, provider, url, enable)''')
-        check_table = self.check_settings_table('search_engines')
-        if len(check_table) == 0:
-            self.settings_cursor.executemany('INSERT INTO search_engines (provider, url, enable) VALUES (?, ?, ?)',
-                                             [('Bing', r'https://www.bing.com/search?q=', '1'),
-                                              ('Google', r'https://www.google.com/search?q=', '0'),
-                                              ('Baidu', r'https://www.baidu.com/s?wd=', '0')])
+        cursor.execute('''CREATE TABLE IF NOT EXISTS search_engines
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, provider, url, enable)''')
+        if self.is_table_empty(cursor, 'search_engines'):
+            cursor.executemany('INSERT INTO search_engines (provider, url, enable) VALUES (?, ?, ?)',
+                               [('Bing', r'https://www.bing.com/search?q=', '1'),
+                                ('Google', r'https://www.google.com/search?q=', '0'),
+                                ('Baidu', r'https://www.baidu.com/s?wd=', '0')])
 
-        self.close_settings_db()
+    def migrate_settings_v2(self, cursor):
+        # History retention policies, 0 means no limit.
+        self.insert_basic_settings(cursor,
+                                   [('history_max_age_days', '0'),
+                                    ('history_max_rows', '0'),
+                                    ('history_dedupe_after_days', '0')])
 
-    def initialize_history_db(self):
+    @staticmethod
+    def migrate_settings_v3(cursor):
+        # Accepted and rejected sites move from Python literal lists in the permissions table into one row per
+        # permission and origin.
+        cursor.execute('''CREATE TABLE IF NOT EXISTS permission_decisions
+                          (id INTEGER PRIMARY KEY, permission TEXT NOT NULL, origin TEXT NOT NULL,
+                          decision INTEGER NOT NULL, updated_at INTEGER NOT NULL)''')
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS permission_decisions_permission_origin
+                          ON permission_decisions (permission, origin)''')
+
+        cursor.execute('SELECT permission, accept, reject FROM permissions')
+        decisions = list()
+        for permission, accept, reject in cursor.fetchall():
+            for urls, decision in [(accept, PERMISSION_ACCEPT), (reject, PERMISSION_REJECT)]:
+                try:
+                    urls = ast.literal_eval(urls) if urls else list()
+                except (ValueError, SyntaxError):
+                    urls = list()
+                if not isinstance(urls, list):
+                    urls = list()
+                for url in urls:
+                    decisions.append((permission, url_to_origin(str(url)), decision, current_time_us()))
+
+        cursor.executemany('''INSERT OR REPLACE INTO permission_decisions (permission, origin, decision, updated_at)
+                              VALUES (?, ?, ?, ?)''', decisions)
+        cursor.execute("""UPDATE permissions SET accept = '', reject = ''""")
+
+    @staticmethod
+    def migrate_settings_v4(cursor):
+        # Open tabs of the last session, history is a serialized QWebEngineHistory.
+        cursor.execute('''CREATE TABLE IF NOT EXISTS session_tabs
+                          (position INTEGER PRIMARY KEY, url TEXT NOT NULL, title TEXT NOT NULL, history BLOB,
+                          current INTEGER NOT NULL DEFAULT 0)''')
+
+    def migrate_settings_v5(self, cursor):
+        # Profile sync: the id of this device, how far the change log of every device has been read, and the time and
+        # device of the latest change of every synced setting for last-writer-wins.
+        self.insert_basic_settings(cursor, [('sync_device', uuid.uuid4().hex)])
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sync_state
+                          (device TEXT PRIMARY KEY, offset INTEGER NOT NULL, sequence INTEGER NOT NULL)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sync_versions
+                          (key TEXT PRIMARY KEY, time INTEGER NOT NULL, device TEXT NOT NULL)''')
+
+    def migrate_settings_v6(self, cursor):
+        # Speculative preload of the best address bar suggestion, disabled by default.
+        self.insert_basic_settings(cursor, [('preload_suggestions', '0')])
+
+    @staticmethod
+    def migrate_settings_v7(cursor):
+        # Hosts which are upgraded from http to https before a request goes out. learned is 0 for hosts of the bundled
+        # list, which only have a row once they were hit.
+        cursor.execute('''CREATE TABLE IF NOT EXISTS https_hosts
+                          (host TEXT PRIMARY KEY, learned INTEGER NOT NULL, hits INTEGER NOT NULL DEFAULT 0,
+                          updated_at INTEGER NOT NULL)''')
+
+    def migrate_settings_v8(self, cursor):
+        # Tab lifecycle: minutes a background tab runs before it is frozen, the memory budget of the render processes
+        # of all tabs and the available system memory under which background tabs are discarded, 0 means no limit.
+        self.insert_basic_settings(cursor,
+                                   [('tab_freeze_after_minutes', '5'),
+                                    ('tab_memory_budget_mb', '2048'),
+                                    ('tab_min_available_mb', '512')])
+
+    @staticmethod
+    def migrate_history_v1(cursor):
+        cursor.execute('''CREATE TABLE IF NOT EXISTS visits
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, url, page_title, time)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS downloads
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, url, file_name, status, reference_url, time)''')
+
+    @staticmethod
+    def migrate_history_v2(cursor):
+        # Visits are split into one row per distinct url and one row per visit referencing it, with times in
+        # microseconds since the epoch, so that completion and time based queries can use indexes.
+        cursor.connection.create_function('kb_asctime_to_us', 1, asctime_to_us, deterministic=True)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'visits_v1'")
+        if cursor.fetchone() is None:
+            cursor.execute('ALTER TABLE visits RENAME TO visits_v1')
+        else:
+            # Older versions committed the rename and the new tables before the copy. An interrupted upgrade of theirs
+            # left every visit in visits_v1, the new tables only hold rows copied from it and are built again.
+            cursor.execute('DROP TABLE IF EXISTS visits')
+            cursor.execute('DROP TABLE IF EXISTS urls')
+
+        cursor.execute('''CREATE TABLE urls
+                          (id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, title TEXT,
+                          visit_count INTEGER NOT NULL DEFAULT 0, typed_count INTEGER NOT NULL DEFAULT 0,
+                          last_visit_time INTEGER NOT NULL DEFAULT 0)''')
+        cursor.execute('CREATE INDEX urls_last_visit_time ON urls (last_visit_time)')
+        cursor.execute('''CREATE TABLE visits
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, url_id INTEGER NOT NULL REFERENCES urls (id),
+                          visit_time INTEGER NOT NULL, transition INTEGER NOT NULL DEFAULT 0)''')
+        cursor.execute('CREATE INDEX visits_url_id ON visits (url_id)')
+        cursor.execute('CREATE INDEX visits_visit_time ON visits (visit_time)')
+
+        cursor.execute('''INSERT INTO urls (url, title, visit_count, last_visit_time)
+                          SELECT visits_v1.url, visits_v1.page_title, latest.visit_count, latest.last_visit_time
+                          FROM visits_v1 JOIN
+                          (SELECT MAX(id) AS id, COUNT(*) AS visit_count, MAX(kb_asctime_to_us(time)) AS last_visit_time
+                          FROM visits_v1 WHERE url IS NOT NULL GROUP BY url) AS latest
+                          ON visits_v1.id = latest.id''')
+        cursor.execute('''INSERT INTO visits (id, url_id, visit_time, transition)
+                          SELECT visits_v1.id, urls.id, kb_asctime_to_us(visits_v1.time), ?
+                          FROM visits_v1 JOIN urls ON urls.url = visits_v1.url ORDER BY visits_v1.id''',
+                       (TRANSITION_LINK,))
+        cursor.execute('DROP TABLE visits_v1')
+
+    @staticmethod
+    def migrate_history_v3(cursor):
+        # Full-text index over titles and urls of visited pages, kept in sync with the urls table by triggers.
+        # Builds of SQLite without FTS5 skip it and search_history falls back to LIKE.
+        try:
+            cursor.execute('''CREATE VIRTUAL TABLE urls_fts
+                              USING fts5(title, url, content='urls', content_rowid='id')''')
+        except sqlite3.OperationalError:
+            return
+
+        cursor.execute("""INSERT INTO urls_fts (urls_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')""")
+        cursor.execute('''CREATE TRIGGER urls_fts_insert AFTER INSERT ON urls BEGIN
+                          INSERT INTO urls_fts (rowid, title, url) VALUES (new.id, new.title, new.url);
+                          END''')
+        cursor.execute('''CREATE TRIGGER urls_fts_delete AFTER DELETE ON urls BEGIN
+                          INSERT INTO urls_fts (urls_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+                          END''')
+        cursor.execute('''CREATE TRIGGER urls_fts_update AFTER UPDATE OF title, url ON urls
+                          WHEN old.title IS NOT new.title OR old.url IS NOT new.url BEGIN
+                          INSERT INTO urls_fts (urls_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url);
+                          INSERT INTO urls_fts (rowid, title, url) VALUES (new.id, new.title, new.url);
+                          END''')
+        cursor.execute("""INSERT INTO urls_fts (urls_fts) VALUES ('rebuild')""")
+
+    @staticmethod
+    def migrate_history_v4(cursor):
+        # Free pages are given back in small steps by incremental_vacuum. Switching a file which has tables needs one
+        # full VACUUM, which cannot run in a transaction, so the transaction of this migration is committed first and
+        # its version bump runs in a new one. The VACUUM only runs once, on the first start after the upgrade.
+        cursor.execute('COMMIT')
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        cursor.execute('BEGIN IMMEDIATE')
+
+    @staticmethod
+    def migrate_history_v5(cursor):
+        # Visits of a url are looked up by their time, e.g. to skip visits which were imported before. The new index
+        # also serves every lookup by url_id.
+        cursor.execute('CREATE INDEX IF NOT EXISTS visits_url_id_visit_time ON visits (url_id, visit_time)')
+        cursor.execute('DROP INDEX IF EXISTS visits_url_id')
+
+    @staticmethod
+    def migrate_history_archive_v1(cursor):
+        # Archives have the urls and visits tables of kbhistory.db. Visits keep their ids from kbhistory.db, which
+        # are never reused, so that ids are unique over all partitions.
+        cursor.execute('''CREATE TABLE urls
+                          (id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, title TEXT,
+                          visit_count INTEGER NOT NULL DEFAULT 0, typed_count INTEGER NOT NULL DEFAULT 0,
+                          last_visit_time INTEGER NOT NULL DEFAULT 0)''')
+        cursor.execute('CREATE INDEX urls_last_visit_time ON urls (last_visit_time)')
+        cursor.execute('''CREATE TABLE visits
+                          (id INTEGER PRIMARY KEY, url_id INTEGER NOT NULL REFERENCES urls (id),
+                          visit_time INTEGER NOT NULL, transition INTEGER NOT NULL DEFAULT 0)''')
+        cursor.execute('CREATE INDEX visits_url_id ON visits (url_id)')
+        cursor.execute('CREATE INDEX visits_visit_time ON visits (visit_time)')
+
+    def history_archive_path(self, month):
+        return os.path.join(self.history_archive_folder, f'kbhistory-{month}.db')
+
+    def read_history_archives(self):
+        # Paths of the archive files, the newest month first.
+        archives = glob.glob(os.path.join(self.history_archive_folder, 'kbhistory-[0-9][0-9][0-9][0-9]-[0-9][0-9].db'))
+        archives.sort(reverse=True)
+        return archives
+
+    def attach_history_archive(self, archive_path):
+        # An archive is attached as "archive" to the history connection of this thread for one query or move, so
+        # that the number of open files does not grow with the number of months.
+        if os.path.exists(self.history_archive_folder) is False:
+            os.mkdir(self.history_archive_folder)
+        if archive_path not in database_registry.initialized_paths:
+            database_registry.initialize(archive_path, self.history_archive_migrations())
+            connection_manager.discard_connection(archive_path)
+
+        self.open_history_db()
+        self.history_cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+
+    def detach_history_archive(self):
+        self.history_db.commit()
+        self.history_cursor.execute('DETACH DATABASE archive')
+        self.history_cursor.close()
+
+    @staticmethod
+    def history_archive_month_end(archive_path):
+        # Every visit of an archive is older than the end of its month.
+        year, month = [int(n) for n in os.path.basename(archive_path)[len('kbhistory-'):-len('.db')].split('-')]
+        return calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0)) * 1000000
+
+    def read_history_archive_rows(self, archive_path, db_command, parameters):
+        self.attach_history_archive(archive_path)
+        try:
+            self.history_cursor.execute(db_command, parameters)
+            rows = self.history_cursor.fetchall()
+        finally:
+            self.detach_history_archive()
+        return rows
+
+    def archive_history_before(self, visit_time, limit):
+        # Move up to limit of the oldest visits before visit_time into the archives of their months. The visit and
+        # typed counts move with the visits, urls without visits left in kbhistory.db are removed from it. Returns the
+        # number of moved visits.
         self.open_history_db()
-        self.history_cursor.execute('''CREATE TABLE IF NOT EXISTS visits
-                                        (id INTEGER PRIMARY KEY AUTOINCREMENT, url, page_title, time)''')
-        self.history_cursor.execute('''CREATE TABLE IF NOT EXISTS downloads
-                                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                        url, file_name, status, reference_url, time)''')
+        self.history_cursor.execute(
+            '''SELECT visits.id, visits.url_id, visits.visit_time, visits.transition, urls.url, urls.title
+               FROM visits JOIN urls ON urls.id = visits.url_id
+               WHERE visits.visit_time < ? ORDER BY visits.visit_time LIMIT ?''', (visit_time, limit)
+        )
+        moved = self.history_cursor.fetchall()
         self.close_history_db()
 
+        months = dict()
+        for visit in moved:
+            months.setdefault(us_to_month(visit[2]), []).append(visit)
+
+        for month, visits in months.items():
+            archive_path = self.history_archive_path(month)
+            url_visits = dict()
+            hot_url_visits = dict()
+            for visit_id, url_id, visit_time, transition, url, page_title in visits:
+                typed = int(transition == TRANSITION_TYPED)
+                url_visit = url_visits.setdefault(url, [page_title, 0, 0, visit_time])
+                url_visit[1] += 1
+                url_visit[2] += typed
+                if visit_time >= url_visit[3]:
+                    url_visit[0] = page_title or url_visit[0]
+                    url_visit[3] = visit_time
+                hot_url_visit = hot_url_visits.setdefault(url_id, [0, 0])
+                hot_url_visit[0] += 1
+                hot_url_visit[1] += typed
+
+            self.attach_history_archive(archive_path)
+            try:
+                url_ids = self.read_url_ids(list(url_visits), 'archive')
+                self.history_cursor.executemany(
+                    '''UPDATE archive.urls
+                       SET title = CASE WHEN ?1 != '' AND ?4 >= last_visit_time THEN ?1 ELSE title END,
+                       visit_count = visit_count + ?2, typed_count = typed_count + ?3,
+                       last_visit_time = MAX(last_visit_time, ?4) WHERE id = ?5''',
+                    [(*url_visits[url], url_id) for url, url_id in url_ids.items()]
+                )
+                self.history_cursor.executemany(
+                    '''INSERT INTO archive.urls (url, title, visit_count, typed_count, last_visit_time)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    [(url, *url_visit) for url, url_visit in url_visits.items() if url not in url_ids]
+                )
+                url_ids = self.read_url_ids(list(url_visits), 'archive')
+                self.history_cursor.executemany(
+                    'INSERT OR IGNORE INTO archive.visits (id, url_id, visit_time, transition) VALUES (?, ?, ?, ?)',
+                    [(visit_id, url_ids[url], visit_time, transition)
+                     for visit_id, _, visit_time, transition, url, _ in visits]
+                )
+
+                self.history_cursor.executemany(
+                    'DELETE FROM main.visits WHERE id = ?', [(visit[0],) for visit in visits]
+                )
+                self.history_cursor.executemany(
+                    '''UPDATE main.urls SET visit_count = MAX(visit_count - ?, 0), typed_count = MAX(typed_count - ?, 0)
+                       WHERE id = ?''', [(*hot_url_visit, url_id) for url_id, hot_url_visit in hot_url_visits.items()]
+                )
+                self.history_cursor.executemany(
+                    '''DELETE FROM main.urls WHERE id = ?1
+                       AND NOT EXISTS (SELECT 1 FROM main.visits WHERE url_id = ?1)''',
+                    [(url_id,) for url_id in hot_url_visits]
+                )
+            finally:
+                self.detach_history_archive()
+
+        return len(moved)
+
+    def delete_history_archives_before(self, visit_time):
+        # Whole archives of months which ended before visit_time are deleted. Returns the number of deleted visits.
+        deleted = 0
+        for archive_path in self.read_history_archives():
+            if self.history_archive_month_end(archive_path) > visit_time:
+                continue
+            deleted += self.read_history_archive_rows(archive_path, 'SELECT COUNT(*) FROM archive.visits', ())[0][0]
+            self.delete_history_archive(archive_path)
+        return deleted
+
+    def delete_history_archive(self, archive_path):
+        connection_manager.discard_connection(archive_path)
+        with database_registry.lock:
+            database_registry.initialized_paths.discard(archive_path)
+        for suffix in ['', '-wal', '-shm', '-journal']:
+            if os.path.exists(f'{archive_path}{suffix}'):
+                os.remove(f'{archive_path}{suffix}')
+
+    @staticmethod
+    def notify_mutation(kind, data):
+        for listener in list(mutation_listeners):
+            listener(kind, data)
+
     def check_settings_table(self, table):
         db_command = f'SELECT * FROM {table}'
         self.settings_cursor.execute(db_command)
@@ -280,66 +939,722 @@ class Database:
         target_column_value = str(target_column_value)
         self.settings_cursor.execute(db_command, (target_column_value, query_column_value))
         self.close_settings_db()
+        self.notify_mutation('setting', (table, query_column, query_column_value, target_column, target_column_value))
 
     def delete_settings_data(self, table, query_column, query_column_value):
         self.open_settings_db()
         db_command = f'DELETE FROM {table} WHERE {query_column} = ?'
         self.settings_cursor.execute(db_command, (query_column_value,))
         self.close_settings_db()
+        self.notify_mutation('delete_setting', (table, query_column, query_column_value))
+
+    @staticmethod
+    def visits_column(column):
+        # Columns of the former flat visits table are mapped onto the urls and visits tables.
+        columns = {'url': 'urls.url', 'page_title': 'urls.title', 'title': 'urls.title', 'time': 'visits.visit_time'}
+        if column in columns:
+            return columns[column]
+        return f'visits.{column}'
+
+    def read_permission_decisions(self):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT permission, origin, decision FROM permission_decisions')
+        permission_decisions = self.settings_cursor.fetchall()
+        self.close_settings_db()
+        return permission_decisions
+
+    def update_permission_decision(self, permission, origin, decision):
+        self.open_settings_db()
+        self.settings_cursor.execute(
+            '''INSERT INTO permission_decisions (permission, origin, decision, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (permission, origin) DO UPDATE SET decision = excluded.decision,
+               updated_at = excluded.updated_at''', (permission, origin, decision, current_time_us())
+        )
+        self.close_settings_db()
+        self.notify_mutation('permission', (permission, origin, decision))
+
+    def delete_permission_decision(self, permission, origin):
+        self.open_settings_db()
+        self.settings_cursor.execute(
+            'DELETE FROM permission_decisions WHERE permission = ? AND origin = ?', (permission, origin)
+        )
+        self.close_settings_db()
+        self.notify_mutation('permission', (permission, origin, None))
+
+    def read_sync_state(self):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT device, offset, sequence FROM sync_state')
+        sync_state = {device: (offset, sequence) for device, offset, sequence in self.settings_cursor.fetchall()}
+        self.close_settings_db()
+        return sync_state
+
+    def update_sync_state(self, device, offset, sequence):
+        self.open_settings_db()
+        self.settings_cursor.execute(
+            '''INSERT INTO sync_state (device, offset, sequence) VALUES (?, ?, ?)
+               ON CONFLICT (device) DO UPDATE SET offset = excluded.offset, sequence = excluded.sequence''',
+            (device, offset, sequence)
+        )
+        self.close_settings_db()
+
+    def read_sync_version(self, key):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT time, device FROM sync_versions WHERE key = ?', (key,))
+        sync_version = self.settings_cursor.fetchone()
+        self.close_settings_db()
+        return sync_version
+
+    def update_sync_versions(self, sync_versions):
+        # sync_versions are (key, time, device), a key keeps its latest version.
+        self.open_settings_db()
+        self.settings_cursor.executemany(
+            '''INSERT INTO sync_versions (key, time, device) VALUES (?, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET time = excluded.time, device = excluded.device
+               WHERE (excluded.time, excluded.device) > (sync_versions.time, sync_versions.device)''', sync_versions
+        )
+        self.close_settings_db()
+
+    def read_learned_https_hosts(self):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT host FROM https_hosts WHERE learned = 1')
+        hosts = [host for host, in self.settings_cursor.fetchall()]
+        self.close_settings_db()
+        return hosts
+
+    def insert_learned_https_hosts(self, hosts):
+        self.open_settings_db()
+        self.settings_cursor.executemany(
+            '''INSERT INTO https_hosts (host, learned, updated_at) VALUES (?, 1, ?)
+               ON CONFLICT (host) DO UPDATE SET learned = 1''', [(host, current_time_us()) for host in hosts]
+        )
+        self.close_settings_db()
+
+    def delete_learned_https_host(self, host):
+        self.open_settings_db()
+        self.settings_cursor.execute('DELETE FROM https_hosts WHERE host = ? AND learned = 1', (host,))
+        self.close_settings_db()
+
+    def add_https_host_hits(self, hits):
+        # hits are {host: number of upgraded requests since the last call}.
+        updated_at = current_time_us()
+        self.open_settings_db()
+        self.settings_cursor.executemany(
+            '''INSERT INTO https_hosts (host, learned, hits, updated_at) VALUES (?, 0, ?, ?)
+               ON CONFLICT (host) DO UPDATE SET hits = hits + excluded.hits, updated_at = excluded.updated_at''',
+            [(host, count, updated_at) for host, count in hits.items()]
+        )
+        self.close_settings_db()
+
+    def read_https_host_hits(self):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT host, learned, hits FROM https_hosts WHERE hits > 0 ORDER BY hits DESC')
+        https_host_hits = self.settings_cursor.fetchall()
+        self.close_settings_db()
+        return https_host_hits
+
+    def read_session_tabs(self):
+        self.open_settings_db()
+        self.settings_cursor.execute('SELECT url, title, history, current FROM session_tabs ORDER BY position')
+        session_tabs = self.settings_cursor.fetchall()
+        self.close_settings_db()
+        return session_tabs
+
+    def replace_session_tabs(self, session_tabs):
+        # The whole session is replaced in one transaction, tabs are (url, title, history, current).
+        self.open_settings_db()
+        self.settings_cursor.execute('DELETE FROM session_tabs')
+        self.settings_cursor.executemany(
+            'INSERT INTO session_tabs (position, url, title, history, current) VALUES (?, ?, ?, ?, ?)',
+            [(position, *session_tab) for position, session_tab in enumerate(session_tabs)]
+        )
+        self.close_settings_db()
 
     def read_history_table(self, table):
+        history_table = list()
+        for page in self.iter_history_pages(table):
+            history_table.extend(page)
+        return history_table
+
+    def read_history_page(self, table, last_seen=None, page_size=200):
+        # One page of the newest rows after last_seen, the key of the last row of the previous page from
+        # history_page_key, which stays cheap however deep the page is. Visits are ordered by (visit_time, id), so that
+        # old visits which were imported or synced late, and got high ids, are shown at their time.
         self.open_history_db()
-        db_command = f'SELECT * FROM {table} ORDER BY id DESC'
-        self.history_cursor.execute(db_command)
-        history_table = self.history_cursor.fetchall()
+        if table == 'visits':
+            if last_seen is None:
+                last_seen = (2 ** 63 - 1, 0)
+            db_command = '''SELECT visits.id, urls.url, urls.title, visits.visit_time
+                            FROM {schema}visits AS visits JOIN {schema}urls AS urls ON urls.id = visits.url_id
+                            WHERE (visits.visit_time, visits.id) < (?, ?)
+                            ORDER BY visits.visit_time DESC, visits.id DESC LIMIT ?'''
+            parameters = (*last_seen, page_size)
+            self.history_cursor.execute(db_command.format(schema=''), parameters)
+        else:
+            if last_seen is None:
+                last_seen = 2 ** 63 - 1
+            self.history_cursor.execute(
+                f'SELECT * FROM {table} WHERE id < ? ORDER BY id DESC LIMIT ?', (last_seen, page_size)
+            )
+        history_page = self.history_cursor.fetchall()
         self.close_history_db()
-        return history_table
 
-    def read_history_urls(self):
+        # Archives are read newest first. Once the last row of a full page is newer than the end of the month of an
+        # archive, neither it nor any older archive can contribute to the page.
+        if table == 'visits':
+            for archive_path in self.read_history_archives():
+                if len(history_page) >= page_size and \
+                        history_page[page_size - 1][3] >= self.history_archive_month_end(archive_path):
+                    break
+                history_page.extend(
+                    self.read_history_archive_rows(archive_path, db_command.format(schema='archive.'), parameters)
+                )
+                history_page.sort(key=lambda row: (row[3], row[0]), reverse=True)
+                del history_page[page_size:]
+        return history_page
+
+    @staticmethod
+    def history_page_key(table, row):
+        # The last_seen of read_history_page for the page after the one ending with row.
+        if table == 'visits':
+            return row[3], row[0]
+        return row[0]
+
+    def iter_history_pages(self, table, page_size=1000):
+        # Pages of rows, the newest first, so that a whole table can be streamed with bounded memory.
+        last_seen = None
+        while True:
+            history_page = self.read_history_page(table, last_seen, page_size)
+            if not history_page:
+                break
+            yield history_page
+            last_seen = self.history_page_key(table, history_page[-1])
+
+    def estimate_history_count(self, table):
+        # Upper bound of the number of rows from the id range, read from the primary key in O(log n).
+        self.open_history_db()
+        self.history_cursor.execute(f'SELECT MAX(id) - MIN(id) + 1 FROM {table}')
+        count = self.history_cursor.fetchone()[0] or 0
+        self.close_history_db()
+        if table == 'visits':
+            for archive_path in self.read_history_archives():
+                count += self.read_history_archive_rows(
+                    archive_path, 'SELECT MAX(id) - MIN(id) + 1 FROM archive.visits', ()
+                )[0][0] or 0
+        return count
+
+    def read_history_urls(self, limit=None):
+        # Distinct visited urls, the most recently visited first. Archives are read newest first until limit urls are
+        # found, a url which is also in a newer partition keeps the newer row.
+        db_command = 'SELECT url, title, last_visit_time FROM {schema}urls ORDER BY last_visit_time DESC LIMIT ?'
+        if limit is None:
+            limit = -1
+
         self.open_history_db()
-        db_command = f'SELECT url, page_title, MAX(id) FROM visits GROUP BY url'
-        self.history_cursor.execute(db_command)
+        self.history_cursor.execute(db_command.format(schema=''), (limit,))
         history_urls = self.history_cursor.fetchall()
         self.close_history_db()
+
+        seen_urls = {url for url, _, _ in history_urls}
+        for archive_path in self.read_history_archives():
+            if 0 <= limit <= len(history_urls):
+                break
+            for row in self.read_history_archive_rows(archive_path, db_command.format(schema='archive.'), (limit,)):
+                if row[0] not in seen_urls:
+                    seen_urls.add(row[0])
+                    history_urls.append(row)
+        if limit >= 0:
+            del history_urls[limit:]
         return history_urls
 
+    def read_history_url_stats(self):
+        # (url, title, visit_count, typed_count, last_visit_time) of every visited url, with the counts of a url summed
+        # over all partitions and the title and time of its newest visit.
+        db_command = 'SELECT url, title, visit_count, typed_count, last_visit_time FROM {schema}urls'
+
+        self.open_history_db()
+        self.history_cursor.execute(db_command.format(schema=''))
+        url_stats = {row[0]: list(row[1:]) for row in self.history_cursor.fetchall()}
+        self.close_history_db()
+
+        for archive_path in self.read_history_archives():
+            for url, title, visit_count, typed_count, last_visit_time in self.read_history_archive_rows(
+                    archive_path, db_command.format(schema='archive.'), ()):
+                url_stat = url_stats.get(url)
+                if url_stat is None:
+                    url_stats[url] = [title, visit_count, typed_count, last_visit_time]
+                else:
+                    url_stat[1] += visit_count
+                    url_stat[2] += typed_count
+        return [(url, *url_stat) for url, url_stat in url_stats.items()]
+
+    def is_host_visited(self, host):
+        # Whether a url of host over http or https was visited lately, by range scans of the unique index on url.
+        visited = False
+        self.open_history_db()
+        for scheme in ['http', 'https']:
+            for separator in ['/', ':']:
+                prefix = f'{scheme}://{host}{separator}'
+                self.history_cursor.execute('SELECT 1 FROM urls WHERE url >= ? AND url < ? LIMIT 1',
+                                            (prefix, prefix + '\U0010ffff'))
+                if self.history_cursor.fetchone() is not None:
+                    visited = True
+                    break
+            if visited:
+                break
+        self.close_history_db()
+        return visited
+
+    @staticmethod
+    def history_search_terms(text):
+        # Every word of the text has to match the beginning of a token in the title or url.
+        words = re.findall(r'\w+', text)
+        fts_query = ' '.join(f'"{word}"*' for word in words)
+        return words, fts_query
+
+    def search_history(self, text, limit=100):
+        # Rows have the shape of read_history_table('visits'): (url id, url, title, last visit time). The best bm25
+        # matches are re-ranked with a boost for pages visited recently. Archives are searched newest first until
+        # limit urls are found.
+        words, fts_query = self.history_search_terms(text)
+        if not words:
+            return []
+
+        self.open_history_db()
+        history_data = self.search_history_partition('main', words, fts_query, limit)
+        self.close_history_db()
+
+        seen_urls = {row[1] for row in history_data}
+        for archive_path in self.read_history_archives():
+            if len(history_data) >= limit:
+                break
+            self.attach_history_archive(archive_path)
+            try:
+                rows = self.search_history_partition('archive', words, fts_query, limit - len(history_data))
+            finally:
+                self.detach_history_archive()
+            for row in rows:
+                if row[1] not in seen_urls:
+                    seen_urls.add(row[1])
+                    history_data.append(row)
+        return history_data
+
+    def search_history_partition(self, schema, words, fts_query, limit):
+        try:
+            db_command = f'''SELECT urls.id, urls.url, urls.title, urls.last_visit_time
+                             FROM (SELECT rowid, rank FROM {schema}.urls_fts WHERE urls_fts MATCH ?
+                             ORDER BY rank LIMIT ?) AS matches
+                             JOIN {schema}.urls AS urls ON urls.id = matches.rowid
+                             ORDER BY matches.rank *
+                             (1.0 + 1.0 / (1.0 + (? - urls.last_visit_time) / 2592000000000.0)) LIMIT ?'''
+            self.history_cursor.execute(db_command, (fts_query, limit * 10, current_time_us(), limit))
+        except sqlite3.OperationalError:
+            conditions = ' AND '.join('(urls.title LIKE ? OR urls.url LIKE ?)' for _ in words)
+            db_command = f'''SELECT urls.id, urls.url, urls.title, urls.last_visit_time FROM {schema}.urls AS urls
+                             WHERE {conditions} ORDER BY urls.last_visit_time DESC LIMIT ?'''
+            parameters = [f'%{word}%' for word in words for _ in range(2)]
+            self.history_cursor.execute(db_command, (*parameters, limit))
+        history_data = self.history_cursor.fetchall()
+        return history_data
+
     def read_history_data(self, table, query_column, query_column_value):
         self.open_history_db()
-        db_command = f'SELECT * FROM {table} where {query_column} = ?'
+        if table == 'visits':
+            db_command = f'''SELECT visits.id, urls.url, urls.title, visits.visit_time
+                             FROM visits JOIN urls ON urls.id = visits.url_id
+                             WHERE {self.visits_column(query_column)} = ?'''
+        else:
+            db_command = f'SELECT * FROM {table} where {query_column} = ?'
         self.history_cursor.execute(db_command, (query_column_value,))
         history_data = self.history_cursor.fetchall()
         self.close_history_db()
         return history_data
 
-    def insert_visits_history(self, url, page_title):
+    def insert_visits_history(self, url, page_title, transition=TRANSITION_LINK):
+        self.insert_history_batch([(url, page_title, current_time_us(), transition)], [])
+
+    def insert_downloads_history(self, url, file_name, status, reference_url):
+        self.insert_history_batch([], [(url, file_name, status, reference_url, time.asctime())])
+
+    def insert_history_batch(self, visits, downloads, notify=True, skip_existing=False):
+        # Write many visits (url, page_title, visit_time, transition) and downloads in one transaction, e.g. from the
+        # history writer thread. Bulk imports pass notify=False, so that they are not recorded as changes, e.g. in the
+        # sync log, and skip_existing=True, so that importing the same visits again adds nothing.
+        if skip_existing and visits:
+            visits = self.filter_new_visits(visits)
         self.open_history_db()
-        db_command = f'INSERT INTO visits (url, page_title, time) VALUES (?, ?, ?)'
-        self.history_cursor.execute(db_command, (url, page_title, time.asctime()))
+        if visits:
+            # Visits are summed up per url first, so that every url row is written once per batch. Existing and new
+            # urls are written by separate UPDATE and INSERT statements instead of an upsert, and the new urls are
+            # inserted by one statement over a JSON array. Every statement which runs the full-text index triggers
+            # has a fixed cost, so per-row statements are several times slower.
+            url_visits = dict()
+            for url, page_title, visit_time, transition in visits:
+                typed = int(transition == TRANSITION_TYPED)
+                if url in url_visits:
+                    url_visit = url_visits[url]
+                    url_visit[1] += 1
+                    url_visit[2] += typed
+                    if visit_time >= url_visit[3]:
+                        url_visit[0] = page_title or url_visit[0]
+                        url_visit[3] = visit_time
+                else:
+                    url_visits[url] = [page_title, 1, typed, visit_time]
+
+            url_ids = self.read_url_ids(list(url_visits))
+            self.history_cursor.executemany(
+                '''UPDATE urls SET title = CASE WHEN ?1 != '' AND ?4 >= last_visit_time THEN ?1 ELSE title END,
+                   visit_count = visit_count + ?2, typed_count = typed_count + ?3,
+                   last_visit_time = MAX(last_visit_time, ?4) WHERE id = ?5''',
+                [(*url_visits[url], url_id) for url, url_id in url_ids.items()]
+            )
+
+            new_urls = [[url, *url_visit] for url, url_visit in url_visits.items() if url not in url_ids]
+            if new_urls:
+                self.history_cursor.execute(
+                    '''INSERT INTO urls (url, title, visit_count, typed_count, last_visit_time)
+                       SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]'),
+                       json_extract(value, '$[3]'), json_extract(value, '$[4]') FROM json_each(?)''',
+                    (json.dumps(new_urls),)
+                )
+                url_ids.update(self.read_url_ids([url for url, _, _, _, _ in new_urls]))
+
+            self.history_cursor.executemany(
+                'INSERT INTO visits (url_id, visit_time, transition) VALUES (?, ?, ?)',
+                [(url_ids[url], visit_time, transition) for url, _, visit_time, transition in visits]
+            )
+        if downloads:
+            self.history_cursor.executemany(
+                'INSERT INTO downloads (url, file_name, status, reference_url, time) VALUES (?, ?, ?, ?, ?)', downloads
+            )
         self.close_history_db()
+        if notify:
+            self.notify_mutation('history', (visits, downloads))
+
+    def read_existing_visits(self, visits, schema='main'):
+        # (url, visit_time) of the given visits which are in the visits table, read with one statement.
+        self.history_cursor.execute(
+            f'''SELECT urls.url, visits.visit_time FROM json_each(?) AS batch
+                JOIN {schema}.urls AS urls ON urls.url = json_extract(batch.value, '$[0]')
+                JOIN {schema}.visits AS visits ON visits.url_id = urls.id
+                AND visits.visit_time = json_extract(batch.value, '$[1]')''',
+            (json.dumps([[url, visit_time] for url, _, visit_time, _ in visits]),)
+        )
+        existing_visits = set(self.history_cursor.fetchall())
+        return existing_visits
+
+    def filter_new_visits(self, visits):
+        # Visits whose url has a visit at the same time in kbhistory.db or in the archive of its month are left out,
+        # as are repeated visits within the batch.
+        self.open_history_db()
+        existing_visits = self.read_existing_visits(visits)
+        self.close_history_db()
+
+        months = dict()
+        for visit in visits:
+            months.setdefault(us_to_month(visit[2]), []).append(visit)
+        for month, month_visits in months.items():
+            archive_path = self.history_archive_path(month)
+            if os.path.exists(archive_path):
+                self.attach_history_archive(archive_path)
+                try:
+                    existing_visits |= self.read_existing_visits(month_visits, 'archive')
+                finally:
+                    self.detach_history_archive()
+
+        new_visits = list()
+        for visit in visits:
+            if (visit[0], visit[2]) not in existing_visits:
+                existing_visits.add((visit[0], visit[2]))
+                new_visits.append(visit)
+        return new_visits
+
+    def read_url_ids(self, urls, schema='main'):
+        # Ids of the given urls which are in the urls table, read with one statement.
+        self.history_cursor.execute(
+            f'''SELECT urls.id, urls.url FROM json_each(?) AS batch JOIN {schema}.urls AS urls
+                ON urls.url = batch.value''', (json.dumps(urls),)
+        )
+        url_ids = {url: url_id for url_id, url in self.history_cursor.fetchall()}
+        return url_ids
+
+    def update_url_visit_counts(self, url_ids, schema='main'):
+        # Recount visits of the given urls after deleting visits, urls without any remaining visit are removed.
+        url_ids = [(url_id,) for url_id in url_ids]
+        self.history_cursor.executemany(
+            f'''UPDATE {schema}.urls SET visit_count = (SELECT COUNT(*) FROM {schema}.visits WHERE url_id = urls.id)
+                WHERE id = ?''', url_ids
+        )
+        self.history_cursor.executemany(f'DELETE FROM {schema}.urls WHERE id = ? AND visit_count = 0', url_ids)
+
+    def delete_partition_visits(self, schema, db_command, parameters):
+        # Delete the visits of one partition whose (id, url_id) are selected by db_command.
+        self.history_cursor.execute(db_command.format(schema=schema), parameters)
+        deleted = self.history_cursor.fetchall()
+        self.history_cursor.executemany(f'DELETE FROM {schema}.visits WHERE id = ?', [(n,) for n, _ in deleted])
+        self.update_url_visit_counts({url_id for _, url_id in deleted}, schema)
+        return len(deleted)
+
+    def prune_history_partitions(self, prune):
+        # prune(schema) deletes visits of one partition and returns their number. It is called for the archives, the
+        # oldest month first, and then for kbhistory.db until one deletes visits, so that a retention step stays
+        # small. Archives left without visits are deleted.
+        for archive_path in reversed(self.read_history_archives()):
+            self.attach_history_archive(archive_path)
+            try:
+                deleted = prune('archive')
+                is_empty = self.history_cursor.execute('SELECT 1 FROM archive.visits LIMIT 1').fetchone() is None
+            finally:
+                self.detach_history_archive()
+
+            if deleted:
+                if is_empty:
+                    self.delete_history_archive(archive_path)
+                return deleted
 
-    def insert_downloads_history(self, url, file_name, status, reference_url):
         self.open_history_db()
-        db_command = f'INSERT INTO downloads (url, file_name, status, reference_url, time) VALUES (?, ?, ?, ?, ?)'
-        self.history_cursor.execute(db_command, (url, file_name, status, reference_url, time.asctime()))
+        deleted = prune('main')
         self.close_history_db()
+        return deleted
+
+    def count_history_visits(self):
+        # Visits in kbhistory.db and in every archive.
+        self.open_history_db()
+        count = self.history_cursor.execute('SELECT COUNT(*) FROM visits').fetchone()[0]
+        self.close_history_db()
+        for archive_path in self.read_history_archives():
+            count += self.read_history_archive_rows(archive_path, 'SELECT COUNT(*) FROM archive.visits', ())[0][0]
+        return count
+
+    def prune_visits_before(self, visit_time, limit):
+        # Delete up to limit visits older than visit_time, the oldest first. Returns the number of deleted visits.
+        db_command = 'SELECT id, url_id FROM {schema}.visits WHERE visit_time < ? ORDER BY visit_time LIMIT ?'
+        return self.prune_history_partitions(
+            lambda schema: self.delete_partition_visits(schema, db_command, (visit_time, limit))
+        )
+
+    def prune_visits_over(self, max_rows, limit):
+        # Delete up to limit of the oldest visits beyond the newest max_rows visits of all partitions.
+        excess = self.count_history_visits() - max_rows
+        if excess <= 0:
+            return 0
+
+        db_command = 'SELECT id, url_id FROM {schema}.visits ORDER BY id LIMIT ?'
+        return self.prune_history_partitions(
+            lambda schema: self.delete_partition_visits(schema, db_command, (min(excess, limit),))
+        )
+
+    def prune_duplicate_visits_before(self, visit_time, limit):
+        # Delete up to limit visits older than visit_time which are not the latest visit of their url. The visit count
+        # of the url is kept, so that it still ranks as often visited. A visit in an archive is also a duplicate when
+        # kbhistory.db has a later visit of its url.
+        def prune(schema):
+            db_command = f'''SELECT id FROM {schema}.visits AS old WHERE visit_time < ?1
+                             AND (EXISTS (SELECT 1 FROM {schema}.visits AS newer
+                             WHERE newer.url_id = old.url_id AND newer.id > old.id)'''
+            if schema != 'main':
+                db_command += f''' OR EXISTS (SELECT 1 FROM {schema}.urls AS urls
+                                 JOIN main.urls AS hot ON hot.url = urls.url
+                                 WHERE urls.id = old.url_id AND hot.last_visit_time > old.visit_time)'''
+            self.history_cursor.execute(f'{db_command}) ORDER BY visit_time LIMIT ?2', (visit_time, limit))
+            deleted = self.history_cursor.fetchall()
+            self.history_cursor.executemany(f'DELETE FROM {schema}.visits WHERE id = ?', deleted)
+            return len(deleted)
+
+        return self.prune_history_partitions(prune)
+
+    def incremental_vacuum(self, pages):
+        # Give up to pages free pages back to the file system. Returns the reclaimed bytes and the remaining free pages.
+        # The file is switched to incremental mode by migrate_history_v4. The pragma frees one page per step, execute()
+        # only steps once while executescript() runs it to the end.
+        self.open_history_db()
+        page_size = self.history_cursor.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self.history_cursor.execute('PRAGMA page_count').fetchone()[0]
+        self.history_db.commit()
+        self.history_cursor.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        reclaimed_pages = max(page_count - self.history_cursor.execute('PRAGMA page_count').fetchone()[0], 0)
+        free_pages = self.history_cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        self.close_history_db()
+        return reclaimed_pages * page_size, free_pages
+
+    @staticmethod
+    def history_file_columns(table):
+        if table == 'visits':
+            return ['url', 'title', 'visit_time', 'transition']
+        return ['url', 'file_name', 'status', 'reference_url', 'time']
+
+    @staticmethod
+    def open_history_file(path, mode):
+        # JSON Lines or CSV by the file name, compressed with gzip if it ends with .gz.
+        if path.endswith('.gz'):
+            return gzip.open(path, f'{mode}t', encoding='utf-8', newline='')
+        return open(path, mode, encoding='utf-8', newline='')
+
+    @staticmethod
+    def is_csv_file(path):
+        if path.endswith('.gz'):
+            path = path[:-3]
+        return path.endswith('.csv')
+
+    def iter_history_export_pages(self, table, page_size=1000):
+        # Pages of rows in the order they were recorded, without ids, in the columns of history_file_columns. Visits
+        # of the archives come first, the oldest month first.
+        if table == 'visits':
+            db_command = '''SELECT visits.id, urls.url, urls.title, visits.visit_time, visits.transition
+                            FROM {schema}visits AS visits JOIN {schema}urls AS urls ON urls.id = visits.url_id
+                            WHERE visits.id > ? ORDER BY visits.id LIMIT ?'''
+            partitions = list(reversed(self.read_history_archives())) + [None]
+        else:
+            db_command = '''SELECT id, url, file_name, status, reference_url, time FROM {schema}downloads
+                            WHERE id > ? ORDER BY id LIMIT ?'''
+            partitions = [None]
+
+        for archive_path in partitions:
+            last_seen_id = 0
+            while True:
+                if archive_path is None:
+                    self.open_history_db()
+                    self.history_cursor.execute(db_command.format(schema=''), (last_seen_id, page_size))
+                    history_page = self.history_cursor.fetchall()
+                    self.close_history_db()
+                else:
+                    history_page = self.read_history_archive_rows(
+                        archive_path, db_command.format(schema='archive.'), (last_seen_id, page_size)
+                    )
+                if not history_page:
+                    break
+                last_seen_id = history_page[-1][0]
+                yield [row[1:] for row in history_page]
+
+    def export_history(self, table, path, page_size=1000, progress=None):
+        # Stream a history table into a file. progress(rows, estimated_total) is called after every page.
+        columns = self.history_file_columns(table)
+        estimated_total = self.estimate_history_count(table)
+        rows = 0
+        with self.open_history_file(path, 'w') as history_file:
+            if self.is_csv_file(path):
+                writer = csv.writer(history_file)
+                writer.writerow(columns)
+                for history_page in self.iter_history_export_pages(table, page_size):
+                    writer.writerows(history_page)
+                    rows += len(history_page)
+                    if progress:
+                        progress(rows, estimated_total)
+            else:
+                for history_page in self.iter_history_export_pages(table, page_size):
+                    history_file.writelines(f'{json.dumps(dict(zip(columns, row)), ensure_ascii=False)}\n'
+                                            for row in history_page)
+                    rows += len(history_page)
+                    if progress:
+                        progress(rows, estimated_total)
+        return rows
+
+    @staticmethod
+    def iter_history_file_records(history_file, is_csv):
+        if is_csv:
+            for record in csv.DictReader(history_file):
+                yield record
+        else:
+            for line in history_file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    @staticmethod
+    def read_history_file_position(history_file):
+        # Bytes read from the file on disk, which is the compressed one for gzip. Reads are buffered, so the position
+        # runs ahead of the parsed records by up to one buffer.
+        raw_file = history_file.buffer
+        raw_file = getattr(raw_file, 'fileobj', raw_file)
+        return raw_file.tell()
+
+    @staticmethod
+    def history_record_to_row(table, record):
+        url = record.get('url')
+        if not url:
+            return None
+
+        if table == 'visits':
+            try:
+                visit_time = int(record.get('visit_time') or 0)
+            except ValueError:
+                visit_time = 0
+            try:
+                transition = int(record.get('transition') or TRANSITION_LINK)
+            except ValueError:
+                transition = TRANSITION_LINK
+            return url, record.get('title') or '', visit_time, transition
+
+        return (url, record.get('file_name') or '', record.get('status') or '',
+                record.get('reference_url') or '', record.get('time') or '')
+
+    def import_history(self, table, path, batch_size=5000, progress=None):
+        # Stream records from a file written by export_history. Every batch is inserted with executemany in one
+        # transaction. progress(rows, bytes_read) is called after every batch.
+        rows = 0
+        batch = list()
+        with self.open_history_file(path, 'r') as history_file:
+            for record in self.iter_history_file_records(history_file, self.is_csv_file(path)):
+                row = self.history_record_to_row(table, record)
+                if row is None:
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    rows += self.import_history_batch(table, batch)
+                    if progress:
+                        progress(rows, self.read_history_file_position(history_file))
+            rows += self.import_history_batch(table, batch)
+            if progress:
+                progress(rows, self.read_history_file_position(history_file))
+        return rows
+
+    def import_history_batch(self, table, batch):
+        rows = len(batch)
+        if table == 'visits':
+            self.insert_history_batch(batch, [], notify=False, skip_existing=True)
+        else:
+            self.insert_history_batch([], batch, notify=False)
+        batch.clear()
+        return rows
 
     def reset_history_table(self, table):
+        # Rows are deleted instead of dropping the tables, so that indexes and later schema objects are kept.
         self.open_history_db()
-        self.history_cursor.execute(f'DROP TABLE {table}')
         if table == 'visits':
-            self.history_cursor.execute(
-                'CREATE TABLE IF NOT EXISTS visits (id INTEGER PRIMARY KEY AUTOINCREMENT, url, page_title, time)'
-            )
+            self.history_cursor.execute('DELETE FROM visits')
+            self.history_cursor.execute('DELETE FROM urls')
         if table == 'downloads':
-            self.history_cursor.execute(
-                '''CREATE TABLE IF NOT EXISTS downloads (id INTEGER PRIMARY KEY AUTOINCREMENT, url, file_name,
-                status, reference_url, time)'''
-            )
-
+            self.history_cursor.execute('DELETE FROM downloads')
         self.close_history_db()
 
+        if table == 'visits':
+            for archive_path in self.read_history_archives():
+                self.delete_history_archive(archive_path)
+
+        self.notify_mutation('reset_history', (table,))
+
+        # After many deletes through the full-text index triggers, FTS5 inserts on the same connection become several
+        # times slower, e.g. when importing history right after clearing it. A new connection does not have that state.
+        connection_manager.discard_connection(self.history_db_path)
+
     def delete_history_data(self, table, query_column, query_column_value):
-        self.open_history_db()
-        db_command = f'DELETE FROM {table} WHERE {query_column} = ?'
-        self.history_cursor.execute(db_command, (query_column_value,))
-        self.close_history_db()
+        # Visits are deleted from kbhistory.db and from every archive, which are read together.
+        if table == 'visits':
+            db_command = f'''SELECT visits.id, visits.url_id
+                             FROM {{schema}}.visits AS visits JOIN {{schema}}.urls AS urls ON urls.id = visits.url_id
+                             WHERE {self.visits_column(query_column)} = ?'''
+            self.open_history_db()
+            self.delete_partition_visits('main', db_command, (query_column_value,))
+            self.close_history_db()
+
+            for archive_path in self.read_history_archives():
+                self.attach_history_archive(archive_path)
+                try:
+                    self.delete_partition_visits('archive', db_command, (query_column_value,))
+                finally:
+                    self.detach_history_archive()
+        else:
+            self.open_history_db()
+            db_command = f'DELETE FROM {table} WHERE {query_column} = ?'
+            self.history_cursor.execute(db_command, (query_column_value,))
+            self.close_history_db()
+        self.notify_mutation('delete_history', (table, query_column, query_column_value))
@@ -1,14 +1,64 @@
 import os
+import csv
+import time
+import queue
+import atexit
 import shutil
+import sqlite3
+import threading
 
-from PySide6.QtCore import Qt, Signal
+from PySide6.QtCore import Qt, Signal, QTimer, QThread
 from PySide6.QtWidgets import (QWidget, QDialog, QPushButton, QGridLayout, QVBoxLayout, QTabWidget, QLabel,
-                               QTableWidget)
+                               QTableWidget, QLineEdit, QFileDialog, QProgressBar)
 
-from kbdatabase import Database
+from kbdatabase import (Database, connection_manager, current_time_us, us_to_asctime, month_start_us, TRANSITION_LINK,
+                        TRANSITION_TYPED)
+from kbimporter import BrowserHistoryImporter
 from kbsettingshandler import BasicSettings, LangSetting
 
 
+class HistoryTransfer(QThread):
+    # Exports or imports a history table in a file, or imports the history of another browser, off the GUI thread.
+    progress_signal = Signal(int, int)
+    finished_signal = Signal(str, int, str)
+
+    def __init__(self, action, table, path):
+        super(HistoryTransfer, self).__init__()
+
+        self.action = action
+        self.table = table
+        self.path = path
+
+    def send_progress(self, rows, total):
+        self.progress_signal.emit(rows, total)
+
+    def send_import_progress(self, rows, bytes_read):
+        # The share of the file read so far in thousandths, which also fits files larger than an int.
+        file_size = os.path.getsize(self.path)
+        self.progress_signal.emit(rows, min(bytes_read * 1000 // file_size, 1000) if file_size else 1000)
+
+    def run(self):
+        database = Database()
+        rows = 0
+        error = ''
+        try:
+            if self.action == 'export':
+                history_writer.flush()
+                rows = database.export_history(self.table, self.path, progress=self.send_progress)
+            elif self.action == 'browser':
+                # Progress of browser imports carries the visits per second instead of a total.
+                history_writer.flush()
+                rows = BrowserHistoryImporter().import_history(self.path, progress=self.send_progress)['visits']
+            else:
+                rows = database.import_history(self.table, self.path, progress=self.send_import_progress)
+        except (OSError, ValueError, KeyError, csv.Error, sqlite3.Error) as exception:
+            error = str(exception)
+        finally:
+            connection_manager.close_thread_connections()
+
+        self.finished_signal.emit(self.action, rows, error)
+
+
 class HistoryManagement(QDialog):
     open_url_signal = Signal(str)
     clear_cookies_signal = Signal()
@@ -27,6 +77,12 @@ class HistoryManagement(QDialog):
         self.visit_url = dict()
         self.visit_time = dict()
         self.visit_layout = dict()
+        # Rows are read page by page while scrolling down.
+        self.history_page_size = 200
+        self.visits_last_seen = None
+        self.visits_all_loaded = False
+        self.downloads_last_seen = None
+        self.downloads_all_loaded = False
 
         self.download_url = dict()
         self.download_time = dict()
@@ -39,6 +95,14 @@ class HistoryManagement(QDialog):
         self.dialog = QTabWidget()
         self.layout.addWidget(self.dialog)
 
+        self.history_transfer = None
+        self.history_transfer_table = None
+        self.history_transfer_status = QLabel()
+        self.history_transfer_progress = QProgressBar()
+        self.history_transfer_progress.setHidden(True)
+        self.layout.addWidget(self.history_transfer_status)
+        self.layout.addWidget(self.history_transfer_progress)
+
         self.visits_history_layout = QVBoxLayout()
         self.visits_history_management_layout = QGridLayout()
         self.visits_history_management_layout.setAlignment(Qt.AlignCenter)
@@ -46,6 +110,14 @@ class HistoryManagement(QDialog):
         self.visits_history_tab = QWidget()
         self.visits_history_tab.setLayout(self.visits_history_layout)
 
+        # Search visited pages by title and url. A query runs once typing pauses for a moment.
+        self.visits_search_bar = QLineEdit()
+        self.visits_search_bar.setPlaceholderText(self.LangSetting.language.lang_search_history)
+        self.visits_search_bar.setClearButtonEnabled(True)
+        self.visits_search_timer = QTimer()
+        self.visits_search_timer.setSingleShot(True)
+        self.visits_search_timer.setInterval(200)
+
         self.visits_history_table = QTableWidget()
         self.visits_history_table.setColumnCount(3)
         self.visits_history_table.setHorizontalHeaderLabels(
@@ -66,10 +138,21 @@ class HistoryManagement(QDialog):
         self.clear_cached_data_button = QPushButton(self.LangSetting.language.lang_clear_cookies_cache)
         self.clear_cached_data_button.setFixedWidth(180)
 
+        self.visits_history_layout.addWidget(self.visits_search_bar)
         self.visits_history_layout.addWidget(self.visits_history_table)
         self.visits_history_layout.addLayout(self.visits_history_management_layout)
+        self.export_visits_history_button = QPushButton(self.LangSetting.language.lang_export)
+        self.export_visits_history_button.setFixedWidth(100)
+        self.import_visits_history_button = QPushButton(self.LangSetting.language.lang_import)
+        self.import_visits_history_button.setFixedWidth(100)
+        self.import_browser_history_button = QPushButton(self.LangSetting.language.lang_import_from_browser)
+        self.import_browser_history_button.setFixedWidth(180)
+
         self.visits_history_management_layout.addWidget(self.clear_visits_history_button, 0, 1)
         self.visits_history_management_layout.addWidget(self.clear_cached_data_button, 0, 2)
+        self.visits_history_management_layout.addWidget(self.export_visits_history_button, 0, 3)
+        self.visits_history_management_layout.addWidget(self.import_visits_history_button, 0, 4)
+        self.visits_history_management_layout.addWidget(self.import_browser_history_button, 0, 5)
 
         self.downloads_history_layout = QVBoxLayout()
         self.downloads_history_management_layout = QGridLayout()
@@ -100,18 +183,36 @@ class HistoryManagement(QDialog):
 
         self.downloads_history_layout.addWidget(self.downloads_history_table)
         self.downloads_history_layout.addLayout(self.downloads_history_management_layout)
+        self.export_downloads_history_button = QPushButton(self.LangSetting.language.lang_export)
+        self.export_downloads_history_button.setFixedWidth(100)
+        self.import_downloads_history_button = QPushButton(self.LangSetting.language.lang_import)
+        self.import_downloads_history_button.setFixedWidth(100)
+
         self.downloads_history_management_layout.addWidget(self.clear_downloads_history_button, 0, 0)
+        self.downloads_history_management_layout.addWidget(self.export_downloads_history_button, 0, 1)
+        self.downloads_history_management_layout.addWidget(self.import_downloads_history_button, 0, 2)
 
         self.dialog.addTab(self.visits_history_tab, self.LangSetting.language.lang_visits_history)
         self.dialog.addTab(self.downloads_history_tab, self.LangSetting.language.lang_downloads_history)
 
         self.clear_visits_history_button.clicked.connect(self.clear_visits_history)
+        self.visits_history_table.verticalScrollBar().valueChanged.connect(self.visits_history_scrolled)
+        self.downloads_history_table.verticalScrollBar().valueChanged.connect(self.downloads_history_scrolled)
+        self.visits_search_bar.textChanged.connect(self.visits_search_timer.start)
+        self.visits_search_timer.timeout.connect(self.search_visits_history)
         self.clear_cached_data_button.clicked.connect(self.clear_cached_data)
         self.clear_downloads_history_button.clicked.connect(self.clear_downloads_history)
+        self.export_visits_history_button.clicked.connect(lambda: self.export_history('visits'))
+        self.import_visits_history_button.clicked.connect(lambda: self.import_history('visits'))
+        self.import_browser_history_button.clicked.connect(self.import_browser_history)
+        self.export_downloads_history_button.clicked.connect(lambda: self.export_history('downloads'))
+        self.import_downloads_history_button.clicked.connect(lambda: self.import_history('downloads'))
 
     def clear_visits_history(self):
+        history_writer.flush()
         self.database.reset_history_table('visits')
         self.visits_history_table.clearContents()
+        self.visits_history_table.setRowCount(0)
         self.clear_address_bar_completer_signal.emit()
 
     def clear_cached_data(self):
@@ -124,27 +225,132 @@ class HistoryManagement(QDialog):
         self.clear_cookies_signal.emit()
 
     def clear_downloads_history(self):
+        history_writer.flush()
         self.database.reset_history_table('downloads')
         self.downloads_history_table.clearContents()
+        self.downloads_history_table.setRowCount(0)
+
+    def export_history(self, table):
+        path, _ = QFileDialog.getSaveFileName(
+            self, self.LangSetting.language.lang_export, f'kbrowser-{table}.jsonl.gz',
+            self.LangSetting.language.lang_history_files
+        )
+        if path:
+            self.start_history_transfer('export', table, path)
+
+    def import_history(self, table):
+        path, _ = QFileDialog.getOpenFileName(
+            self, self.LangSetting.language.lang_import, '', self.LangSetting.language.lang_history_files
+        )
+        if path:
+            self.start_history_transfer('import', table, path)
+
+    def import_browser_history(self):
+        path, _ = QFileDialog.getOpenFileName(
+            self, self.LangSetting.language.lang_import_from_browser, '',
+            self.LangSetting.language.lang_browser_history_files
+        )
+        if path:
+            self.start_history_transfer('browser', 'visits', path)
+
+    def start_history_transfer(self, action, table, path):
+        if self.history_transfer is not None and self.history_transfer.isRunning():
+            return
+
+        self.history_transfer_table = table
+        self.history_transfer = HistoryTransfer(action, table, path)
+        self.history_transfer.progress_signal.connect(self.history_transfer_progressed)
+        self.history_transfer.finished_signal.connect(self.history_transfer_finished)
+
+        self.history_transfer_status.setText(self.LangSetting.language.lang_history_transfer_running)
+        self.history_transfer_progress.setRange(0, 0)
+        self.history_transfer_progress.setHidden(False)
+        self.history_transfer.start()
+
+    def history_transfer_progressed(self, rows, total):
+        # Exports know the number of rows in advance, imports of a file report the thousandths of the file read. Imports
+        # from a browser keep a busy indicator.
+        if self.history_transfer.action == 'export' and total > 0:
+            self.history_transfer_progress.setRange(0, total)
+            self.history_transfer_progress.setValue(min(rows, total))
+        if self.history_transfer.action == 'import':
+            self.history_transfer_progress.setRange(0, 1000)
+            self.history_transfer_progress.setValue(total)
+        if self.history_transfer.action == 'browser':
+            self.history_transfer_status.setText(
+                f'{self.LangSetting.language.lang_history_transfer_running} {rows} '
+                f'({total} {self.LangSetting.language.lang_rows_per_second})'
+            )
+        else:
+            self.history_transfer_status.setText(f'{self.LangSetting.language.lang_history_transfer_running} {rows}')
+
+    def history_transfer_finished(self, action, rows, error):
+        self.history_transfer_progress.setHidden(True)
+        if error:
+            self.history_transfer_status.setText(f'{self.LangSetting.language.lang_history_transfer_failed}{error}')
+        else:
+            self.history_transfer_status.setText(f'{self.LangSetting.language.lang_history_transfer_done}{rows}')
+
+        if action in ['import', 'browser']:
+            if self.history_transfer_table == 'visits':
+                self.show_visits_history()
+            else:
+                self.show_downloads_history()
 
     def read_visits_history(self):
-        visits = self.database.read_history_table('visits')
+        history_writer.flush()
+        visits = self.database.read_history_page('visits', self.visits_last_seen, self.history_page_size)
         return visits
 
     def read_downloads_history(self):
-        downloads = self.database.read_history_table('downloads')
+        history_writer.flush()
+        downloads = self.database.read_history_page('downloads', self.downloads_last_seen, self.history_page_size)
         return downloads
 
+    def search_visits_history(self):
+        text = self.visits_search_bar.text().strip()
+        if text == '':
+            self.show_visits_history()
+        else:
+            history_writer.flush()
+            visits = self.database.search_history(text, 200)
+            # Search results are not paginated.
+            self.visits_all_loaded = True
+            self.fill_visits_history_table(visits)
+
     def show_visits_history(self):
+        self.visits_last_seen = None
+        self.visits_all_loaded = False
+        visits = self.read_visits_history()
+        self.fill_visits_history_table(visits)
+
+    def show_more_visits_history(self):
         visits = self.read_visits_history()
-        self.visits_history_table.setRowCount(len(visits))
+        self.fill_visits_history_table(visits, append=True)
+
+    def visits_history_scrolled(self, value):
+        if self.visits_all_loaded is False and value >= self.visits_history_table.verticalScrollBar().maximum() - 5:
+            self.show_more_visits_history()
+
+    def fill_visits_history_table(self, visits, append=False):
+        if visits:
+            self.visits_last_seen = self.database.history_page_key('visits', visits[-1])
+        if len(visits) < self.history_page_size:
+            self.visits_all_loaded = True
+
+        first_row = 0
+        if append:
+            first_row = self.visits_history_table.rowCount()
+        else:
+            self.visits_history_table.clearContents()
+        self.visits_history_table.setRowCount(first_row + len(visits))
 
-        for n in range(len(visits)):
-            visit = visits[n]
+        for n in range(first_row, first_row + len(visits)):
+            visit = visits[n - first_row]
 
             self.visit_page_title[n] = QLabel(visit[2])
             self.visit_url[n] = QLabel(f'<a href="{visit[1]}">{visit[1]}</a>')
-            self.visit_time[n] = QLabel(visit[3])
+            self.visit_time[n] = QLabel(us_to_asctime(visit[3]))
 
             self.visit_page_title[n].setMargin(5)
             self.visit_url[n].setMargin(5)
@@ -157,11 +363,35 @@ class HistoryManagement(QDialog):
             self.visit_url[n].linkActivated.connect(self.send_signal)
 
     def show_downloads_history(self):
+        self.downloads_last_seen = None
+        self.downloads_all_loaded = False
         downloads = self.read_downloads_history()
-        self.downloads_history_table.setRowCount(len(downloads))
+        self.fill_downloads_history_table(downloads)
 
-        for n in range(len(downloads)):
-            download = downloads[n]
+    def show_more_downloads_history(self):
+        downloads = self.read_downloads_history()
+        self.fill_downloads_history_table(downloads, append=True)
+
+    def downloads_history_scrolled(self, value):
+        if self.downloads_all_loaded is False and \
+                value >= self.downloads_history_table.verticalScrollBar().maximum() - 5:
+            self.show_more_downloads_history()
+
+    def fill_downloads_history_table(self, downloads, append=False):
+        if downloads:
+            self.downloads_last_seen = self.database.history_page_key('downloads', downloads[-1])
+        if len(downloads) < self.history_page_size:
+            self.downloads_all_loaded = True
+
+        first_row = 0
+        if append:
+            first_row = self.downloads_history_table.rowCount()
+        else:
+            self.downloads_history_table.clearContents()
+        self.downloads_history_table.setRowCount(first_row + len(downloads))
+
+        for n in range(first_row, first_row + len(downloads)):
+            download = downloads[n - first_row]
             self.download_file_name[n] = QLabel(download[2])
             self.download_url[n] = QLabel(f'<a href="{download[1]}">{download[1]}</a>')
             self.download_reference_url[n] = QLabel(f'<a href="{download[4]}">{download[4]}</a>')
@@ -184,16 +414,296 @@ class HistoryManagement(QDialog):
         self.open_url_signal.emit(url)
 
 
+class HistoryRetention:
+    # Prunes history according to the retention policies in the basic settings. Every step deletes at most batch_size
+    # visits or vacuums at most vacuum_pages pages, so that a step never holds the database lock for long.
+    def __init__(self, batch_size=500, vacuum_pages=256, first_run_delay=60, step_interval=0.2, run_interval=3600,
+                 hot_months=1):
+        super(HistoryRetention, self).__init__()
+
+        self.batch_size = batch_size
+        # Visits older than the last hot_months calendar months are moved into monthly archive files.
+        self.hot_months = hot_months
+        self.vacuum_pages = vacuum_pages
+        self.step_interval = step_interval
+        self.run_interval = run_interval
+        self.next_run = time.monotonic() + first_run_delay
+
+        self.statistics_lock = threading.Lock()
+        self.statistics = {'rows_pruned': 0, 'rows_archived': 0, 'bytes_reclaimed': 0, 'steps': 0}
+
+    @staticmethod
+    def read_policy(database):
+        policy = list()
+        for item in ['history_max_age_days', 'history_max_rows', 'history_dedupe_after_days']:
+            temp = database.read_settings_data('basic', 'item', item)
+            try:
+                value = int(temp[0][2])
+            except (IndexError, ValueError):
+                value = 0
+            policy.append(max(value, 0))
+        return policy
+
+    def is_due(self):
+        return time.monotonic() >= self.next_run
+
+    def schedule(self, delay=0):
+        # Run soon again, e.g. after the policies were changed.
+        self.next_run = min(self.next_run, time.monotonic() + delay)
+
+    def postpone(self, delay):
+        # Run again after delay, e.g. after a step failed.
+        self.next_run = time.monotonic() + delay
+
+    def run_step(self, database):
+        max_age_days, max_rows, dedupe_after_days = self.read_policy(database)
+        day = 86400 * 1000000
+
+        pruned = 0
+        if max_age_days:
+            pruned = database.delete_history_archives_before(current_time_us() - max_age_days * day)
+            pruned += database.prune_visits_before(current_time_us() - max_age_days * day, self.batch_size)
+        if pruned == 0 and max_rows:
+            pruned = database.prune_visits_over(max_rows, self.batch_size)
+        if pruned == 0 and dedupe_after_days:
+            pruned = database.prune_duplicate_visits_before(
+                current_time_us() - dedupe_after_days * day, self.batch_size
+            )
+
+        archived = 0
+        if pruned == 0:
+            archived = database.archive_history_before(
+                month_start_us(current_time_us(), self.hot_months - 1), self.batch_size
+            )
+
+        reclaimed, free_pages = 0, 0
+        if pruned == 0 and archived == 0:
+            reclaimed, free_pages = database.incremental_vacuum(self.vacuum_pages)
+
+        with self.statistics_lock:
+            self.statistics['rows_pruned'] += pruned
+            self.statistics['rows_archived'] += archived
+            self.statistics['bytes_reclaimed'] += reclaimed
+            self.statistics['steps'] += 1
+
+        if pruned or archived or free_pages:
+            self.next_run = time.monotonic() + self.step_interval
+        else:
+            self.next_run = time.monotonic() + self.run_interval
+
+    def read_statistics(self):
+        with self.statistics_lock:
+            return dict(self.statistics)
+
+
+class HistoryWriter:
+    # Write-behind recorder for visits and downloads. Records are queued from the GUI thread and written by a writer
+    # thread in one transaction every flush_interval milliseconds or every flush_rows records, whichever comes first.
+    #
+    # A failed write, e.g. while a backup or an import holds the database longer than the busy timeout, keeps its
+    # records and is tried again after retry_interval seconds. Failures are counted in the statistics with the last
+    # error. A writer thread which died anyway is replaced by a new one on the next record.
+    def __init__(self, flush_interval=500, flush_rows=200, max_queue_size=10000, retry_interval=5,
+                 retention_delay=60):
+        super(HistoryWriter, self).__init__()
+
+        self.flush_interval = flush_interval / 1000
+        self.flush_rows = flush_rows
+        self.retry_interval = retry_interval
+        self.retention_delay = retention_delay
+        self.queue = queue.Queue(max_queue_size)
+        # Retention runs in the writer thread too, in the pauses between writes.
+        self.retention = HistoryRetention()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.stopped = False
+
+        self.statistics_lock = threading.Lock()
+        self.statistics = {'queued': 0, 'coalesced': 0, 'written': 0, 'flushes': 0, 'max_queue_depth': 0,
+                           'last_flush_latency': 0.0, 'max_flush_latency': 0.0, 'total_flush_latency': 0.0,
+                           'errors': 0, 'last_error': '', 'threads_started': 0}
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def ensure_started(self):
+        # A Thread can only be started once, so a new one is created for every start.
+        with self.start_lock:
+            if not self.is_alive() and not self.stopped:
+                if self.thread is None:
+                    atexit.register(self.stop)
+                self.thread = threading.Thread(target=self.run, name='kBrowser history writer', daemon=True)
+                self.thread.start()
+                with self.statistics_lock:
+                    self.statistics['threads_started'] += 1
+
+    def put(self, item):
+        self.ensure_started()
+        if self.stopped:
+            # Late records after shutdown are written directly.
+            kind, data = item
+            if kind == 'visit':
+                Database().insert_history_batch([data], [])
+            if kind == 'download':
+                Database().insert_history_batch([], [data])
+            return
+
+        # The queue is bounded, so a writer that falls behind slows down the producers instead of growing forever.
+        self.queue.put(item)
+        with self.statistics_lock:
+            self.statistics['queued'] += 1
+            self.statistics['max_queue_depth'] = max(self.statistics['max_queue_depth'], self.queue.qsize())
+
+    def record_visit(self, url, page_title, transition=TRANSITION_LINK):
+        self.put(('visit', (url, page_title, current_time_us(), transition)))
+
+    def record_download(self, url, file_name, status, reference_url):
+        self.put(('download', (url, file_name, status, reference_url, time.asctime())))
+
+    def schedule_retention(self):
+        # After the retention policies were changed, the next step runs retention_delay seconds after the last change
+        # instead of at the next hourly run, so that a value which is still being edited deletes nothing.
+        self.retention.postpone(self.retention_delay)
+        if self.is_alive():
+            self.queue.put(('retention', None))
+
+    def flush(self, timeout=5):
+        if not self.is_alive():
+            return
+        flushed = threading.Event()
+        self.queue.put(('flush', flushed))
+        flushed.wait(timeout)
+
+    def stop(self, timeout=5):
+        with self.start_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        if self.is_alive():
+            self.queue.put(('stop', None))
+            self.thread.join(timeout)
+
+    def read_statistics(self):
+        with self.statistics_lock:
+            statistics = dict(self.statistics)
+        statistics['queue_depth'] = self.queue.qsize()
+        statistics.update(self.retention.read_statistics())
+        return statistics
+
+    def record_error(self, database, exception):
+        # A failed statement may leave a transaction or an attached archive behind, the next write starts on a new
+        # connection.
+        with self.statistics_lock:
+            self.statistics['errors'] += 1
+            self.statistics['last_error'] = str(exception)
+        try:
+            if database.history_db is not None:
+                database.history_db.rollback()
+            connection_manager.discard_connection(database.history_db_path)
+        except sqlite3.Error:
+            pass
+
+    def write_pending(self, database, visits, downloads):
+        # Returns False if the records could not be written, they stay in visits and downloads then.
+        if not visits and not downloads:
+            return True
+
+        start = time.perf_counter()
+        try:
+            database.insert_history_batch(visits, downloads)
+        except sqlite3.Error as exception:
+            self.record_error(database, exception)
+            return False
+        latency = (time.perf_counter() - start) * 1000
+
+        with self.statistics_lock:
+            self.statistics['written'] += len(visits) + len(downloads)
+            self.statistics['flushes'] += 1
+            self.statistics['last_flush_latency'] = latency
+            self.statistics['max_flush_latency'] = max(self.statistics['max_flush_latency'], latency)
+            self.statistics['total_flush_latency'] += latency
+
+        visits.clear()
+        downloads.clear()
+        return True
+
+    def run(self):
+        database = Database()
+        visits = []
+        downloads = []
+        deadline = None
+        retry_time = 0
+
+        while True:
+            wake_up = self.retention.next_run
+            if deadline is not None:
+                wake_up = min(deadline, wake_up)
+            timeout = max(wake_up - time.monotonic(), 0)
+
+            try:
+                kind, data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, data = 'timeout', None
+
+            if kind == 'visit':
+                # A page often changes its title several times right after loading, only the last title and time are
+                # kept. The visit stays typed if any of its records was.
+                if visits and visits[-1][0] == data[0]:
+                    url, page_title, visit_time, transition = data
+                    if visits[-1][3] == TRANSITION_TYPED:
+                        transition = TRANSITION_TYPED
+                    visits[-1] = (url, page_title or visits[-1][1], visit_time, transition)
+                    with self.statistics_lock:
+                        self.statistics['coalesced'] += 1
+                else:
+                    visits.append(data)
+            elif kind == 'download':
+                downloads.append(data)
+
+            if (visits or downloads) and deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+
+            # After a failed write, a full batch waits for the retry instead of trying again with every record.
+            if kind in ['timeout', 'flush', 'stop'] or \
+                    len(visits) + len(downloads) >= self.flush_rows and time.monotonic() >= retry_time:
+                if self.write_pending(database, visits, downloads):
+                    deadline = None
+                else:
+                    retry_time = time.monotonic() + self.retry_interval
+                    deadline = retry_time
+
+            if kind == 'flush':
+                data.set()
+            if kind == 'stop':
+                break
+
+            if kind in ['timeout', 'retention'] and self.retention.is_due():
+                try:
+                    self.retention.run_step(database)
+                except sqlite3.Error as exception:
+                    self.record_error(database, exception)
+                    self.retention.postpone(self.retry_interval)
+
+        connection_manager.close_thread_connections()
+
+
+history_writer = HistoryWriter()
+
+
 class VisitsHistory:
     def __init__(self):
         super(VisitsHistory, self).__init__()
         self.database = Database()
 
-    def record_a_visit(self, page_title, web_view):
-        url = web_view.url().toString()
+    @staticmethod
+    def is_recorded(page_title, url):
         no_record = ['', 'about:blank', page_title, f'{page_title}/']
-        if url not in no_record:
-            self.database.insert_visits_history(url, page_title)
+        return url not in no_record
+
+    def record_a_visit(self, page_title, web_view, transition=TRANSITION_LINK):
+        url = web_view.url().toString()
+        if self.is_recorded(page_title, url):
+            history_writer.record_visit(url, page_title, transition)
 
     def read_history_urls(self):
         history_urls = self.database.read_history_urls()
@@ -213,4 +723,4 @@ class DownloadsHistory:
         file_name = download.downloadFileName()
         status = f'{download.state()}'
         reference_url = reference.url().toString()
-        self.database.insert_downloads_history(url, file_name, status, reference_url)
+        history_writer.record_download(url, file_name, status, reference_url)
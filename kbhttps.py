@@ -0,0 +1,220 @@
+import time
+import bisect
+import hashlib
+import ipaddress
+import threading
+from array import array
+
+from PySide6.QtCore import QUrl, QTimer
+from PySide6.QtWebEngineCore import QWebEngineUrlRequestInterceptor
+
+from kbdatabase import Database
+
+
+# Domains which only serve https, with their subdomains, like entries of the HSTS preload list with include_subdomains.
+# Whole top level domains of the list are included.
+PRELOADED_HTTPS_DOMAINS = [
+    'app', 'bank', 'day', 'dev', 'foo', 'insurance', 'new', 'page',
+    'dropbox.com', 'facebook.com', 'github.com', 'paypal.com', 'pypi.org', 'twitter.com', 'wikimedia.org',
+    'wikipedia.org',
+]
+
+
+class HostHashSet:
+    # Sorted 64-bit hashes of host names in an array, about 8 bytes per host, looked up with a binary search. A hash
+    # collision upgrades a host which was not meant to be, the odds are negligible for the few hosts a profile learns.
+    def __init__(self, hosts=()):
+        super(HostHashSet, self).__init__()
+
+        self.hashes = array('Q', sorted({self.host_hash(host) for host in hosts}))
+
+    @staticmethod
+    def host_hash(host):
+        return int.from_bytes(hashlib.blake2b(host.encode(), digest_size=8).digest(), 'little')
+
+    def __contains__(self, host):
+        host_hash = self.host_hash(host)
+        n = bisect.bisect_left(self.hashes, host_hash)
+        return n < len(self.hashes) and self.hashes[n] == host_hash
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, host):
+        host_hash = self.host_hash(host)
+        n = bisect.bisect_left(self.hashes, host_hash)
+        if n < len(self.hashes) and self.hashes[n] == host_hash:
+            return False
+        self.hashes.insert(n, host_hash)
+        return True
+
+    def discard(self, host):
+        host_hash = self.host_hash(host)
+        n = bisect.bisect_left(self.hashes, host_hash)
+        if n < len(self.hashes) and self.hashes[n] == host_hash:
+            del self.hashes[n]
+
+
+class HttpsUpgradeList:
+    # Hosts known to serve https: the preloaded domains with their subdomains, and hosts learned from pages which
+    # loaded over https, without their subdomains. Both are loaded on the first lookup.
+    def __init__(self, preloaded_domains=PRELOADED_HTTPS_DOMAINS):
+        super(HttpsUpgradeList, self).__init__()
+
+        self.preloaded_domains = preloaded_domains
+        self.database = Database()
+        self.lock = threading.Lock()
+
+        self.preloaded = None
+        self.learned = None
+        # Hosts which redirected back to http after an upgrade, never upgraded again in this session
+        self.excluded = set()
+        # Learned hosts which are not stored yet
+        self.pending_learned = list()
+
+    @staticmethod
+    def normalize_host(host):
+        # None for hosts which are never upgraded: IP addresses and names without a dot, like localhost.
+        host = host.lower().rstrip('.')
+        if '.' not in host:
+            return None
+        try:
+            ipaddress.ip_address(host.strip('[]'))
+        except ValueError:
+            return host
+        return None
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.learned is None:
+                self.preloaded = HostHashSet(self.preloaded_domains)
+                self.learned = HostHashSet(self.database.read_learned_https_hosts())
+
+    def is_known(self, host):
+        host = self.normalize_host(host)
+        if host is None or host in self.excluded:
+            return False
+
+        self.ensure_loaded()
+        if host in self.learned:
+            return True
+        labels = host.split('.')
+        return any('.'.join(labels[n:]) in self.preloaded for n in range(len(labels)))
+
+    def learn(self, host):
+        host = self.normalize_host(host)
+        if host is None or host in self.excluded or self.is_known(host):
+            return False
+
+        with self.lock:
+            self.learned.add(host)
+            self.pending_learned.append(host)
+        return True
+
+    def forget(self, host):
+        host = self.normalize_host(host)
+        if host is None:
+            return
+
+        self.ensure_loaded()
+        with self.lock:
+            self.excluded.add(host)
+            self.learned.discard(host)
+            if host in self.pending_learned:
+                self.pending_learned.remove(host)
+        self.database.delete_learned_https_host(host)
+
+    def save(self):
+        with self.lock:
+            hosts = self.pending_learned
+            self.pending_learned = list()
+        if hosts:
+            self.database.insert_learned_https_hosts(hosts)
+
+
+class HttpsUpgradeInterceptor(QWebEngineUrlRequestInterceptor):
+    # Redirects http requests to known https hosts to https before they go out, which saves the round trip of the
+    # redirect the server would answer with. Only requests on the default port are upgraded.
+    #
+    # An http url upgraded max_repeated_upgrades times within repeat_window seconds means that the server sends it back
+    # to http, its host is forgotten. Hits per host are added to the https_hosts table every save_interval.
+    #
+    # The interceptor of the off-the-record profile is created with is_learning=False and the upgrade list of the
+    # persistent one. It upgrades the same hosts, but learns, counts and forgets nothing, so that no host visited in
+    # private browsing is written to disk.
+    def __init__(self, max_repeated_upgrades=3, repeat_window=10, save_interval=60000, upgrade_list=None,
+                 is_learning=True):
+        super(HttpsUpgradeInterceptor, self).__init__()
+
+        self.max_repeated_upgrades = max_repeated_upgrades
+        self.repeat_window = repeat_window
+        self.is_learning = is_learning
+
+        self.upgrade_list = upgrade_list if upgrade_list is not None else HttpsUpgradeList()
+        self.database = Database()
+
+        self.hits = dict()
+        self.recent_upgrades = dict()
+        self.statistics = {'upgraded': 0, 'learned': 0, 'forgotten': 0}
+
+        self.save_timer = QTimer()
+        self.save_timer.setInterval(save_interval)
+        self.save_timer.timeout.connect(self.save)
+        if self.is_learning:
+            self.save_timer.start()
+
+    def interceptRequest(self, info):
+        url = info.requestUrl()
+        if url.scheme() != 'http' or url.port() not in [-1, 80] or not self.upgrade_list.is_known(url.host()):
+            return
+
+        if self.is_redirect_loop(url):
+            if self.is_learning:
+                self.upgrade_list.forget(url.host())
+                self.statistics['forgotten'] += 1
+            return
+
+        https_url = QUrl(url)
+        https_url.setScheme('https')
+        https_url.setPort(-1)
+        info.redirect(https_url)
+
+        self.statistics['upgraded'] += 1
+        if self.is_learning:
+            host = url.host().lower()
+            self.hits[host] = self.hits.get(host, 0) + 1
+
+    def is_redirect_loop(self, url):
+        now = time.monotonic()
+        if len(self.recent_upgrades) > 1000:
+            self.recent_upgrades = {key: value for key, value in self.recent_upgrades.items()
+                                    if now - value[0] < self.repeat_window}
+
+        web_address = url.toString()
+        first_time, count = self.recent_upgrades.get(web_address, (now, 0))
+        if now - first_time >= self.repeat_window:
+            first_time, count = now, 0
+        self.recent_upgrades[web_address] = (first_time, count + 1)
+        return count + 1 > self.max_repeated_upgrades
+
+    def learn(self, web_address):
+        # Called for pages which finished loading, hosts of pages loaded over https are upgraded from then on.
+        if self.is_learning and web_address.scheme() == 'https' and web_address.port() in [-1, 443]:
+            if self.upgrade_list.learn(web_address.host()):
+                self.statistics['learned'] += 1
+
+    def save(self):
+        if not self.is_learning:
+            return
+        self.upgrade_list.save()
+        hits = self.hits
+        self.hits = dict()
+        if hits:
+            self.database.add_https_host_hits(hits)
+
+    def read_statistics(self):
+        # Upgraded requests, each one a redirect saved, and the hits per host.
+        self.save()
+        statistics = dict(self.statistics)
+        statistics['hosts'] = self.database.read_https_host_hits()
+        return statistics
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import urllib.parse
+
+from kbdatabase import Database, TRANSITION_LINK, TRANSITION_TYPED
+
+
+class BrowserHistoryImporter:
+    # Imports the visits of a Chromium "History" or a Firefox "places.sqlite" database into kBrowser's history. The
+    # file is copied first, so that a running browser keeps its lock and the copy is read consistently.
+
+    # Chromium stores microseconds since 1601-01-01, Firefox and kBrowser since 1970-01-01.
+    chromium_epoch_offset = 11644473600 * 1000000
+    # Chromium's core transition type and Firefox's visit_type of typed visits.
+    chromium_typed = 1
+    firefox_typed = 2
+    skipped_schemes = ['', 'about', 'chrome', 'chrome-extension', 'chrome-search', 'edge', 'place', 'moz-extension',
+                       'javascript', 'data', 'blob', 'view-source']
+
+    def __init__(self, chunk_size=20000):
+        super(BrowserHistoryImporter, self).__init__()
+
+        self.chunk_size = chunk_size
+        self.database = Database()
+
+    @staticmethod
+    def snapshot(path, folder):
+        # Uncheckpointed changes of a running browser are in the -wal file next to the database.
+        snapshot_path = os.path.join(folder, 'history.sqlite')
+        shutil.copyfile(path, snapshot_path)
+        for suffix in ['-wal', '-journal']:
+            if os.path.exists(f'{path}{suffix}'):
+                shutil.copyfile(f'{path}{suffix}', f'{snapshot_path}{suffix}')
+        return snapshot_path
+
+    @staticmethod
+    def open_snapshot(snapshot_path):
+        uri = f'file:{urllib.parse.quote(snapshot_path)}?mode=ro'
+        return sqlite3.connect(uri, uri=True)
+
+    @staticmethod
+    def detect_browser(connection):
+        cursor = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {name for name, in cursor.fetchall()}
+        if {'moz_places', 'moz_historyvisits'} <= tables:
+            return 'firefox'
+        if {'urls', 'visits'} <= tables:
+            return 'chromium'
+        return None
+
+    def is_skipped(self, url):
+        if not url:
+            return True
+        scheme = url.split(':', 1)[0].lower() if ':' in url else ''
+        return scheme in self.skipped_schemes
+
+    def iter_chromium_visits(self, connection):
+        cursor = connection.execute(
+            '''SELECT urls.url, urls.title, visits.visit_time, visits.transition
+               FROM visits JOIN urls ON urls.id = visits.url ORDER BY visits.id'''
+        )
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            yield [(url, title or '', visit_time - self.chromium_epoch_offset,
+                    TRANSITION_TYPED if (transition or 0) & 0xFF == self.chromium_typed else TRANSITION_LINK)
+                   for url, title, visit_time, transition in rows if not self.is_skipped(url)]
+
+    def iter_firefox_visits(self, connection):
+        cursor = connection.execute(
+            '''SELECT moz_places.url, moz_places.title, moz_historyvisits.visit_date, moz_historyvisits.visit_type
+               FROM moz_historyvisits JOIN moz_places ON moz_places.id = moz_historyvisits.place_id
+               ORDER BY moz_historyvisits.id'''
+        )
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            yield [(url, title or '', visit_date or 0,
+                    TRANSITION_TYPED if visit_type == self.firefox_typed else TRANSITION_LINK)
+                   for url, title, visit_date, visit_type in rows if not self.is_skipped(url)]
+
+    def count_urls(self, connection, browser):
+        # Distinct visited urls which are imported, counted by the snapshot instead of in memory.
+        connection.create_function('kb_is_skipped', 1, self.is_skipped, deterministic=True)
+        if browser == 'chromium':
+            db_command = '''SELECT COUNT(*) FROM urls WHERE NOT kb_is_skipped(url)
+                            AND EXISTS (SELECT 1 FROM visits WHERE visits.url = urls.id)'''
+        else:
+            db_command = '''SELECT COUNT(*) FROM moz_places WHERE NOT kb_is_skipped(url) AND EXISTS
+                            (SELECT 1 FROM moz_historyvisits WHERE moz_historyvisits.place_id = moz_places.id)'''
+        return connection.execute(db_command).fetchone()[0]
+
+    def import_history(self, path, progress=None):
+        # Every chunk is written by insert_history_batch in one transaction, which also merges visits of urls that
+        # are already in the history. Visits already in the history with the same url and time are skipped, so that
+        # importing a file again adds nothing. Imported visits are not recorded as changes, e.g. in the sync log.
+        # progress(visits, visits_per_second) is called after every chunk.
+        start = time.perf_counter()
+        visits = 0
+        urls = 0
+
+        with tempfile.TemporaryDirectory(prefix='kbimport') as folder:
+            connection = self.open_snapshot(self.snapshot(path, folder))
+            try:
+                browser = self.detect_browser(connection)
+                if browser == 'chromium':
+                    chunks = self.iter_chromium_visits(connection)
+                elif browser == 'firefox':
+                    chunks = self.iter_firefox_visits(connection)
+                else:
+                    raise ValueError(f'{path} is not a Chromium or Firefox history database')
+
+                for chunk in chunks:
+                    if chunk:
+                        self.database.insert_history_batch(chunk, [], notify=False, skip_existing=True)
+                    visits += len(chunk)
+                    if progress:
+                        progress(visits, int(visits / max(time.perf_counter() - start, 0.001)))
+                urls = self.count_urls(connection, browser)
+            finally:
+                connection.close()
+
+        seconds = time.perf_counter() - start
+        statistics = {'browser': browser, 'visits': visits, 'urls': urls, 'seconds': seconds,
+                      'visits_per_second': visits / max(seconds, 0.001)}
+        return statistics
@@ -33,6 +33,16 @@ class LangEnUS:
         self.lang_clear_downloads_history = 'Clear Downloads History'
         self.lang_visits_history = 'Visits History'
         self.lang_downloads_history = 'Downloads History'
+        self.lang_search_history = 'Search visited pages by title or url'
+        self.lang_export = 'Export'
+        self.lang_import = 'Import'
+        self.lang_history_files = 'JSON Lines (*.jsonl *.jsonl.gz);;CSV (*.csv *.csv.gz)'
+        self.lang_history_transfer_running = 'Rows processed:'
+        self.lang_history_transfer_done = 'Finished. Rows processed: '
+        self.lang_history_transfer_failed = 'Failed: '
+        self.lang_import_from_browser = 'Import from Chromium/Firefox'
+        self.lang_browser_history_files = 'Browser history (History places.sqlite);;All files (*)'
+        self.lang_rows_per_second = 'rows/s'
 
         # Terms in kbprivacy
         self.lang_accept_once = 'Accept once'
@@ -59,9 +69,17 @@ class LangEnUS:
         self.lang_private_browsing = 'Private browsing'
         self.lang_new_setting_effective_note = 'New setting will be applied in a new tab.'
         self.lang_https_mode = 'SSL mode'
+        self.lang_preload_suggestions = 'Preload the best address bar suggestion'
+        self.lang_tab_freeze_after_minutes = 'Freeze background tabs after (minutes)'
+        self.lang_tab_memory_budget_mb = 'Discard background tabs when tabs use more than (MB)'
+        self.lang_tab_min_available_mb = 'Discard background tabs when available memory is below (MB)'
         self.lang_download_folder = 'Download folder'
         self.lang_choose_download_folder = 'Choose a folder for saving downloads'
         self.lang_search_engine = 'Search engine'
+        self.lang_no_limit = 'No limit'
+        self.lang_history_max_age_days = 'Delete visits older than (days)'
+        self.lang_history_max_rows = 'Maximum number of visits kept'
+        self.lang_history_dedupe_after_days = 'Keep only the latest visit of a page after (days)'
 
         self.lang_certificates = 'Certificates'
         self.lang_ask_every_time_invalid_certificate = 'Ask every time when a site has an invalid certificate'
@@ -108,6 +126,17 @@ class LangEnUS:
         self.lang_sites_no_desktop_audio_video_capture = 'Sites without the permission of ' \
                                                          'desktop audio and video capture'
 
-
-
-
+        # Terms in kbtaskmanager
+        self.lang_task_manager = 'Task Manager'
+        self.lang_tab = 'Tab'
+        self.lang_process_id = 'Process ID'
+        self.lang_memory_mb = 'Memory (MB)'
+        self.lang_cpu_percent = 'CPU %'
+        self.lang_threads = 'Threads'
+        self.lang_state = 'State'
+        self.lang_browser_process = 'Browser'
+        self.lang_active = 'Active'
+        self.lang_frozen = 'Frozen'
+        self.lang_discarded = 'Discarded'
+        self.lang_end_process = 'End process'
+        self.lang_discard_tab = 'Discard tab'
@@ -0,0 +1,252 @@
+import os
+import re
+import marshal
+import ipaddress
+import urllib.parse
+
+from kbdatabase import Database
+from kbsettingshandler import SettingsStore
+
+
+INPUT_URL = 'url'
+INPUT_SEARCH = 'search'
+
+# Schemes which are loaded as typed.
+KNOWN_SCHEMES = ['http', 'https', 'file', 'ftp', 'about', 'data', 'blob', 'view-source', 'chrome', 'qrc']
+
+# Used when the system has no public suffix list, the suffixes of most visited sites.
+FALLBACK_PUBLIC_SUFFIXES = [
+    'com', 'org', 'net', 'edu', 'gov', 'mil', 'int', 'info', 'biz', 'name', 'pro', 'mobi', 'io', 'ai', 'app', 'dev',
+    'me', 'tv', 'cc', 'co', 'xyz', 'online', 'site', 'tech', 'blog', 'shop', 'cloud', 'page',
+    'us', 'ca', 'mx', 'br', 'ar', 'uk', 'ie', 'de', 'fr', 'es', 'pt', 'it', 'nl', 'be', 'lu', 'ch', 'at', 'dk', 'se',
+    'no', 'fi', 'is', 'pl', 'cz', 'sk', 'hu', 'ro', 'bg', 'gr', 'tr', 'ru', 'ua', 'by', 'kz', 'il', 'ae', 'sa', 'in',
+    'pk', 'cn', 'hk', 'tw', 'jp', 'kr', 'sg', 'my', 'th', 'vn', 'id', 'ph', 'au', 'nz', 'za', 'eg', 'ng', 'ke', 'eu',
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'com.cn', 'net.cn', 'org.cn', 'com.hk', 'com.tw', 'co.jp', 'ne.jp', 'or.jp',
+    'co.kr', 'com.au', 'net.au', 'org.au', 'co.nz', 'com.br', 'com.mx', 'co.in', 'co.za', 'com.sg', 'com.tr',
+    'github.io', 'gitlab.io', 'blogspot.com', 'herokuapp.com', 'netlify.app', 'vercel.app', 'pages.dev',
+]
+
+
+class PublicSuffixTrie:
+    # Rules of the public suffix list in a trie of nested dicts keyed by labels from the right, a node with the key
+    # '' ends a rule. Wildcard rules have a '*' child and exception rules a '!<label>' child. The trie is built from the
+    # text list once and kept as a marshal blob in the profile, which loads several times faster than parsing the list.
+    system_list_path = '/usr/share/publicsuffix/public_suffix_list.dat'
+    cache_version = 1
+
+    def __init__(self, cache_path=None, list_path=None):
+        super(PublicSuffixTrie, self).__init__()
+
+        self.cache_path = cache_path
+        self.list_path = list_path or self.system_list_path
+        self.trie = None
+
+    def read_list_signature(self):
+        try:
+            list_stat = os.stat(self.list_path)
+        except OSError:
+            return None
+        return self.list_path, list_stat.st_mtime_ns, list_stat.st_size
+
+    def read_cache(self, list_signature):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                cache_version, cached_signature, trie = marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if cache_version != self.cache_version or cached_signature != list_signature:
+            return None
+        return trie
+
+    def write_cache(self, list_signature, trie):
+        if self.cache_path is None:
+            return
+        temporary_path = f'{self.cache_path}.tmp'
+        try:
+            with open(temporary_path, 'wb') as cache_file:
+                marshal.dump((self.cache_version, list_signature, trie), cache_file)
+            os.replace(temporary_path, self.cache_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def read_rules(list_path):
+        rules = list()
+        with open(list_path, encoding='utf-8') as list_file:
+            for line in list_file:
+                line = line.strip()
+                if line and not line.startswith('//'):
+                    rules.append(line.split()[0].lower())
+        return rules
+
+    @staticmethod
+    def build_trie(rules):
+        # Internationalized rules are added in Unicode and in Punycode, hosts may be typed either way.
+        trie = dict()
+        for rule in rules:
+            forms = [rule]
+            try:
+                ascii_rule = '.'.join(label if label in ['*'] or label.startswith('!') else label.encode('idna').decode()
+                                      for label in rule.split('.'))
+                if ascii_rule != rule:
+                    forms.append(ascii_rule)
+            except UnicodeError:
+                pass
+
+            for form in forms:
+                node = trie
+                for label in reversed(form.split('.')):
+                    node = node.setdefault(label, dict())
+                node[''] = 1
+        return trie
+
+    def load(self):
+        list_signature = self.read_list_signature()
+        if list_signature is None:
+            self.trie = self.build_trie(FALLBACK_PUBLIC_SUFFIXES)
+            return
+
+        trie = self.read_cache(list_signature)
+        if trie is None:
+            try:
+                trie = self.build_trie(self.read_rules(self.list_path))
+            except (OSError, UnicodeError):
+                self.trie = self.build_trie(FALLBACK_PUBLIC_SUFFIXES)
+                return
+            self.write_cache(list_signature, trie)
+        self.trie = trie
+
+    def public_suffix_length(self, labels):
+        # Number of labels of the longest public suffix of a host given as its labels, 0 when no rule matches. The
+        # implicit "*" rule of the list is left out, so unknown top level domains are not suffixes.
+        if self.trie is None:
+            self.load()
+
+        node = self.trie
+        length = 0
+        for n, label in enumerate(reversed(labels)):
+            if f'!{label}' in node:
+                return n
+            child = node.get(label)
+            if child is None:
+                child = node.get('*')
+            if child is None:
+                break
+            node = child
+            if '' in node:
+                length = n + 1
+        return length
+
+
+class OmniboxClassifier:
+    # Decides whether the text of the address bar is a url to load or a search:
+    #     a known scheme, host:port, IP addresses and localhost are urls,
+    #     text with whitespace is a search,
+    #     a host with a label before its public suffix, e.g. example.com or user.github.io, is a url, a bare public
+    #     suffix like co.uk and file.tar.gz are searches,
+    #     any other host is a url only if it was visited before, e.g. intranet, intranet/wiki or nas.lan, so that
+    #     and/or is a search.
+    # Settings are read from the shared settings store and the public suffix trie is loaded on the first use.
+    scheme_pattern = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):(.*)$', re.DOTALL)
+    separator_pattern = re.compile(r'[/?#]')
+    host_pattern = re.compile(r'^[a-z0-9\-_~%\u0080-\U0010ffff]+(\.[a-z0-9\-_~%\u0080-\U0010ffff]+)*\.?$')
+
+    def __init__(self):
+        super(OmniboxClassifier, self).__init__()
+
+        self.database = Database()
+        self.settings_store = SettingsStore.shared()
+        self.public_suffix_trie = PublicSuffixTrie(
+            os.path.join(self.database.custom_profile_path, 'public_suffix_list.cache')
+        )
+
+    @staticmethod
+    def split_host_port(authority):
+        # (host, port) of host, host:port, [IPv6] or [IPv6]:port, None when the text after ':' is not a port.
+        if authority.startswith('['):
+            host, bracket, rest = authority[1:].partition(']')
+            if not bracket or (rest and not rest.startswith(':')):
+                return None
+            port = rest[1:] if rest else ''
+        else:
+            host, _, port = authority.partition(':')
+
+        if port and (not port.isdigit() or int(port) > 65535):
+            return None
+        return host, port
+
+    @staticmethod
+    def is_ip_address(host):
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def is_loopback(host):
+        if host == 'localhost' or host.endswith('.localhost'):
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    def split_input(self, text):
+        # (kind, scheme, host) of the stripped text of the address bar.
+        match = self.scheme_pattern.match(text)
+        if match is not None and match.group(1).lower() in KNOWN_SCHEMES:
+            return INPUT_URL, match.group(1).lower(), urllib.parse.urlsplit(text).hostname or ''
+
+        if not text or any(character.isspace() for character in text):
+            return INPUT_SEARCH, None, None
+
+        separator_match = self.separator_pattern.search(text)
+        authority = text if separator_match is None else text[:separator_match.start()]
+        if '@' in authority:
+            return INPUT_SEARCH, None, None
+        host_port = self.split_host_port(authority)
+        if host_port is None:
+            return INPUT_SEARCH, None, None
+        host, port = host_port
+        host = host.lower()
+
+        if self.is_ip_address(host) or host == 'localhost' or host.endswith('.localhost'):
+            return INPUT_URL, None, host
+        if not self.host_pattern.match(host):
+            return INPUT_SEARCH, None, None
+        if port:
+            return INPUT_URL, None, host
+
+        labels = host.rstrip('.').split('.')
+        if len(labels) > 1 and 0 < self.public_suffix_trie.public_suffix_length(labels) < len(labels):
+            return INPUT_URL, None, host
+
+        if self.database.is_host_visited(host):
+            return INPUT_URL, None, host
+        return INPUT_SEARCH, None, None
+
+    def classify(self, text):
+        kind, _, _ = self.split_input(text.strip())
+        return kind
+
+    def resolve(self, text):
+        # The address to load for the text. With the https mode enabled http is upgraded to https, except for loopback
+        # hosts, which rarely serve https and are not exposed to the network anyway.
+        text = text.strip()
+        if text == 'about:blank':
+            return ''
+
+        kind, scheme, host = self.split_input(text)
+        if kind == INPUT_SEARCH:
+            _, search_engine_url = self.settings_store.read_enabled_search_engine()
+            return f'{search_engine_url}{urllib.parse.quote_plus(text)}'
+
+        https_mode = self.settings_store.read_basic_setting('https_mode') == '1' and not self.is_loopback(host)
+        if scheme is None:
+            return f'https://{text}' if https_mode else f'http://{text}'
+        if scheme == 'http' and https_mode:
+            return f'https:{text[len(scheme) + 1:]}'
+        return text
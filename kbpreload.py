@@ -0,0 +1,123 @@
+import time
+
+from PySide6.QtCore import QObject, QUrl, QTimer
+from PySide6.QtWebEngineCore import QWebEnginePage
+
+from kbprocess import read_rss_mb, read_available_memory_mb
+
+
+class SpeculativePreloader(QObject):
+    # Loads the best suggestion of the address bar in a hidden page while the user is still typing, when it is the only
+    # likely match: its frecency is at least min_frecency and a confidence_threshold share of the frecency of all shown
+    # suggestions. If Enter then loads the same url, MainWindow adopts the page into the current tab, which starts with
+    # the navigation history of the preloaded page.
+    #
+    # The preload is cancelled when the best suggestion changes or falls under the threshold, when the current tab
+    # changes, when it fails, and when its render process grows beyond memory_cap_mb. No preload starts while the system
+    # has less than memory_cap_mb available.
+    #     hits: loads from the address bar which adopted the preloaded page
+    #     misses: loads from the address bar without a preloaded page of their url
+    #     wasted: preloads discarded without being adopted
+    #     saved_ms: load time already spent on the adopted pages, which the user did not have to wait for
+    def __init__(self, confidence_threshold=0.6, min_frecency=2.0, memory_cap_mb=256):
+        super(SpeculativePreloader, self).__init__()
+
+        self.confidence_threshold = confidence_threshold
+        self.min_frecency = min_frecency
+        self.memory_cap_mb = memory_cap_mb
+
+        self.page = None
+        self.url = None
+        self.start_time = 0.0
+        # Seconds the preload took, None while it still loads
+        self.load_time = None
+
+        self.statistics = {'hits': 0, 'misses': 0, 'wasted': 0, 'saved_ms': 0.0}
+
+        self.memory_timer = QTimer()
+        self.memory_timer.setInterval(1000)
+        self.memory_timer.timeout.connect(self.check_memory)
+
+    def is_confident(self, suggestions, frecencies):
+        if not suggestions or QUrl(suggestions[0][0]).scheme() not in ['http', 'https']:
+            return False
+        return frecencies[0] >= self.min_frecency and frecencies[0] >= self.confidence_threshold * sum(frecencies)
+
+    def suggest(self, suggestions, frecencies, profile):
+        # Called with the suggestions shown for every new text of the address bar.
+        if not self.is_confident(suggestions, frecencies):
+            self.cancel()
+            return
+
+        url = suggestions[0][0]
+        if url == self.url:
+            return
+        self.cancel()
+
+        available_memory = read_available_memory_mb()
+        if available_memory is not None and available_memory < self.memory_cap_mb:
+            return
+
+        self.page = QWebEnginePage(profile)
+        self.page.setAudioMuted(True)
+        self.page.loadFinished.connect(lambda ok, page=self.page: self.preload_finished(ok, page))
+        self.url = url
+        self.start_time = time.perf_counter()
+        self.load_time = None
+        self.page.load(QUrl(url))
+        self.memory_timer.start()
+
+    def preload_finished(self, ok, page):
+        if page is not self.page or self.load_time is not None:
+            return
+        if not ok:
+            self.cancel()
+            return
+        self.load_time = time.perf_counter() - self.start_time
+
+    def check_memory(self):
+        if self.page is None:
+            self.memory_timer.stop()
+            return
+        rss = read_rss_mb(self.page.renderProcessPid())
+        if rss is not None and rss > self.memory_cap_mb:
+            self.cancel()
+
+    def matches(self, web_address):
+        preloaded_url = QUrl(self.url).adjusted(QUrl.StripTrailingSlash)
+        return preloaded_url == QUrl(web_address).adjusted(QUrl.StripTrailingSlash)
+
+    def take(self, web_address):
+        # The preloaded page if it has the url of web_address, it is then owned by the caller. Otherwise the preload is
+        # cancelled and None is returned.
+        if self.page is None or not self.matches(web_address):
+            self.statistics['misses'] += 1
+            self.cancel()
+            return None
+
+        page = self.page
+        if self.load_time is None:
+            self.statistics['saved_ms'] += (time.perf_counter() - self.start_time) * 1000
+        else:
+            self.statistics['saved_ms'] += self.load_time * 1000
+        self.statistics['hits'] += 1
+
+        self.page = None
+        self.url = None
+        self.memory_timer.stop()
+        page.setAudioMuted(False)
+        return page
+
+    def cancel(self):
+        if self.page is None:
+            return
+        self.page.deleteLater()
+        self.page = None
+        self.url = None
+        self.memory_timer.stop()
+        self.statistics['wasted'] += 1
+
+    def read_statistics(self):
+        statistics = dict(self.statistics)
+        statistics['preloading'] = self.url
+        return statistics
@@ -34,6 +34,7 @@ class CertificatesHandler:
     def __init__(self):
         super(CertificatesHandler, self).__init__()
         self.LangSetting = LangSetting()
+        self.certificates_permissions = CertificatesPermissions()
         self.permission_dialog = None
 
     def cert_handling(self, error):
@@ -41,20 +42,17 @@ class CertificatesHandler:
 
         url = error.url()
 
-        permission_status, permission_accept_list, permission_reject_list = \
-            CertificatesPermissions().read_permission("Certificates")
+        permission_status = self.certificates_permissions.read_permission_status("Certificates")
         if permission_status == "No":
             return
         else:
             check_permission_list = None
-            if permission_accept_list:
-                if url.toString() in permission_accept_list:
-                    error.acceptCertificate()
-                    check_permission_list = 'Done'
-            if permission_reject_list:
-                if url.toString() in permission_reject_list:
-                    error.rejectCertificate()
-                    check_permission_list = 'Done'
+            if self.certificates_permissions.is_accepted("Certificates", url.toString()):
+                error.acceptCertificate()
+                check_permission_list = 'Done'
+            elif self.certificates_permissions.is_rejected("Certificates", url.toString()):
+                error.rejectCertificate()
+                check_permission_list = 'Done'
 
             if check_permission_list is None:
                 title = self.LangSetting.language.lang_invalid_certificate
@@ -72,12 +70,12 @@ class CertificatesHandler:
                     self.permission_dialog.close()
                 ))
                 self.permission_dialog.always_accept_button.clicked.connect(lambda: (
-                    CertificatesPermissions().accept_permission("Certificates", url.toString()),
+                    self.certificates_permissions.accept_permission("Certificates", url.toString()),
                     error.acceptCertificate(),
                     self.permission_dialog.close()
                 ))
                 self.permission_dialog.always_reject_button.clicked.connect(lambda: (
-                    CertificatesPermissions().reject_permission("Certificates", url.toString()),
+                    self.certificates_permissions.reject_permission("Certificates", url.toString()),
                     error.rejectCertificate(),
                     self.permission_dialog.close()
                 ))
@@ -89,29 +87,27 @@ class PermissionsHandler:
     def __init__(self):
         super(PermissionsHandler, self).__init__()
         self.LangSetting = LangSetting()
+        self.certificates_permissions = CertificatesPermissions()
         self.permission_dialog = None
 
     def permission_handling(self, url, permission, web_view):
         permission_type = f'{permission}'.split('.')
         permission_type = permission_type[4]
-        permission_status, permission_accept_list, permission_reject_list = \
-            CertificatesPermissions().read_permission(permission_type)
+        permission_status = self.certificates_permissions.read_permission_status(permission_type)
         if permission_status == "No":
             return
         else:
             check_permission_list = None
-            if permission_accept_list:
-                if url.toString() in permission_accept_list:
-                    web_view.page().setFeaturePermission(
-                        url, permission, QWebEnginePage.PermissionGrantedByUser
-                    )
-                    check_permission_list = 'Done'
-            if permission_reject_list:
-                if url.toString() in permission_reject_list:
-                    web_view.page().setFeaturePermission(
-                        url, permission, QWebEnginePage.PermissionDeniedByUser
-                    )
-                    check_permission_list = 'Done'
+            if self.certificates_permissions.is_accepted(permission_type, url.toString()):
+                web_view.page().setFeaturePermission(
+                    url, permission, QWebEnginePage.PermissionGrantedByUser
+                )
+                check_permission_list = 'Done'
+            elif self.certificates_permissions.is_rejected(permission_type, url.toString()):
+                web_view.page().setFeaturePermission(
+                    url, permission, QWebEnginePage.PermissionDeniedByUser
+                )
+                check_permission_list = 'Done'
 
             if check_permission_list is None:
                 title = self.LangSetting.language.lang_permission_requested
@@ -130,13 +126,13 @@ class PermissionsHandler:
                     self.permission_dialog.close()
                 ))
                 self.permission_dialog.always_accept_button.clicked.connect(lambda: (
-                    CertificatesPermissions().accept_permission(permission_type, url.toString()),
+                    self.certificates_permissions.accept_permission(permission_type, url.toString()),
                     web_view.page().setFeaturePermission(
                         url, permission, QWebEnginePage.PermissionGrantedByUser),
                     self.permission_dialog.close()
                 ))
                 self.permission_dialog.always_reject_button.clicked.connect(lambda: (
-                    CertificatesPermissions().reject_permission(permission_type, url.toString()),
+                    self.certificates_permissions.reject_permission(permission_type, url.toString()),
                     web_view.page().setFeaturePermission(
                         url, permission, QWebEnginePage.PermissionDeniedByUser),
                     self.permission_dialog.close()
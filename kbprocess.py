@@ -0,0 +1,56 @@
+# Readers of /proc on Linux. They return None on other systems and for processes which are gone.
+
+
+def read_proc_fields(path):
+    # "Name:   value unit" lines of /proc/meminfo and /proc/<pid>/status, values in kB as ints.
+    fields = dict()
+    try:
+        with open(path, encoding='utf-8') as proc_file:
+            for line in proc_file:
+                name, _, value = line.partition(':')
+                value = value.split()
+                if value and value[0].isdigit():
+                    fields[name] = int(value[0])
+    except OSError:
+        return None
+    return fields
+
+
+def read_rss_mb(pid):
+    if not pid:
+        return None
+    status = read_proc_fields(f'/proc/{pid}/status')
+    if status is None or 'VmRSS' not in status:
+        return None
+    return status['VmRSS'] / 1024
+
+
+def read_available_memory_mb():
+    meminfo = read_proc_fields('/proc/meminfo')
+    if meminfo is None or 'MemAvailable' not in meminfo:
+        return None
+    return meminfo['MemAvailable'] / 1024
+
+
+def read_cpu_ticks(pid):
+    # User and system CPU time of a process in clock ticks, from /proc/<pid>/stat. The name of the process in
+    # parentheses may contain spaces, so the fields are counted from its closing parenthesis.
+    if not pid:
+        return None
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8') as stat_file:
+            stat = stat_file.read()
+        fields = stat[stat.rindex(')') + 2:].split()
+        return int(fields[11]) + int(fields[12])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_process_status(pid):
+    # (RSS in MB, number of threads) from /proc/<pid>/status.
+    if not pid:
+        return None
+    status = read_proc_fields(f'/proc/{pid}/status')
+    if status is None or 'VmRSS' not in status:
+        return None
+    return status['VmRSS'] / 1024, status.get('Threads', 0)
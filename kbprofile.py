@@ -0,0 +1,74 @@
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtWidgets import QApplication
+from PySide6.QtWebEngineCore import QWebEngineProfile
+
+from kbsettingshandler import SettingsStore, BasicSettings, LangSetting
+
+
+class ProfileManager(QObject):
+    # The persistent profile and the off-the-record profile of private browsing, created and configured once on first
+    # use and shared by every tab, so that tabs share network and cache state. They are children of the application
+    # and outlive every page using them.
+    #
+    # Downloads of both profiles are sent through download_requested once, whichever tab requested them. Changes of
+    # the download folder and the preferred language apply to both profiles at once.
+    download_requested = Signal(object)
+
+    def __init__(self, url_request_interceptor=None, off_the_record_url_request_interceptor=None):
+        super(ProfileManager, self).__init__(QApplication.instance())
+
+        self.url_request_interceptor = url_request_interceptor
+        # The off-the-record profile has its own interceptor, which stores nothing about the requests it sees.
+        self.off_the_record_url_request_interceptor = off_the_record_url_request_interceptor
+        self.basic_settings = BasicSettings()
+        self.LangSetting = LangSetting()
+        self.settings_store = SettingsStore.shared()
+
+        self.persistent_profile = None
+        self.off_the_record_profile = None
+
+        self.settings_store.setting_changed.connect(self.setting_changed)
+
+    def configure_profile(self, profile, url_request_interceptor):
+        profile.setDownloadPath(self.basic_settings.read_download_folder())
+        http_language_code, _, _ = self.LangSetting.read_preferred_language_setting()
+        profile.setHttpAcceptLanguage(http_language_code)
+
+        # Requests to hosts known to serve https are upgraded before they go out.
+        if url_request_interceptor is not None:
+            profile.setUrlRequestInterceptor(url_request_interceptor)
+
+        profile.downloadRequested.connect(self.download_requested)
+
+    def read_persistent_profile(self):
+        if self.persistent_profile is None:
+            self.persistent_profile = QWebEngineProfile('kBrowser', self)
+            cache_path, storage_path = self.basic_settings.read_cache_storage_path()
+            self.persistent_profile.setCachePath(cache_path)
+            self.persistent_profile.setPersistentStoragePath(storage_path)
+            self.configure_profile(self.persistent_profile, self.url_request_interceptor)
+        return self.persistent_profile
+
+    def read_off_the_record_profile(self):
+        if self.off_the_record_profile is None:
+            self.off_the_record_profile = QWebEngineProfile(self)
+            self.configure_profile(self.off_the_record_profile, self.off_the_record_url_request_interceptor)
+        return self.off_the_record_profile
+
+    def read_profile(self):
+        # The profile for a new tab, private browsing applies to tabs opened after it was changed.
+        private_browsing_status = self.basic_settings.read_private_browsing()
+        if private_browsing_status == self.LangSetting.language.lang_no:
+            return self.read_persistent_profile()
+        return self.read_off_the_record_profile()
+
+    def read_profiles(self):
+        return [profile for profile in [self.persistent_profile, self.off_the_record_profile] if profile is not None]
+
+    def setting_changed(self, item, value):
+        if item == 'download_folder':
+            for profile in self.read_profiles():
+                profile.setDownloadPath(value)
+        elif item == 'preferred_language':
+            for profile in self.read_profiles():
+                profile.setHttpAcceptLanguage(value)
@@ -0,0 +1,68 @@
+from PySide6.QtCore import QUrl, QByteArray, QDataStream, QIODevice
+from PySide6.QtWidgets import QWidget
+
+from kbdatabase import Database
+
+
+class SessionTab(QWidget):
+    # Placeholder of a restored tab. It has no web view and loads nothing until the tab is activated for the first
+    # time, then MainWindow replaces it with a web view built from the stored url and navigation history.
+    def __init__(self, web_address, page_title, history):
+        super(SessionTab, self).__init__()
+
+        self.web_address = web_address
+        self.page_title = page_title
+        self.history = history
+
+    def url(self):
+        return QUrl(self.web_address)
+
+
+class SessionManager:
+    def __init__(self):
+        super(SessionManager, self).__init__()
+
+        self.database = Database()
+        self.last_session_tabs = None
+
+    @staticmethod
+    def serialize_history(web_view):
+        # Older bindings lack the QDataStream operators of QWebEngineHistory, then a tab is restored by its url only.
+        history = QByteArray()
+        stream = QDataStream(history, QIODevice.WriteOnly)
+        try:
+            stream << web_view.history()
+        except TypeError:
+            return None
+        return bytes(history.data())
+
+    @staticmethod
+    def restore_history(web_view, history):
+        # Restoring the history also loads its current page.
+        stream = QDataStream(QByteArray(history), QIODevice.ReadOnly)
+        try:
+            stream >> web_view.history()
+        except TypeError:
+            return False
+        return True
+
+    def read_session(self):
+        session_tabs = self.database.read_session_tabs()
+        return session_tabs
+
+    def save_session(self, tabs):
+        # Tabs which are still placeholders keep their stored state. The session is only written when it changed
+        # since the last save.
+        session_tabs = list()
+        current_index = tabs.currentIndex()
+        for n in range(tabs.count()):
+            widget = tabs.widget(n)
+            current = int(n == current_index)
+            if isinstance(widget, SessionTab):
+                session_tabs.append((widget.web_address, widget.page_title, widget.history, current))
+            else:
+                session_tabs.append((widget.url().toString(), tabs.tabText(n), self.serialize_history(widget), current))
+
+        if session_tabs != self.last_session_tabs:
+            self.database.replace_session_tabs(session_tabs)
+            self.last_session_tabs = session_tabs
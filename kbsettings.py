@@ -1,9 +1,10 @@
 from PySide6.QtCore import Qt, QDir, Signal
 from PySide6.QtGui import QAction, QFont
 from PySide6.QtWidgets import (QWidget, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout, QTabWidget,
-                               QDialog, QLabel, QStyle, QComboBox, QFileDialog, QScrollArea)
+                               QDialog, QLabel, QStyle, QComboBox, QFileDialog, QScrollArea, QSpinBox)
 
 from kbsettingshandler import BasicSettings, SearchEngines, CertificatesPermissions, LangSetting
+from kbhistory import history_writer
 
 
 class Settings(QDialog):
@@ -41,6 +42,7 @@ class Settings(QDialog):
 
         private_browsing_status = self.BasicSettings.read_private_browsing()
         https_mode_status = self.BasicSettings.read_https_mode()
+        preload_suggestions_status = self.BasicSettings.read_preload_suggestions()
         download_folder_path = self.BasicSettings.read_download_folder()
 
         yes_or_no = [self.LangSetting.language.lang_yes, self.LangSetting.language.lang_no]
@@ -57,6 +59,27 @@ class Settings(QDialog):
         self.https_mode.addItems(yes_or_no)
         self.https_mode.setCurrentText(https_mode_status)
 
+        self.preload_suggestions_label = QLabel(self.LangSetting.language.lang_preload_suggestions)
+        self.preload_suggestions_label.setFont(font_title)
+        self.preload_suggestions = QComboBox()
+        self.preload_suggestions.addItems(yes_or_no)
+        self.preload_suggestions.setCurrentText(preload_suggestions_status)
+
+        # Tab lifecycle limits, 0 means no limit.
+        freeze_after_minutes, memory_budget_mb, min_available_mb = self.BasicSettings.read_tab_lifecycle()
+
+        self.tab_freeze_after_minutes_label = QLabel(self.LangSetting.language.lang_tab_freeze_after_minutes)
+        self.tab_freeze_after_minutes_label.setFont(font_title)
+        self.tab_freeze_after_minutes = self.create_limit_box(freeze_after_minutes, 10080)
+
+        self.tab_memory_budget_mb_label = QLabel(self.LangSetting.language.lang_tab_memory_budget_mb)
+        self.tab_memory_budget_mb_label.setFont(font_title)
+        self.tab_memory_budget_mb = self.create_limit_box(memory_budget_mb, 1048576)
+
+        self.tab_min_available_mb_label = QLabel(self.LangSetting.language.lang_tab_min_available_mb)
+        self.tab_min_available_mb_label.setFont(font_title)
+        self.tab_min_available_mb = self.create_limit_box(min_available_mb, 1048576)
+
         self.download_folder_label = QLabel(self.LangSetting.language.lang_download_folder)
         self.download_folder_label.setFont(font_title)
         self.download_folder = QLineEdit()
@@ -76,6 +99,21 @@ class Settings(QDialog):
         self.search_engine.addItems(search_engines_list)
         self.search_engine.setCurrentText(enabled_search_engine)
 
+        # History retention policies, 0 means no limit.
+        max_age_days, max_rows, dedupe_after_days = self.BasicSettings.read_history_retention()
+
+        self.history_max_age_days_label = QLabel(self.LangSetting.language.lang_history_max_age_days)
+        self.history_max_age_days_label.setFont(font_title)
+        self.history_max_age_days = self.create_limit_box(max_age_days, 36500)
+
+        self.history_max_rows_label = QLabel(self.LangSetting.language.lang_history_max_rows)
+        self.history_max_rows_label.setFont(font_title)
+        self.history_max_rows = self.create_limit_box(max_rows, 100000000)
+
+        self.history_dedupe_after_days_label = QLabel(self.LangSetting.language.lang_history_dedupe_after_days)
+        self.history_dedupe_after_days_label.setFont(font_title)
+        self.history_dedupe_after_days = self.create_limit_box(dedupe_after_days, 36500)
+
         self.certificates_section = QLabel(self.LangSetting.language.lang_certificates)
         self.certificates_section.setFont(font_title)
 
@@ -427,6 +465,31 @@ class Settings(QDialog):
         self.layout_https_mode.addWidget(self.https_mode_label)
         self.layout_https_mode.addWidget(self.https_mode)
 
+        self.layout_preload_suggestions = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_preload_suggestions)
+
+        self.layout_preload_suggestions.addWidget(self.preload_suggestions_label)
+        self.layout_preload_suggestions.addWidget(self.preload_suggestions)
+
+        # Layout of tab lifecycle
+        self.layout_tab_freeze_after_minutes = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_tab_freeze_after_minutes)
+
+        self.layout_tab_freeze_after_minutes.addWidget(self.tab_freeze_after_minutes_label)
+        self.layout_tab_freeze_after_minutes.addWidget(self.tab_freeze_after_minutes)
+
+        self.layout_tab_memory_budget_mb = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_tab_memory_budget_mb)
+
+        self.layout_tab_memory_budget_mb.addWidget(self.tab_memory_budget_mb_label)
+        self.layout_tab_memory_budget_mb.addWidget(self.tab_memory_budget_mb)
+
+        self.layout_tab_min_available_mb = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_tab_min_available_mb)
+
+        self.layout_tab_min_available_mb.addWidget(self.tab_min_available_mb_label)
+        self.layout_tab_min_available_mb.addWidget(self.tab_min_available_mb)
+
         self.layout_download_folder = QHBoxLayout()
         self.layout_basic.addLayout(self.layout_download_folder)
 
@@ -440,6 +503,25 @@ class Settings(QDialog):
         self.layout_search_engine.addWidget(self.search_engine_label)
         self.layout_search_engine.addWidget(self.search_engine)
 
+        # Layout of history retention
+        self.layout_history_max_age_days = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_history_max_age_days)
+
+        self.layout_history_max_age_days.addWidget(self.history_max_age_days_label)
+        self.layout_history_max_age_days.addWidget(self.history_max_age_days)
+
+        self.layout_history_max_rows = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_history_max_rows)
+
+        self.layout_history_max_rows.addWidget(self.history_max_rows_label)
+        self.layout_history_max_rows.addWidget(self.history_max_rows)
+
+        self.layout_history_dedupe_after_days = QHBoxLayout()
+        self.layout_basic.addLayout(self.layout_history_dedupe_after_days)
+
+        self.layout_history_dedupe_after_days.addWidget(self.history_dedupe_after_days_label)
+        self.layout_history_dedupe_after_days.addWidget(self.history_dedupe_after_days)
+
         # Layout of certificate management
         self.layout_Certificates_status = QHBoxLayout()
         self.layout_Certificates_accept = QHBoxLayout()
@@ -683,13 +765,35 @@ class Settings(QDialog):
         self.https_mode.currentTextChanged.connect(
             lambda option, item_type='https_mode': self.basic_setting_status_changed(option, item_type)
         )
+        self.preload_suggestions.currentTextChanged.connect(
+            lambda option, item_type='preload_suggestions': self.basic_setting_status_changed(option, item_type)
+        )
+
+        self.tab_freeze_after_minutes.valueChanged.connect(self.tab_lifecycle_changed)
+        self.tab_memory_budget_mb.valueChanged.connect(self.tab_lifecycle_changed)
+        self.tab_min_available_mb.valueChanged.connect(self.tab_lifecycle_changed)
 
         self.search_engine.currentTextChanged.connect(self.search_engine_changed)
 
         self.download_folder.textChanged.connect(self.download_folder_changed)
 
+        self.history_max_age_days.valueChanged.connect(self.history_retention_changed)
+        self.history_max_rows.valueChanged.connect(self.history_retention_changed)
+        self.history_dedupe_after_days.valueChanged.connect(self.history_retention_changed)
+
         self.browser_release.linkActivated.connect(self.send_signal)
 
+    def create_limit_box(self, value, maximum):
+        # A number of minutes, days, rows or megabytes, where 0 means no limit.
+        limit_box = QSpinBox()
+        limit_box.setRange(0, maximum)
+        limit_box.setSpecialValueText(self.LangSetting.language.lang_no_limit)
+        # valueChanged is only emitted when editing is finished, not for every typed digit.
+        limit_box.setKeyboardTracking(False)
+        limit_box.setFixedWidth(160)
+        limit_box.setValue(value)
+        return limit_box
+
     def send_signal(self, url):
         self.open_url_signal.emit(url)
 
@@ -714,6 +818,17 @@ class Settings(QDialog):
     def download_folder_changed(self, path):
         self.BasicSettings.change_download_folder(path)
 
+    def tab_lifecycle_changed(self):
+        self.BasicSettings.change_tab_lifecycle(
+            self.tab_freeze_after_minutes.value(), self.tab_memory_budget_mb.value(), self.tab_min_available_mb.value()
+        )
+
+    def history_retention_changed(self):
+        self.BasicSettings.change_history_retention(
+            self.history_max_age_days.value(), self.history_max_rows.value(), self.history_dedupe_after_days.value()
+        )
+        history_writer.schedule_retention()
+
     def permission_status_changed(self, option, permission_type):
         if option == self.LangSetting.language.lang_yes:
             self.CertificatesPermissions.enable_permission(permission_type)
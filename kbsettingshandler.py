@@ -1,15 +1,74 @@
-import ast
+from PySide6.QtCore import QObject, Signal
 
-from kbdatabase import EnvironConfig, Database
+from kbdatabase import EnvironConfig, Database, url_to_origin, PERMISSION_ACCEPT, PERMISSION_REJECT
 from kblang import LangEnUS
 
 
+class SettingsStore(QObject):
+    # In-memory copy of the basic and search_engines tables, shared by all settings handlers. Reads never touch the
+    # database, writes go through to it and setting_changed is emitted with the item and its new value for every
+    # changed item. A change of the search engine is emitted as the item 'search_engine' with the provider.
+    setting_changed = Signal(str, str)
+
+    shared_store = None
+
+    def __init__(self):
+        super(SettingsStore, self).__init__()
+
+        self.database = Database()
+        self.basic = dict()
+        self.search_engines = list()
+        self.load()
+
+    @classmethod
+    def shared(cls):
+        if cls.shared_store is None:
+            cls.shared_store = cls()
+        return cls.shared_store
+
+    def load(self):
+        self.basic = {item: value for _, item, value in self.database.read_settings_table('basic')}
+        self.search_engines = [[provider, url, enable]
+                               for _, provider, url, enable in self.database.read_settings_table('search_engines')]
+
+    def read_basic_setting(self, item):
+        return self.basic[item]
+
+    def update_basic_setting(self, item, value):
+        value = str(value)
+        if self.basic.get(item) == value:
+            return
+        self.database.update_settings_data('basic', 'item', item, 'value', value)
+        self.basic[item] = value
+        self.setting_changed.emit(item, value)
+
+    def read_search_engines(self):
+        return [provider for provider, _, _ in self.search_engines]
+
+    def read_enabled_search_engine(self):
+        for provider, url, enable in self.search_engines:
+            if enable == '1':
+                return provider, url
+        provider, url, _ = self.search_engines[0]
+        return provider, url
+
+    def update_search_engine(self, provider, enable):
+        enable = str(enable)
+        for search_engine in self.search_engines:
+            if search_engine[0] == provider and search_engine[2] != enable:
+                self.database.update_settings_data('search_engines', 'provider', provider, 'enable', enable)
+                search_engine[2] = enable
+                if enable == '1':
+                    self.setting_changed.emit('search_engine', provider)
+
+
 class BasicSettings:
     def __init__(self):
         super(BasicSettings, self).__init__()
 
         self.environ_config = EnvironConfig()
         self.database = Database()
+        self.settings_store = SettingsStore.shared()
         self.LangSetting = LangSetting()
 
     def read_cache_storage_path(self):
@@ -17,18 +76,14 @@ class BasicSettings:
         return cache_path, storage_path
 
     def read_download_folder(self):
-        temp = self.database.read_settings_data('basic', 'item', 'download_folder')
-        temp = temp[0]
-        download_folder = temp[2]
+        download_folder = self.settings_store.read_basic_setting('download_folder')
         return download_folder
 
     def change_download_folder(self, path):
-        self.database.update_settings_data('basic', 'item', 'download_folder', 'value', path)
+        self.settings_store.update_basic_setting('download_folder', path)
 
     def read_private_browsing(self):
-        temp = self.database.read_settings_data('basic', 'item', 'private_browsing')
-        temp = temp[0]
-        value = temp[2]
+        value = self.settings_store.read_basic_setting('private_browsing')
         if value == "1":
             status = self.LangSetting.language.lang_yes
         else:
@@ -37,9 +92,7 @@ class BasicSettings:
         return status
 
     def read_https_mode(self):
-        temp = self.database.read_settings_data('basic', 'item', 'https_mode')
-        temp = temp[0]
-        value = temp[2]
+        value = self.settings_store.read_basic_setting('https_mode')
         if value == "1":
             status = self.LangSetting.language.lang_yes
         else:
@@ -47,11 +100,48 @@ class BasicSettings:
 
         return status
 
+    def read_preload_suggestions(self):
+        value = self.settings_store.read_basic_setting('preload_suggestions')
+        if value == "1":
+            status = self.LangSetting.language.lang_yes
+        else:
+            status = self.LangSetting.language.lang_no
+
+        return status
+
+    def read_history_retention(self):
+        retention = list()
+        for item in ['history_max_age_days', 'history_max_rows', 'history_dedupe_after_days']:
+            retention.append(int(self.settings_store.read_basic_setting(item)))
+
+        max_age_days, max_rows, dedupe_after_days = retention
+        return max_age_days, max_rows, dedupe_after_days
+
+    def change_history_retention(self, max_age_days, max_rows, dedupe_after_days):
+        # 0 means no limit.
+        self.settings_store.update_basic_setting('history_max_age_days', max_age_days)
+        self.settings_store.update_basic_setting('history_max_rows', max_rows)
+        self.settings_store.update_basic_setting('history_dedupe_after_days', dedupe_after_days)
+
+    def read_tab_lifecycle(self):
+        tab_lifecycle = list()
+        for item in ['tab_freeze_after_minutes', 'tab_memory_budget_mb', 'tab_min_available_mb']:
+            tab_lifecycle.append(int(self.settings_store.read_basic_setting(item)))
+
+        freeze_after_minutes, memory_budget_mb, min_available_mb = tab_lifecycle
+        return freeze_after_minutes, memory_budget_mb, min_available_mb
+
+    def change_tab_lifecycle(self, freeze_after_minutes, memory_budget_mb, min_available_mb):
+        # 0 means no limit.
+        self.settings_store.update_basic_setting('tab_freeze_after_minutes', freeze_after_minutes)
+        self.settings_store.update_basic_setting('tab_memory_budget_mb', memory_budget_mb)
+        self.settings_store.update_basic_setting('tab_min_available_mb', min_available_mb)
+
     def enable_basic_setting(self, item_type):
-        self.database.update_settings_data('basic', 'item', item_type, 'value', '1')
+        self.settings_store.update_basic_setting(item_type, '1')
 
     def disable_basic_setting(self, item_type):
-        self.database.update_settings_data('basic', 'item', item_type, 'value', '0')
+        self.settings_store.update_basic_setting(item_type, '0')
 
 
 class SearchEngines:
@@ -59,25 +149,77 @@ class SearchEngines:
         super(SearchEngines, self).__init__()
 
         self.database = Database()
+        self.settings_store = SettingsStore.shared()
 
     def read_search_engines(self):
-        temp = self.database.read_settings_table('search_engines')
-        temp = list(zip(*temp))
-        search_engines_list = temp[1]
+        search_engines_list = self.settings_store.read_search_engines()
         return search_engines_list
 
     def read_enabled_search_engine(self):
-        temp = self.database.read_settings_data('search_engines', 'enable', '1')
-        temp = temp[0]
-        enabled_search_engine = temp[1]
-        enabled_search_engine_url = temp[2]
+        enabled_search_engine, enabled_search_engine_url = self.settings_store.read_enabled_search_engine()
         return enabled_search_engine, enabled_search_engine_url
 
     def enable_search_engine(self, provider):
-        self.database.update_settings_data('search_engines', 'provider', provider, 'enable', '1')
+        self.settings_store.update_search_engine(provider, '1')
 
     def disable_search_engine(self, provider):
-        self.database.update_settings_data('search_engines', 'provider', provider, 'enable', '0')
+        self.settings_store.update_search_engine(provider, '0')
+
+
+class PermissionStore:
+    # In-memory index of the permission statuses and of the remembered decisions keyed by (permission, origin), so that
+    # a permission request or a certificate error is decided without touching the database.
+    shared_store = None
+
+    def __init__(self):
+        super(PermissionStore, self).__init__()
+
+        self.database = Database()
+        self.status = dict()
+        self.decisions = dict()
+        self.load()
+
+    @classmethod
+    def shared(cls):
+        if cls.shared_store is None:
+            cls.shared_store = cls()
+        return cls.shared_store
+
+    def load(self):
+        self.status = {permission: status
+                       for _, permission, status, _, _ in self.database.read_settings_table('permissions')}
+        self.decisions = {(permission, origin): decision
+                          for permission, origin, decision in self.database.read_permission_decisions()}
+
+    def read_status(self, permission_type):
+        return self.status[permission_type]
+
+    def update_status(self, permission_type, status):
+        self.database.update_settings_data('permissions', 'permission', permission_type, 'status', status)
+        self.status[permission_type] = str(status)
+
+    def read_decision(self, permission_type, url):
+        return self.decisions.get((permission_type, url_to_origin(url)))
+
+    def read_origins(self, permission_type, decision):
+        origins = [origin for (permission, origin), value in self.decisions.items()
+                   if permission == permission_type and value == decision]
+        origins.sort()
+        return origins
+
+    def update_decision(self, permission_type, url, decision):
+        origin = url_to_origin(url)
+        if self.decisions.get((permission_type, origin)) == decision:
+            return
+        self.database.update_permission_decision(permission_type, origin, decision)
+        self.decisions[(permission_type, origin)] = decision
+
+    def remove_decision(self, permission_type, url, decision):
+        origin = url_to_origin(url)
+        if self.decisions.get((permission_type, origin)) != decision:
+            return
+        self.database.delete_permission_decision(permission_type, origin)
+        del self.decisions[(permission_type, origin)]
 
 
 class CertificatesPermissions:
@@ -85,79 +227,46 @@ class CertificatesPermissions:
         super(CertificatesPermissions, self).__init__()
 
         self.database = Database()
+        self.permission_store = PermissionStore.shared()
         self.LangSetting = LangSetting()
 
-    def read_permission(self, permission_type):
-        temp = self.database.read_settings_data('permissions', 'permission', permission_type)
-        temp = temp[0]
-        permission_status = temp[2]
-
+    def read_permission_status(self, permission_type):
+        permission_status = self.permission_store.read_status(permission_type)
         if permission_status == '1':
             permission_status = self.LangSetting.language.lang_yes
         else:
             permission_status = self.LangSetting.language.lang_no
+        return permission_status
 
-        permission_accept_list = temp[3]
-        if permission_accept_list == '' or permission_accept_list is None:
-            permission_accept_list = list()
-        else:
-            permission_accept_list = ast.literal_eval(permission_accept_list)
+    def read_permission(self, permission_type):
+        permission_status = self.read_permission_status(permission_type)
+        permission_accept_list = self.permission_store.read_origins(permission_type, PERMISSION_ACCEPT)
+        permission_reject_list = self.permission_store.read_origins(permission_type, PERMISSION_REJECT)
+        return permission_status, permission_accept_list, permission_reject_list
 
-        permission_reject_list = temp[4]
-        if permission_reject_list == '' or permission_reject_list is None:
-            permission_reject_list = list()
-        else:
-            permission_reject_list = ast.literal_eval(permission_reject_list)
+    def is_accepted(self, permission_type, url):
+        return self.permission_store.read_decision(permission_type, url) == PERMISSION_ACCEPT
 
-        return permission_status, permission_accept_list, permission_reject_list
+    def is_rejected(self, permission_type, url):
+        return self.permission_store.read_decision(permission_type, url) == PERMISSION_REJECT
 
     def enable_permission(self, permission_type):
-        self.database.update_settings_data('permissions', 'permission', permission_type, 'status', '1')
+        self.permission_store.update_status(permission_type, '1')
 
     def disable_permission(self, permission_type):
-        self.database.update_settings_data('permissions', 'permission', permission_type, 'status', '0')
+        self.permission_store.update_status(permission_type, '0')
 
     def accept_permission(self, permission_type, url):
-        _, permission_accept_list, _ = self.read_permission(permission_type)
-        if permission_accept_list == '' or permission_accept_list is None:
-            permission_accept_list = list()
-
-        check_permission_list = None
-        if permission_accept_list:
-            if url in permission_accept_list:
-                check_permission_list = 'Found'
-
-        if check_permission_list is None:
-            permission_accept_list.append(url)
-            self.database.update_settings_data(
-                'permissions', 'permission', permission_type, 'accept', permission_accept_list
-            )
+        self.permission_store.update_decision(permission_type, url, PERMISSION_ACCEPT)
 
     def reject_permission(self, permission_type, url):
-        _, _, permission_reject_list = self.read_permission(permission_type)
-        if permission_reject_list == "" or permission_reject_list is None:
-            permission_reject_list = list()
-
-        check_permission_list = None
-        if permission_reject_list:
-            if url in permission_reject_list:
-                check_permission_list = 'Found'
-
-        if check_permission_list is None:
-            permission_reject_list.append(url)
-            self.database.update_settings_data(
-                'permissions', 'permission', permission_type, 'reject', permission_reject_list
-            )
+        self.permission_store.update_decision(permission_type, url, PERMISSION_REJECT)
 
     def remove_from_accept(self, permission_type, url):
-        permission_status, permission_accept_list, permission_reject_list = self.read_permission(permission_type)
-        accepted_list = permission_accept_list.remove(url)
-        self.database.update_settings_data('permissions', 'permission', permission_type, 'accept', accepted_list)
+        self.permission_store.remove_decision(permission_type, url, PERMISSION_ACCEPT)
 
     def remove_from_reject(self, permission_type, url):
-        permission_status, permission_accept_list, permission_reject_list = self.read_permission(permission_type)
-        rejected_list = permission_reject_list.remove(url)
-        self.database.update_settings_data('permissions', 'permission', permission_type, 'reject', rejected_list)
+        self.permission_store.remove_decision(permission_type, url, PERMISSION_REJECT)
 
 
 class LangSetting:
@@ -165,14 +274,13 @@ class LangSetting:
         super(LangSetting, self).__init__()
         self.environ_config = EnvironConfig()
         self.database = Database()
+        self.settings_store = SettingsStore.shared()
 
         self.language = self.switch_ui_translation()
         self.languages_list = [('en_US', self.language.lang_en_us), ('zh_CN', self.language.lang_zh_cn)]
 
     def switch_ui_translation(self):
-        temp = self.database.read_settings_data('basic', 'item', 'ui_translation')
-        temp = temp[0]
-        locale_code = temp[2]
+        locale_code = self.settings_store.read_basic_setting('ui_translation')
         ui_translation = None
         if locale_code == 'en_US':
             ui_translation = LangEnUS()
@@ -212,9 +320,7 @@ class LangSetting:
         return language_name
 
     def read_ui_translation_setting(self):
-        temp = self.database.read_settings_data('basic', 'item', 'ui_translation')
-        temp = temp[0]
-        locale_code = temp[2]
+        locale_code = self.settings_store.read_basic_setting('ui_translation')
         translation_name = self.show_language_name(locale_code)
 
         available_translations_list = self.read_translations_list()
@@ -222,9 +328,7 @@ class LangSetting:
         return translation_name, available_translations_list
 
     def read_preferred_language_setting(self):
-        temp = self.database.read_settings_data('basic', 'item', 'preferred_language')
-        temp = temp[0]
-        http_language_code = temp[2]
+        http_language_code = self.settings_store.read_basic_setting('preferred_language')
         language_name = self.show_language_name(http_language_code)
 
         temp = list(zip(*self.languages_list))
@@ -234,11 +338,11 @@ class LangSetting:
 
     def change_ui_translation_setting(self, language_name):
         locale_code, _ = self.language_name_to_language_code(language_name)
-        self.database.update_settings_data('basic', 'item', 'ui_translation', 'value', locale_code)
+        self.settings_store.update_basic_setting('ui_translation', locale_code)
 
     def change_preferred_language_setting(self, language_name):
         _, http_language_code = self.language_name_to_language_code(language_name)
-        self.database.update_settings_data('basic', 'item', 'preferred_language', 'value', http_language_code)
+        self.settings_store.update_basic_setting('preferred_language', http_language_code)
 
 
 class WindowSettings:
@@ -248,8 +352,7 @@ class WindowSettings:
         self.environ_config = EnvironConfig()
 
     def save_window_size(self, width, height):
-        self.environ_config.update_configuration_file_setting('Width', width)
-        self.environ_config.update_configuration_file_setting('Height', height)
+        self.environ_config.update_configuration_file_settings({'Width': width, 'Height': height})
 
     def read_window_size(self, available_width, available_height):
         width = self.environ_config.read_configuration_file_setting('Width')
@@ -0,0 +1,310 @@
+import os
+import glob
+import json
+import time
+import zlib
+import threading
+
+from PySide6.QtCore import Qt, QObject, Signal
+
+from kbdatabase import Database, add_mutation_listener, remove_mutation_listener, current_time_us
+from kbsettingshandler import SettingsStore, PermissionStore
+
+
+class SyncApplier(QObject):
+    # Applies settings and permission changes of other devices on the GUI thread, which owns the in-memory stores. The
+    # sync thread emits change_signal and the change is applied when the event loop delivers it.
+    change_signal = Signal(str, object)
+
+    def __init__(self, profile_sync):
+        super(SyncApplier, self).__init__()
+
+        self.profile_sync = profile_sync
+        self.database = Database()
+        self.settings_store = SettingsStore.shared()
+        self.permission_store = PermissionStore.shared()
+
+        self.change_signal.connect(self.apply_change, Qt.QueuedConnection)
+
+    def apply_change(self, kind, data):
+        # Changes applied from other devices are not logged again.
+        self.profile_sync.local.applying = True
+        try:
+            if kind == 'setting':
+                self.apply_setting(*data)
+            elif kind == 'delete_setting':
+                self.database.delete_settings_data(*data)
+                self.settings_store.load()
+                self.permission_store.load()
+            elif kind == 'permission':
+                permission, origin, decision = data
+                if decision is None:
+                    # The origin may have no decision on this device.
+                    local_decision = self.permission_store.read_decision(permission, origin)
+                    if local_decision is not None:
+                        self.permission_store.remove_decision(permission, origin, local_decision)
+                else:
+                    self.permission_store.update_decision(permission, origin, decision)
+        finally:
+            self.profile_sync.local.applying = False
+
+    def apply_setting(self, table, query_column, query_column_value, target_column, target_column_value):
+        # Through the in-memory stores, so that the change is seen at once.
+        if table == 'basic':
+            self.settings_store.update_basic_setting(query_column_value, target_column_value)
+        elif table == 'search_engines':
+            self.settings_store.update_search_engine(query_column_value, target_column_value)
+        elif table == 'permissions':
+            self.permission_store.update_status(query_column_value, target_column_value)
+
+
+class ProfileSync(threading.Thread):
+    # Shares history, the search engine, permission settings and decisions between the devices of a user through a
+    # folder, e.g. a shared mount. Every device appends its changes to its own log file <device>.kblog there and reads
+    # the logs of the other devices from the offset it reached before, so that the cost of a sync only depends on the
+    # number of new changes.
+    #
+    # A log line is "<crc32 of the payload in hex> <payload>", the payload is the JSON array
+    # [sequence, time, kind, data]. Sequences count up per device. Settings and permission decisions are merged with
+    # last-writer-wins by (time, device), visits are added and deletions of visits are replayed. Downloads have local
+    # file names and are not synced, imported history is not logged.
+    synced_basic_items = ['https_mode', 'preferred_language', 'history_max_age_days', 'history_max_rows',
+                          'history_dedupe_after_days']
+    synced_settings_tables = ['search_engines', 'permissions']
+
+    def __init__(self, sync_folder, poll_interval=10):
+        super(ProfileSync, self).__init__(name='ProfileSync', daemon=True)
+
+        self.sync_folder = sync_folder
+        self.poll_interval = poll_interval
+
+        self.database = Database()
+        self.device = SettingsStore.shared().read_basic_setting('sync_device')
+        self.log_path = os.path.join(self.sync_folder, f'{self.device}.kblog')
+
+        self.lock = threading.Lock()
+        self.pending = list()
+        self.pending_versions = list()
+        # The stored sequence is updated after lines are appended, so after a crash in between the log is ahead.
+        # Sequences are never reused, or other devices would skip the new lines as already applied.
+        _, self.sequence = self.database.read_sync_state().get(self.device, (0, 0))
+        self.sequence = max(self.sequence, self.read_logged_sequence())
+
+        # Changes applied from other devices are not logged again.
+        self.local = threading.local()
+        self.sync_applier = SyncApplier(self)
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.statistics_lock = threading.Lock()
+        self.statistics = {'logged': 0, 'applied': 0, 'skipped': 0, 'corrupt': 0}
+
+        add_mutation_listener(self.record_change)
+
+    def is_synced(self, kind, data):
+        if kind in ['setting', 'delete_setting']:
+            table, _, query_column_value = data[:3]
+            if table == 'basic':
+                return query_column_value in self.synced_basic_items
+            return table in self.synced_settings_tables
+        if kind == 'history':
+            return bool(data[0])
+        if kind in ['delete_history', 'reset_history']:
+            return data[0] == 'visits'
+        return kind == 'permission'
+
+    @staticmethod
+    def version_key(kind, data):
+        # Settings and permission decisions which are merged by last-writer-wins.
+        if kind == 'setting':
+            table, _, query_column_value, target_column, _ = data
+            return f'{table}:{query_column_value}:{target_column}'
+        if kind == 'permission':
+            permission, origin, _ = data
+            return f'permission:{permission}:{origin}'
+        return None
+
+    def record_change(self, kind, data):
+        # Called by Database in the thread that made the change, it only queues a line.
+        if getattr(self.local, 'applying', False) or not self.is_synced(kind, data):
+            return
+
+        if kind == 'history':
+            # Downloads have local file names and are not synced.
+            data = (data[0],)
+        change_time = current_time_us()
+        with self.lock:
+            self.sequence += 1
+            payload = json.dumps([self.sequence, change_time, kind, data], ensure_ascii=False, separators=(',', ':'))
+            self.pending.append(f'{zlib.crc32(payload.encode()):08x} {payload}\n')
+            key = self.version_key(kind, data)
+            if key is not None:
+                self.pending_versions.append((key, change_time, self.device))
+        self.wake_event.set()
+
+    def write_pending(self):
+        with self.lock:
+            lines = self.pending
+            versions = self.pending_versions
+            sequence = self.sequence
+            self.pending = list()
+            self.pending_versions = list()
+        if not lines:
+            return
+
+        with open(self.log_path, 'a', encoding='utf-8') as log_file:
+            log_file.writelines(lines)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+        self.database.update_sync_versions(versions)
+        self.database.update_sync_state(self.device, 0, sequence)
+        with self.statistics_lock:
+            self.statistics['logged'] += len(lines)
+
+    def read_logged_sequence(self, tail_size=65536):
+        # Sequence of the last intact line in the log of this device, read from its end. The tail grows until it holds
+        # a complete line, a batch of visits may be longer than tail_size.
+        try:
+            log_size = os.path.getsize(self.log_path)
+            with open(self.log_path, 'rb') as log_file:
+                while True:
+                    offset = max(log_size - tail_size, 0)
+                    log_file.seek(offset)
+                    lines = log_file.read().splitlines()
+                    if offset:
+                        # The first line is cut off.
+                        lines = lines[1:]
+                    for line in reversed(lines):
+                        change = self.parse_line(line)
+                        if change is not None:
+                            return change[0]
+                    if offset == 0:
+                        return 0
+                    tail_size *= 4
+        except OSError:
+            return 0
+
+    @staticmethod
+    def parse_line(line):
+        checksum, _, payload = line.partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def read_logs(self):
+        # Complete lines after the stored offset of every other device. A last line without a newline is still being
+        # written and is read again next time.
+        sync_state = self.database.read_sync_state()
+        for log_path in glob.glob(os.path.join(self.sync_folder, '*.kblog')):
+            device = os.path.basename(log_path)[:-len('.kblog')]
+            if device == self.device:
+                continue
+
+            offset, last_sequence = sync_state.get(device, (0, 0))
+            try:
+                if os.path.getsize(log_path) < offset:
+                    # The log was replaced, sequences keep already applied changes from being applied twice.
+                    offset = 0
+                with open(log_path, 'rb') as log_file:
+                    log_file.seek(offset)
+                    data = log_file.read()
+            except OSError:
+                continue
+
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                change = self.parse_line(line)
+                if change is None:
+                    with self.statistics_lock:
+                        self.statistics['corrupt'] += 1
+                    continue
+                sequence, change_time, kind, change_data = change
+                if sequence <= last_sequence:
+                    continue
+                self.apply_change(device, change_time, kind, change_data)
+                last_sequence = sequence
+
+            if end:
+                self.database.update_sync_state(device, offset + end, last_sequence)
+
+    def apply_change(self, device, change_time, kind, data):
+        # Logs of older versions may hold changes which are not synced any more, e.g. clearing the downloads.
+        if not self.is_synced(kind, data):
+            with self.statistics_lock:
+                self.statistics['skipped'] += 1
+            return
+
+        key = self.version_key(kind, data)
+        if key is not None:
+            sync_version = self.database.read_sync_version(key)
+            if sync_version is not None and tuple(sync_version) >= (change_time, device):
+                with self.statistics_lock:
+                    self.statistics['skipped'] += 1
+                return
+
+        if kind in ['setting', 'delete_setting', 'permission']:
+            # The in-memory stores belong to the GUI thread.
+            self.sync_applier.change_signal.emit(kind, data)
+        else:
+            self.local.applying = True
+            try:
+                if kind == 'history':
+                    self.database.insert_history_batch([tuple(visit) for visit in data[0]], [])
+                elif kind == 'delete_history':
+                    self.database.delete_history_data(*data)
+                elif kind == 'reset_history':
+                    self.reset_history(change_time)
+            finally:
+                self.local.applying = False
+
+        if key is not None:
+            self.database.update_sync_versions([(key, change_time, device)])
+        with self.statistics_lock:
+            self.statistics['applied'] += 1
+
+    def reset_history(self, change_time):
+        # Only what was recorded before the other device cleared its history is deleted.
+        while self.database.prune_visits_before(change_time, 5000):
+            pass
+        self.database.delete_history_archives_before(change_time)
+
+    def sync(self):
+        self.write_pending()
+        self.read_logs()
+
+    def run(self):
+        if os.path.exists(self.sync_folder) is False:
+            os.makedirs(self.sync_folder, exist_ok=True)
+
+        # Local changes are written as soon as they are queued, the logs of other devices every poll_interval.
+        next_read = 0
+        while not self.stop_event.is_set():
+            try:
+                self.write_pending()
+                if time.monotonic() >= next_read:
+                    self.read_logs()
+                    next_read = time.monotonic() + self.poll_interval
+            except OSError:
+                pass
+            self.wake_event.wait(max(next_read - time.monotonic(), 0))
+            self.wake_event.clear()
+
+        try:
+            self.write_pending()
+        except OSError:
+            pass
+
+    def stop(self, timeout=5):
+        remove_mutation_listener(self.record_change)
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def read_statistics(self):
+        with self.statistics_lock:
+            return dict(self.statistics)
@@ -0,0 +1,140 @@
+import time
+
+from PySide6.QtCore import QObject, QTimer
+from PySide6.QtWebEngineCore import QWebEnginePage
+
+from kbprocess import read_rss_mb, read_available_memory_mb
+from kbsettingshandler import SettingsStore, BasicSettings
+from kbsession import SessionTab
+
+
+class TabLifecycleManager(QObject):
+    # Lowers the cost of background tabs through the lifecycle states of their pages. A tab hidden for
+    # freeze_after_minutes is frozen: it keeps its memory but runs no JavaScript and no timers. When the render processes
+    # of all tabs use more than memory_budget_mb, or the system has less than min_available_mb available, the least
+    # recently used background tabs are discarded, which ends their render process. Pages keep their url, title and
+    # navigation history in both states and are reloaded when their tab is activated.
+    #
+    # Tabs playing audio or whose page recommends to stay active, e.g. while the developer tools are attached, are left
+    # alone. The limits come from the basic settings, 0 means no limit.
+    tab_lifecycle_items = ['tab_freeze_after_minutes', 'tab_memory_budget_mb', 'tab_min_available_mb']
+
+    def __init__(self, tabs, check_interval=30000):
+        super(TabLifecycleManager, self).__init__()
+
+        self.tabs = tabs
+        self.basic_settings = BasicSettings()
+        self.settings_store = SettingsStore.shared()
+        self.freeze_after_minutes, self.memory_budget_mb, self.min_available_mb = \
+            self.basic_settings.read_tab_lifecycle()
+
+        self.current_web_view = None
+        self.statistics = {'frozen': 0, 'discarded': 0, 'reactivated': 0}
+
+        self.settings_store.setting_changed.connect(self.setting_changed)
+
+        self.check_timer = QTimer()
+        self.check_timer.setInterval(check_interval)
+        self.check_timer.timeout.connect(self.check_tabs)
+        self.check_timer.start()
+
+    def setting_changed(self, item, value):
+        if item in self.tab_lifecycle_items:
+            self.freeze_after_minutes, self.memory_budget_mb, self.min_available_mb = \
+                self.basic_settings.read_tab_lifecycle()
+
+    def read_web_views(self):
+        web_views = list()
+        for n in range(self.tabs.count()):
+            widget = self.tabs.widget(n)
+            if not isinstance(widget, SessionTab):
+                web_views.append(widget)
+        return web_views
+
+    def tab_activated(self, web_view):
+        # The tab which was shown until now starts its time in the background.
+        now = time.monotonic()
+        if self.current_web_view is not None and self.current_web_view is not web_view:
+            self.current_web_view.last_visible_time = now
+        self.current_web_view = web_view
+        if isinstance(web_view, SessionTab):
+            return
+
+        web_view.last_visible_time = now
+        if web_view.page().lifecycleState() != QWebEnginePage.LifecycleState.Active:
+            web_view.page().setLifecycleState(QWebEnginePage.LifecycleState.Active)
+            self.statistics['reactivated'] += 1
+
+    def tab_removed(self, web_view):
+        if self.current_web_view is web_view:
+            self.current_web_view = None
+
+    def is_background(self, web_view):
+        page = web_view.page()
+        return (web_view is not self.tabs.currentWidget() and not page.recentlyAudible()
+                and page.recommendedState() != QWebEnginePage.LifecycleState.Active)
+
+    def check_tabs(self):
+        now = time.monotonic()
+        background_web_views = [web_view for web_view in self.read_web_views() if self.is_background(web_view)]
+
+        if self.freeze_after_minutes:
+            for web_view in background_web_views:
+                hidden_seconds = now - getattr(web_view, 'last_visible_time', now)
+                if web_view.page().lifecycleState() == QWebEnginePage.LifecycleState.Active and \
+                        hidden_seconds >= self.freeze_after_minutes * 60:
+                    web_view.page().setLifecycleState(QWebEnginePage.LifecycleState.Frozen)
+                    self.statistics['frozen'] += 1
+
+        self.discard_tabs(background_web_views)
+
+    def discard_tab(self, web_view):
+        # Discards a background tab on request, e.g. from the task manager. The current tab stays active.
+        if web_view is self.tabs.currentWidget() or isinstance(web_view, SessionTab):
+            return False
+        if web_view.page().lifecycleState() == QWebEnginePage.LifecycleState.Discarded:
+            return False
+        web_view.page().setLifecycleState(QWebEnginePage.LifecycleState.Discarded)
+        self.statistics['discarded'] += 1
+        return True
+
+    def read_renderer_memory(self):
+        # RSS of every render process, several pages of a site may share one.
+        renderer_memory = dict()
+        for web_view in self.read_web_views():
+            pid = web_view.page().renderProcessPid()
+            if pid and pid not in renderer_memory:
+                renderer_memory[pid] = read_rss_mb(pid) or 0
+        return renderer_memory
+
+    def discard_tabs(self, background_web_views):
+        renderer_memory = self.read_renderer_memory()
+        memory_excess = 0
+        if self.memory_budget_mb:
+            memory_excess = sum(renderer_memory.values()) - self.memory_budget_mb
+        available_memory = read_available_memory_mb()
+        if self.min_available_mb and available_memory is not None:
+            memory_excess = max(memory_excess, self.min_available_mb - available_memory)
+        if memory_excess <= 0:
+            return
+
+        # Least recently used first. The memory of a render process only counts as freed once none of the remaining
+        # pages uses it.
+        candidates = [web_view for web_view in background_web_views
+                      if web_view.page().lifecycleState() != QWebEnginePage.LifecycleState.Discarded]
+        candidates.sort(key=lambda web_view: getattr(web_view, 'last_visible_time', 0))
+        pids = [web_view.page().renderProcessPid() for web_view in self.read_web_views()]
+        for web_view in candidates:
+            pid = web_view.page().renderProcessPid()
+            self.discard_tab(web_view)
+
+            pids.remove(pid)
+            if pid not in pids:
+                memory_excess -= renderer_memory.get(pid, 0)
+            if memory_excess <= 0:
+                break
+
+    def read_statistics(self):
+        statistics = dict(self.statistics)
+        statistics['renderer_memory_mb'] = sum(self.read_renderer_memory().values())
+        return statistics
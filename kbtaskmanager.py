@@ -0,0 +1,286 @@
+import os
+import time
+import signal
+import threading
+
+from PySide6.QtCore import Qt, QObject, Signal, QThread
+from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QPushButton,
+                               QAbstractItemView)
+from PySide6.QtWebEngineCore import QWebEnginePage
+
+from kbprocess import read_cpu_ticks, read_process_status
+from kbsession import SessionTab
+from kbsettingshandler import LangSetting
+
+
+class ProcessSampler(QThread):
+    # Samples RSS, CPU usage and the number of threads of a set of processes every interval seconds, off the GUI
+    # thread. CPU% is the CPU time of a process between two samples relative to the wall time between them, so one busy
+    # core is 100. A process sampled for the first time has 0.
+    samples_signal = Signal(object)
+
+    def __init__(self, interval=1.0):
+        super(ProcessSampler, self).__init__()
+
+        self.interval = interval
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+
+        self.lock = threading.Lock()
+        self.pids = set()
+        # pid: (rss_mb, cpu_percent, threads)
+        self.samples = dict()
+        self.stop_event = threading.Event()
+
+    def set_pids(self, pids):
+        with self.lock:
+            self.pids = set(pids)
+
+    def read_samples(self):
+        with self.lock:
+            return dict(self.samples)
+
+    def start_sampling(self):
+        self.stop_event.clear()
+        self.start()
+
+    def run(self):
+        last_ticks = dict()
+        last_time = time.monotonic()
+        while True:
+            with self.lock:
+                pids = set(self.pids)
+
+            now = time.monotonic()
+            elapsed = now - last_time
+            samples = dict()
+            ticks = dict()
+            for pid in pids:
+                status = read_process_status(pid)
+                cpu_ticks = read_cpu_ticks(pid)
+                if status is None or cpu_ticks is None:
+                    continue
+                ticks[pid] = cpu_ticks
+                cpu_percent = 0.0
+                if pid in last_ticks and elapsed > 0:
+                    cpu_percent = (cpu_ticks - last_ticks[pid]) / self.clock_ticks / elapsed * 100
+                rss_mb, threads = status
+                samples[pid] = (rss_mb, cpu_percent, threads)
+            last_ticks = ticks
+            last_time = now
+
+            with self.lock:
+                self.samples = samples
+            self.samples_signal.emit(samples)
+
+            if self.stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stop_event.set()
+        self.wait()
+
+
+class TaskManager(QObject):
+    # Maps every tab to its render process and the latest samples of that process. read_tasks() can be polled by other
+    # parts of the browser and by tests while sampling runs, tasks_changed is emitted after every sample. Sampling runs
+    # between start() and stop(), which are counted, so that several users can share it.
+    tasks_changed = Signal()
+
+    lifecycle_states = {
+        QWebEnginePage.LifecycleState.Active: 'active',
+        QWebEnginePage.LifecycleState.Frozen: 'frozen',
+        QWebEnginePage.LifecycleState.Discarded: 'discarded',
+    }
+
+    def __init__(self, tabs, tab_lifecycle_manager, interval=1.0):
+        super(TaskManager, self).__init__()
+
+        self.tabs = tabs
+        self.tab_lifecycle_manager = tab_lifecycle_manager
+        self.users = 0
+
+        self.process_sampler = ProcessSampler(interval)
+        self.process_sampler.samples_signal.connect(self.samples_received)
+
+    def start(self):
+        self.users += 1
+        self.process_sampler.set_pids(self.read_pids())
+        if not self.process_sampler.isRunning():
+            self.process_sampler.start_sampling()
+
+    def stop(self, force=False):
+        self.users = 0 if force else max(self.users - 1, 0)
+        if self.users == 0 and self.process_sampler.isRunning():
+            self.process_sampler.stop()
+
+    def read_renderer_pids(self):
+        pids = set()
+        for n in range(self.tabs.count()):
+            widget = self.tabs.widget(n)
+            if not isinstance(widget, SessionTab) and widget.page().renderProcessPid():
+                pids.add(widget.page().renderProcessPid())
+        return pids
+
+    def read_pids(self):
+        return self.read_renderer_pids() | {os.getpid()}
+
+    def samples_received(self, samples):
+        # Tabs may have been opened, closed or discarded since the last sample.
+        self.process_sampler.set_pids(self.read_pids())
+        self.tasks_changed.emit()
+
+    @staticmethod
+    def make_task(index, title, url, pid, state, samples):
+        rss_mb, cpu_percent, threads = samples.get(pid, (None, None, None))
+        return {'index': index, 'title': title, 'url': url, 'pid': pid, 'state': state, 'rss_mb': rss_mb,
+                'cpu_percent': cpu_percent, 'threads': threads}
+
+    def read_tasks(self):
+        # The browser process first with the index -1, then one task per tab. Tabs restored from the last session and
+        # not activated yet have no process and count as discarded. Sampled values are None until a sample is taken.
+        samples = self.process_sampler.read_samples()
+        tasks = [self.make_task(-1, '', '', os.getpid(), 'active', samples)]
+        for n in range(self.tabs.count()):
+            widget = self.tabs.widget(n)
+            if isinstance(widget, SessionTab):
+                tasks.append(self.make_task(n, widget.page_title, widget.web_address, 0, 'discarded', samples))
+                continue
+            page = widget.page()
+            tasks.append(self.make_task(n, self.tabs.tabText(n), widget.url().toString(), page.renderProcessPid(),
+                                        self.lifecycle_states.get(page.lifecycleState(), 'active'), samples))
+        return tasks
+
+    def end_process(self, pid):
+        # Only render processes of tabs can be ended, their tabs show an error page until they are reloaded.
+        if not pid or pid not in self.read_renderer_pids():
+            return False
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            return False
+        return True
+
+    def discard_tab(self, index):
+        if index < 0 or index >= self.tabs.count():
+            return False
+        return self.tab_lifecycle_manager.discard_tab(self.tabs.widget(index))
+
+
+class TaskManagerDialog(QDialog):
+    def __init__(self, task_manager):
+        super(TaskManagerDialog, self).__init__()
+
+        self.task_manager = task_manager
+        self.LangSetting = LangSetting()
+
+        self.resize(800, 480)
+        self.setWindowTitle(self.LangSetting.language.lang_task_manager)
+
+        self.state_names = {'active': self.LangSetting.language.lang_active,
+                            'frozen': self.LangSetting.language.lang_frozen,
+                            'discarded': self.LangSetting.language.lang_discarded}
+
+        self.task_table = QTableWidget()
+        self.task_table.setColumnCount(6)
+        self.task_table.setHorizontalHeaderLabels(
+            [self.LangSetting.language.lang_tab,
+             self.LangSetting.language.lang_process_id,
+             self.LangSetting.language.lang_memory_mb,
+             self.LangSetting.language.lang_cpu_percent,
+             self.LangSetting.language.lang_threads,
+             self.LangSetting.language.lang_state]
+        )
+        self.task_table.setColumnWidth(0, 320)
+        self.task_table.verticalHeader().setHidden(True)
+        self.task_table.setShowGrid(False)
+        self.task_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.task_table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.task_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.task_table.setSortingEnabled(True)
+        self.task_table.sortByColumn(2, Qt.DescendingOrder)
+
+        self.end_process_button = QPushButton(self.LangSetting.language.lang_end_process)
+        self.end_process_button.setFixedWidth(120)
+        self.discard_tab_button = QPushButton(self.LangSetting.language.lang_discard_tab)
+        self.discard_tab_button.setFixedWidth(120)
+
+        self.buttons_layout = QHBoxLayout()
+        self.buttons_layout.setAlignment(Qt.AlignRight)
+        self.buttons_layout.addWidget(self.discard_tab_button)
+        self.buttons_layout.addWidget(self.end_process_button)
+
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(self.task_table)
+        self.layout.addLayout(self.buttons_layout)
+
+        self.task_manager.tasks_changed.connect(self.show_tasks)
+        self.task_table.itemSelectionChanged.connect(self.update_buttons)
+        self.end_process_button.clicked.connect(self.end_process)
+        self.discard_tab_button.clicked.connect(self.discard_tab)
+
+        self.task_manager.start()
+        self.is_sampling = True
+        self.show_tasks()
+
+    def read_selected_task(self):
+        # (tab index, pid) of the selected row, or None.
+        rows = self.task_table.selectionModel().selectedRows()
+        if not rows:
+            return None
+        item = self.task_table.item(rows[0].row(), 0)
+        return item.data(Qt.UserRole), item.data(Qt.UserRole + 1)
+
+    def show_tasks(self):
+        # Sorting is suspended while the rows are replaced and the selected task is selected again afterwards.
+        selected_task = self.read_selected_task()
+        tasks = self.task_manager.read_tasks()
+
+        self.task_table.setSortingEnabled(False)
+        self.task_table.setRowCount(len(tasks))
+        for row, task in enumerate(tasks):
+            title = (task['title'] or task['url']) if task['index'] >= 0 else self.LangSetting.language.lang_browser_process
+            values = [title, task['pid'] or '',
+                      round(task['rss_mb'], 1) if task['rss_mb'] is not None else '',
+                      round(task['cpu_percent'], 1) if task['cpu_percent'] is not None else '',
+                      task['threads'] if task['threads'] is not None else '',
+                      self.state_names[task['state']]]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, value)
+                item.setData(Qt.UserRole, task['index'])
+                item.setData(Qt.UserRole + 1, task['pid'])
+                self.task_table.setItem(row, column, item)
+        self.task_table.setSortingEnabled(True)
+
+        if selected_task is not None:
+            for row in range(self.task_table.rowCount()):
+                item = self.task_table.item(row, 0)
+                if (item.data(Qt.UserRole), item.data(Qt.UserRole + 1)) == selected_task:
+                    self.task_table.selectRow(row)
+                    break
+        self.update_buttons()
+
+    def update_buttons(self):
+        selected_task = self.read_selected_task()
+        is_tab = selected_task is not None and selected_task[0] >= 0
+        self.end_process_button.setEnabled(is_tab and bool(selected_task[1]))
+        self.discard_tab_button.setEnabled(is_tab)
+
+    def end_process(self):
+        selected_task = self.read_selected_task()
+        if selected_task is not None:
+            self.task_manager.end_process(selected_task[1])
+
+    def discard_tab(self):
+        selected_task = self.read_selected_task()
+        if selected_task is not None:
+            self.task_manager.discard_tab(selected_task[0])
+
+    def done(self, result):
+        # Closing the window, Esc, accept() and reject() all end here. Sampling stops once.
+        if self.is_sampling:
+            self.is_sampling = False
+            self.task_manager.tasks_changed.disconnect(self.show_tasks)
+            self.task_manager.stop()
+        super(TaskManagerDialog, self).done(result)
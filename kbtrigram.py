@@ -0,0 +1,96 @@
+import sys
+from array import array
+
+
+class TrigramIndex:
+    # Substring index over the lower case url and title of visited pages. Every trigram (three consecutive characters)
+    # maps to the ids of the urls containing it in an array of unsigned ints. A text can only be contained in a url
+    # which has all of its trigrams, so the urls in the lists of its rarest trigrams are the candidates, and only those
+    # are checked.
+    #
+    # Trigrams found in more than max_posting_ratio of the urls, like "www" or "com", do not narrow a search down.
+    # Their lists are dropped once they grow that long and they are never used for candidates. Removed urls keep
+    # their ids in the lists until the index is rebuilt, candidates are checked against the current text anyway.
+    def __init__(self, max_posting_ratio=0.02, min_posting_cap=1000):
+        super(TrigramIndex, self).__init__()
+
+        self.max_posting_ratio = max_posting_ratio
+        self.min_posting_cap = min_posting_cap
+
+        # id: interned url, None once removed
+        self.urls = list()
+        self.url_ids = dict()
+        # trigram: array of url ids, None for trigrams in too many urls
+        self.postings = dict()
+
+    @staticmethod
+    def trigrams(text):
+        return {text[n:n + 3] for n in range(len(text) - 2)}
+
+    def posting_cap(self):
+        return max(int(len(self.url_ids) * self.max_posting_ratio), self.min_posting_cap)
+
+    def add(self, url, text, old_text=''):
+        # text is the lower case string to search in. When the text of a known url changes, old_text is its previous
+        # text and only the new trigrams are added.
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url = sys.intern(url)
+            url_id = len(self.urls)
+            self.urls.append(url)
+            self.url_ids[url] = url_id
+            old_text = ''
+
+        trigrams = self.trigrams(text)
+        if old_text:
+            trigrams -= self.trigrams(old_text)
+
+        postings = self.postings
+        posting_cap = self.posting_cap()
+        for trigram in trigrams:
+            posting = postings.get(trigram, False)
+            if posting is False:
+                postings[sys.intern(trigram)] = array('I', [url_id])
+            elif posting is not None:
+                posting.append(url_id)
+                if len(posting) > posting_cap:
+                    postings[trigram] = None
+
+    def remove(self, url):
+        url_id = self.url_ids.pop(url, None)
+        if url_id is not None:
+            self.urls[url_id] = None
+
+    def clear(self):
+        self.urls = list()
+        self.url_ids = dict()
+        self.postings = dict()
+
+    def __len__(self):
+        return len(self.url_ids)
+
+    def candidates(self, words, max_candidates=256):
+        # Urls which may contain every word, or None when the words only have trigrams which are too common to narrow
+        # the search down, or are shorter than three characters. The list of the rarest trigram is intersected with
+        # the next rarest ones while more than max_candidates urls are left.
+        postings = list()
+        for word in words:
+            for trigram in self.trigrams(word):
+                posting = self.postings.get(trigram, False)
+                if posting is False:
+                    return []
+                if posting is not None:
+                    postings.append(posting)
+
+        if not postings:
+            return None
+
+        postings.sort(key=len)
+        url_ids = postings[0]
+        for posting in postings[1:]:
+            if len(url_ids) <= max_candidates:
+                break
+            url_ids = set(url_ids).intersection(posting)
+
+        urls = self.urls
+        return [urls[url_id] for url_id in url_ids if urls[url_id] is not None]